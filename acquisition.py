@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict, deque
+
+from metrics import metrics, get_logger, DEPTH_BUCKETS
+
+log = get_logger('acquisition')
+
+
+class AcquisitionEngine(object):
+    def __init__(self, workers=8, per_host=2, max_pending=1000):
+        """
+        A bounded pool of worker threads that image acquisitions get queued
+        into. At most `workers` downloads run at once in total and at most
+        `per_host` of them against any one host, queued work for busy hosts
+        waits without holding up the other hosts.
+
+        :param int workers: the global number of worker threads. 0 runs every
+        task synchronously in :func: submit
+        :param int per_host: the maximum concurrent tasks for a single host
+        :param int max_pending: :func: submit blocks once this many tasks are
+        queued or running, so plugins can't run too far ahead of the
+        downloads
+        """
+        self.workers = workers
+        self.per_host = max(1, per_host)
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()
+        self._active = {}
+        self._unfinished = 0
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work,
+                                 name='acquisition-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, host, func, *args):
+        """
+        Queues func(*args) to be run against the given host.
+
+        :param str host: the host the task talks to, used for the per host
+        limit
+        """
+        if self.workers <= 0:
+            self._run(func, args)
+            return
+        if not self._threads:
+            self.start()
+        with self._cond:
+            metrics.observe('acquisition_queue_depth', self._unfinished,
+                            DEPTH_BUCKETS)
+            while self.max_pending and self._unfinished >= self.max_pending:
+                self._cond.wait()
+            self._pending.setdefault(host, deque()).append((func, args))
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    def join(self):
+        """
+        Blocks until everything that has been queued has finished
+        """
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def shutdown(self):
+        """
+        Waits for the queue to drain and then stops the worker threads
+        """
+        self.join()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._stopped = False
+
+    def queue_depth(self):
+        with self._cond:
+            return self._unfinished
+
+    def _next_task(self):
+        #must be called with self._cond held. Round robin between the hosts
+        # that still have a free slot
+        for host, tasks in self._pending.items():
+            if self._active.get(host, 0) < self.per_host:
+                task = tasks.popleft()
+                del self._pending[host]
+                if tasks:
+                    self._pending[host] = tasks
+                self._active[host] = self._active.get(host, 0) + 1
+                return host, task
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                host, task = self._next_task()
+                while task is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    host, task = self._next_task()
+            try:
+                self._run(*task)
+            finally:
+                with self._cond:
+                    self._active[host] -= 1
+                    self._unfinished -= 1
+                    self._cond.notify_all()
+
+    @staticmethod
+    def _run(func, args):
+        try:
+            func(*args)
+        except Exception:
+            log.exception('Error in acquisition task')
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+
+from database import Database, DedupIndex, WriteBuffer, CopyIndex
+from http_session import HttpSession
+from journal import journal_path
+from plugin_interface import PluginInterface
+from rate_limit import RateLimiter
+from reddit_connect import RedditConnect, INCREMENTAL
+from metrics import get_logger, setup_logging
+
+log = get_logger('batch_runner')
+
+
+def load_config(path):
+    """
+    Reads a batch config file. It is JSON like:
+
+        {"database": "db_name",
+         "options": {"workers": 8, "per_host": 2, "min_width": 1920},
+         "accounts": [{"username": "me", "password": "pw",
+                       "subs": ["wallpapers", "earthporn"],
+                       "output": "/srv/wallpapers/me",
+                       "mode": "incremental", "max_pages": null}]}
+
+    options are passed on to every `class` PluginInterface and mode and
+    max_pages are optional.
+
+    :returns: (accounts, database, options)
+    """
+    with open(path) as f:
+        config = json.load(f)
+    return config['accounts'], config.get('database', 'reddit_scraper'), \
+        config.get('options', {})
+
+
+class BatchRunner(object):
+    def __init__(self, accounts, database, session=None, **options):
+        """
+        Runs several accounts one after the other in a single process. They
+        share one `class` HttpSession and so one connection pool and one
+        `class` RateLimiter, which keeps the accounts together under reddit's
+        limits, and one database and `class` DedupIndex. An image that one
+        account already downloaded is hard linked into the output directory
+        of any other account that wants it through a `class` CopyIndex,
+        instead of being downloaded again. Every account keeps its own
+        journal, <database>_<username>_journal.log, so the posts one of them
+        failed are only retried by that account.
+
+        :param list accounts: dicts with the username, password, subs and
+        output of each account, and optionally its sync mode and max_pages
+        :param str database: the prefix for the database filename
+        :param session: the `class` HttpSession to share. One is made if this
+        is not passed in.
+        :param options: keyword arguments for every `class` PluginInterface
+        """
+        self.accounts = accounts
+        self.database = database
+        if session is None:
+            session = HttpSession(limiter=RateLimiter(), pool_maxsize=max(
+                10, options.get('workers', 8)))
+        self.session = session
+        self.options = options
+        self.failed = []
+
+    def run(self):
+        """
+        Runs every account. An account that fails is reported and the rest
+        carry on.
+
+        :returns list: the usernames of the accounts that failed
+        """
+        database = Database(self.database)
+        for account in self.accounts:
+            recovered = database.reconcile(account['output'])
+            if recovered:
+                log.info('Recovered %d images from %s that were missing from '
+                         'the database.', recovered, account['output'])
+        dedup = DedupIndex(database)
+        writer = WriteBuffer(database)
+        copies = CopyIndex(database, writer)
+        try:
+            for account in self.accounts:
+                copies.adopt(account['output'])
+            for account in self.accounts:
+                try:
+                    self.run_account(account, dedup, copies)
+                except Exception:
+                    log.exception('Account %s failed', account['username'])
+                    self.failed.append(account['username'])
+        finally:
+            writer.close()
+        return self.failed
+
+    def run_account(self, account, dedup, copies):
+        log.info('=== %s -> %s ===', account['username'], account['output'])
+        rc = RedditConnect(account['username'], account['password'],
+                           session=self.session)
+        rc.login()
+        upvotes = rc.iter_upvotes(database=self.database,
+                                  mode=account.get('mode', INCREMENTAL),
+                                  max_pages=account.get('max_pages'))
+        options = dict(self.options)
+        if options.get('journal') is None:
+            options['journal'] = journal_path(
+                '%s_%s' % (self.database, account['username']),
+                os.path.dirname(dedup.database.db))
+        plugins = PluginInterface(self.database,
+                                  rc.iter_candidates(account['subs'],
+                                                     upvotes),
+                                  account['output'], session=self.session,
+                                  dedup=dedup, copies=copies, **options)
+        plugins.acquire()
+        rc.save_sync_mark()
+
+
+if __name__ == '__main__':
+    #python -m batch_runner config.json
+    setup_logging()
+    accounts, database, options = load_config(sys.argv[1])
+    failed = BatchRunner(accounts, database, **options).run()
+    if failed:
+        print 'Failed accounts: %s' % ', '.join(failed)
+        sys.exit(1)
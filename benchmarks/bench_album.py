@@ -0,0 +1,114 @@
+#Benchmark for resolving an imgur album page, the old BeautifulSoup and eval
+# way against ImgurAlbum.get_imgur_album. The page is a synthetic album of
+# 500 images unless a recorded one is given, e.g. the .body file of a
+# fixture saved by tests.http_fixtures.RecordingSession.
+#
+#Run from the repository root with:
+#   python -m benchmarks.bench_album [images] [--page FILE] [--runs N]
+
+import sys
+import json
+import time
+import argparse
+
+from bs4 import BeautifulSoup
+
+from plugins import loaded_plugins
+
+ImgurAlbum = [p for p in loaded_plugins
+              if p.__name__ == 'ImgurAlbum'][0].load()
+
+
+def album_page(images):
+    album = [{'hash': 'h%06d' % n, 'ext': '.jpg',
+              'title': 'Image %d, "quoted" and \\escaped' % n,
+              'description': 'A description of image %d. ' % n * 5,
+              'width': 1920, 'height': 1080, 'size': 500000 + n,
+              'datetime': '2013-10-01 12:00:00', 'animated': False}
+             for n in range(images)]
+    thumbs = ''.join('<div class="thumb"><a href="/%s"><img src="//i.imgur.'
+                     'com/%ss.jpg"></a><p>%s</p></div>' %
+                     (image['hash'], image['hash'], image['title'])
+                     for image in album)
+    return ('<html><head><title>An album</title>'
+            '<script type="text/javascript">var imgur = {};</script>'
+            '</head><body><div id="content">%s</div>'
+            '<script type="text/javascript">\n  var album = %s;\n'
+            '  Imgur.Album.init(album);\n</script></body></html>' %
+            (thumbs, json.dumps(album)))
+
+
+def old_way(page):
+    root = BeautifulSoup(page, 'lxml')
+    urls = []
+    for script in root.find('body').find_all('script'):
+        text = script.string or ''
+        if text.replace('\n', '').lstrip().rstrip().startswith('var album'):
+            album = eval('[{%s}]' % text.split('[{')[1].split(
+                '}]')[0].replace('false', 'False'))
+            for image in album:
+                urls.append('http://i.imgur.com/%s%s' % (image['hash'],
+                                                         image['ext']))
+    return urls
+
+
+class PageResponse(object):
+    def __init__(self, page):
+        self.page = page
+        self.headers = {'content-type': 'text/html; charset=utf-8'}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.page), chunk_size):
+            yield self.page[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class PageSession(object):
+    def __init__(self, page):
+        self.page = page
+
+    def get(self, url, **kwargs):
+        return PageResponse(self.page)
+
+
+def new_way(page):
+    plugin = ImgurAlbum.__new__(ImgurAlbum)
+    plugin.session = PageSession(page)
+    return plugin.get_imgur_album('http://imgur.com/a/bench')
+
+
+def best_of(runs, function, page):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        urls = function(page)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(urls)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks resolving an '
+                                     'imgur album page')
+    parser.add_argument('images', type=int, nargs='?', default=500)
+    parser.add_argument('--page', help='a recorded album page to use '
+                        'instead of a synthetic one')
+    parser.add_argument('--runs', type=int, default=5)
+    options = parser.parse_args(argv)
+
+    if options.page:
+        with open(options.page, 'rb') as f:
+            page = f.read()
+    else:
+        page = album_page(options.images)
+    print 'page: %.1fKB' % (len(page) / 1024.0)
+    for name, function in [('BeautifulSoup + eval', old_way),
+                           ('select + js_literal', new_way)]:
+        seconds, found = best_of(options.runs, function, page)
+        print '%-22s %8.1fms %6d images' % (name, seconds * 1000, found)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,175 @@
+#End to end benchmark for PluginInterface.acquire. Synthetic sets of
+# candidates are served from a local fixture server, so it never touches the
+# real sites, and each set runs in a fresh process so the peak RSS is its
+# own.
+#
+#Run from the repository root with:
+#   python -m benchmarks.bench_pipeline [candidates ...] [--workers N]
+#       [--latency SECONDS] [--bandwidth BYTES_PER_SECOND]
+#       [--duplicates FRACTION]
+#
+#The default sets are 1000, 10000 and 100000 candidates.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging
+import argparse
+import resource
+import threading
+from Queue import Empty
+from StringIO import StringIO
+from multiprocessing import Process, Queue
+
+from PIL import Image
+
+from data_types import Download
+from database import Database, WriteBuffer
+from metrics import setup_logging
+from plugin_interface import PluginInterface
+from tests.http_fixtures import FixtureStore, FixtureServer
+
+
+def image_bytes(n):
+    out = StringIO()
+    Image.new('RGB', (4, 3), (n & 0xff, (n >> 8) & 0xff,
+                              (n >> 16) & 0xff)).save(out, 'PNG')
+    return out.getvalue()
+
+
+def build_fixtures(count, duplicates):
+    """
+    Every candidate is a direct link to its own image, except that the
+    given fraction of them are reposts of an earlier image under a new url
+    """
+    store = FixtureStore()
+    every = int(1 / duplicates) if duplicates else 0
+    for n in range(count):
+        body = image_bytes(n - 1 if every and n % every == every - 1 else n)
+        store.add('http://i.imgur.com/%d.png' % n, body, 'image/png')
+    return store
+
+
+def candidates(count):
+    for n in range(count):
+        yield Download('title %d' % n, 'wallpapers',
+                       'http://i.imgur.com/%d.png' % n)
+
+
+class DbTimer(object):
+    """
+    Adds up the time spent in database writes and lookups
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def wrap(self, cls, name):
+        original = getattr(cls, name)
+        timer = self
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with timer._lock:
+                    timer.seconds += time.time() - start
+        setattr(cls, name, timed)
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run(count, options, results):
+    here = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    server = None
+    try:
+        store = build_fixtures(count, options.duplicates)
+        server = FixtureServer(store, latency=options.latency,
+                               bandwidth=options.bandwidth).start()
+        db_timer = DbTimer()
+        db_timer.wrap(WriteBuffer, 'flush')
+        db_timer.wrap(Database, 'lookup')
+        plugins = PluginInterface(
+            'bench', candidates(count), 'out', workers=options.workers,
+            session=server.session(pool_maxsize=max(10, options.workers)),
+            preflight=False)
+        start = time.time()
+        plugins.acquire()
+        elapsed = time.time() - start
+        saved = sum(os.path.getsize(os.path.join('out', f))
+                    for f in os.listdir('out'))
+        results.put({'candidates': count, 'handled': len(plugins.handled),
+                     'seconds': elapsed, 'bytes': saved,
+                     'db_seconds': db_timer.seconds, 'rss': peak_rss()})
+    finally:
+        if server is not None:
+            server.stop()
+        os.chdir(here)
+        shutil.rmtree(tmp)
+
+
+def wait_for(p, results):
+    """
+    :returns: what the benchmark process put on the queue, or None if it
+    died without putting anything there
+    """
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Empty:
+            if not p.is_alive():
+                break
+    #it may have put its results there just before exiting
+    try:
+        return results.get(timeout=1)
+    except Empty:
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks '
+                                     'PluginInterface.acquire end to end')
+    parser.add_argument('sizes', type=int, nargs='*',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=None)
+    parser.add_argument('--duplicates', type=float, default=0.1)
+    options = parser.parse_args(argv)
+    #only the problems, which would otherwise go unseen in the child
+    setup_logging(logging.WARNING)
+
+    print '%10s %8s %9s %13s %10s %9s %10s' % (
+        'candidates', 'saved', 'seconds', 'candidates/s', 'KB/s',
+        'db secs', 'peak RSS')
+    for count in options.sizes:
+        results = Queue()
+        p = Process(target=run, args=(count, options, results))
+        p.start()
+        r = wait_for(p, results)
+        p.join()
+        if r is None:
+            sys.exit('The benchmark of %d candidates failed, exit code %s' %
+                     (count, p.exitcode))
+        assert r['handled'] > 0, 'No candidates were handled'
+        print '%10d %8d %9.2f %13.1f %10.1f %9.2f %8.1fMB' % (
+            r['candidates'], r['handled'], r['seconds'],
+            r['candidates'] / r['seconds'],
+            r['bytes'] / 1024.0 / r['seconds'], r['db_seconds'],
+            r['rss'] / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,71 @@
+#Micro-benchmark for BasePlugin.prune against a large download history.
+#
+#Run from the repository root with:
+#   python -m benchmarks.bench_prune [history_rows] [candidates]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from data_types import CandidatesList, Download
+from database import Database, DedupIndex
+from plugins.base_plugin import BasePlugin
+
+
+def build_history(database, rows):
+    conn = database.engine.connect()
+    half = rows / 2
+    conn.execute(database.wallpapers.insert(),
+                 [{'subreddit': 'wallpapers', 'title': 'title %d' % i,
+                   'url': 'http://i.imgur.com/%d.jpg' % i,
+                   'filename': '%d.jpg' % i, 'md5': '%032x' % i}
+                  for i in range(half)])
+    conn.execute(database.retrieved.insert(),
+                 [{'image_url': 'http://imgur.com/a/%d' % i}
+                  for i in range(rows - half)])
+
+
+def build_candidates(count):
+    #every other candidate is already in the history
+    cands = []
+    for i in range(count):
+        if i % 2:
+            url = 'http://i.imgur.com/%d.jpg' % i
+        else:
+            url = 'http://i.imgur.com/new%d.jpg' % i
+        cands.append(Download('title %d' % i, 'wallpapers', url))
+    return CandidatesList(cands)
+
+
+def main(rows=100000, candidates=10000):
+    here = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        database = Database('bench')
+        build_history(database, rows)
+
+        start = time.time()
+        dedup = DedupIndex(database)
+        index_time = time.time() - start
+
+        plugin = BasePlugin.__new__(BasePlugin)
+        plugin.dedup = dedup
+        plugin.candidates = build_candidates(candidates)
+        start = time.time()
+        plugin.prune()
+        prune_time = time.time() - start
+
+        print 'history rows: %d, candidates: %d' % (rows, candidates)
+        print 'dedup index build: %.3fs' % index_time
+        print 'prune: %.3fs (%d candidates left)' % (prune_time,
+                                                     len(plugin.candidates))
+    finally:
+        os.chdir(here)
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -1,32 +1,82 @@
+from collections import OrderedDict
+
+
+def convert_candidates(candidates):
+    """
+    Converts the generic list of dictionaries that came from the `class`
+    RedditConnect json data into a `class` CandidatesList of `class` Download
+    objects. Anything that is already a Download is passed through as is.
+    """
+    new_cands = []
+    for c in candidates:
+        if isinstance(c, Download):
+            new_cands.append(c)
+        else:
+            new_cands.append(Download(c['data']['title'],
+                                      c['data']['subreddit'],
+                                      c['data']['url']))
+    return CandidatesList(new_cands)
+
+
 class CandidatesList(object):
     """
     A list made up of `class` Download objects with a specific implementation
     of __contains__ to make `keyword` in work properly. Used for list of
     candidates returned from `class` RedditConnect
+
+    Candidates are indexed both by (title, subreddit, url) and by url so that
+    membership checks and removals are O(1). Iteration keeps the original
+    order and it is safe to remove candidates while iterating.
     """
     def __init__(self, candidates):
-        self.candidates = candidates
+        self._entries = OrderedDict()
+        self._by_url = {}
+        for c in candidates:
+            self.append(c)
+
+    @property
+    def candidates(self):
+        return list(self._entries.values())
 
     def __contains__(self, item):
-        for c in self.candidates:
-                if item == c.url:
-                    return item
-                elif item == c:
-                    return item
+        if isinstance(item, Download):
+            return item.key in self._entries
+        return item in self._by_url
+
+    def append(self, item):
+        if item.key in self._entries:
+            return
+        self._entries[item.key] = item
+        self._by_url.setdefault(item.url, set()).add(item.key)
 
     def remove(self, item):
-        for c in self.candidates:
-            if c.url == item:
-                self.candidates.remove(c)
-            elif item in self.candidates:
-                self.candidates.remove(item)
+        """
+        Removes a `class` Download, or every candidate with a given url if a
+        string is passed in. Removing something that isn't there is a no-op.
+        """
+        if isinstance(item, Download):
+            keys = [item.key]
+        else:
+            keys = list(self._by_url.get(item, ()))
+        for key in keys:
+            removed = self._entries.pop(key, None)
+            if removed is None:
+                continue
+            url_keys = self._by_url[removed.url]
+            url_keys.discard(key)
+            if not url_keys:
+                del self._by_url[removed.url]
 
     def __len__(self):
-        return len(self.candidates)
+        return len(self._entries)
 
     def __iter__(self):
-        for c in self.candidates:
-            yield c
+        #iterate over a snapshot of the keys so removal during iteration is
+        # safe, skipping anything that was removed after we started
+        for key in list(self._entries.keys()):
+            c = self._entries.get(key)
+            if c is not None:
+                yield c
 
 
 class DownloadList(object):
@@ -34,18 +84,34 @@ class DownloadList(object):
     A list made up of `class` Download objects with a specific implementation
     of __contains__ to make `keyword` in work properly. Used for lists of
     already handled posts and anready fetched image urls
+
+    Plain url strings may be stored as well as `class` Download objects,
+    urls are matched against either.
     """
     def __init__(self, downloads):
-        self.downloads = downloads
+        self.downloads = []
+        self._keys = set()
+        self._urls = set()
+        for dl in downloads:
+            self.append(dl)
 
     def __contains__(self, item):
-        for dl in self.downloads:
-            if dl.title == item.title and \
-                dl.subreddit == item.subreddit and \
-                    dl.url == item.url:
-                        return dl
+        if isinstance(item, Download):
+            return item.key in self._keys or item.url in self._urls
+        return item in self._urls
+
+    def __len__(self):
+        return len(self.downloads)
+
+    def __iter__(self):
+        return iter(self.downloads)
 
     def append(self, item):
+        if isinstance(item, Download):
+            self._keys.add(item.key)
+            self._urls.add(item.url)
+        else:
+            self._urls.add(item)
         self.downloads.append(item)
 
 
@@ -53,7 +119,13 @@ class Download(object):
     """
     A convenience class, the datatype that comprises a `class` DownloadList
     or a `class` CandidatesList
+
+    Two downloads are equal when their title, subreddit and url match. Don't
+    change those attributes on a download that is in a list, make a new one.
     """
+    __slots__ = ('title', 'subreddit', 'url', 'filename', 'md5', 'cookies',
+                 'file_size', 'width', 'height', 'dhash')
+
     def __init__(self, title, subreddit, url, cookies=None):
         self.title = title
         self.subreddit = subreddit
@@ -61,6 +133,30 @@ class Download(object):
         self.filename = self.name_from_url()
         self.md5 = None
         self.cookies = cookies
+        self.file_size = None
+        self.width = None
+        self.height = None
+        self.dhash = None
+
+    @property
+    def key(self):
+        return self.title, self.subreddit, self.url
+
+    def __eq__(self, other):
+        if not isinstance(other, Download):
+            return NotImplemented
+        return self.key == other.key
+
+    def __ne__(self, other):
+        if not isinstance(other, Download):
+            return NotImplemented
+        return self.key != other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return 'Download(%r, %r, %r)' % self.key
 
     def name_from_url(self):
-        return self.url.split('/')[-1].replace(' ', '_')
\ No newline at end of file
+        return self.url.split('/')[-1].replace(' ', '_')
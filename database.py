@@ -0,0 +1,802 @@
+import os
+import time
+import atexit
+import shutil
+import weakref
+import hashlib
+import threading
+
+from sqlalchemy import *
+from sqlalchemy import event
+import sqlalchemy.sql as sql
+
+from metrics import metrics, get_logger
+
+#pragmas set on every new sqlite connection. WAL lets the readers carry on
+# while a batch is being written and NORMAL only fsyncs at checkpoints, which
+# is still safe against corruption in WAL mode
+SQLITE_PRAGMAS = ['PRAGMA journal_mode=WAL',
+                  'PRAGMA synchronous=NORMAL',
+                  'PRAGMA busy_timeout=10000',
+                  'PRAGMA temp_store=MEMORY']
+#the temp files images are streamed into before being saved are named like
+# this, so that leftovers from a killed run can be recognised and cleaned up
+TEMP_PREFIX = 'reddit-scraper-'
+TEMP_SUFFIX = '.part'
+#held while picking a free name in an output directory and moving a file
+# there, so two workers never pick the same name
+SAVE_LOCK = threading.Lock()
+#how many values to put in one IN (...) lookup
+LOOKUP_CHUNK = 500
+#every `class` WriteBuffer that hasn't been closed, flushed at exit. Weak so
+# the exit hook doesn't keep a buffer that was dropped alive
+OPEN_BUFFERS = weakref.WeakSet()
+
+log = get_logger('database')
+
+
+def flush_open_buffers():
+    """
+    Writes whatever is still waiting in the open buffers, run at exit
+    """
+    for buf in list(OPEN_BUFFERS):
+        buf.flush()
+
+
+atexit.register(flush_open_buffers)
+
+
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def database_file(database):
+    """
+    Returns the sqlite file for a database prefix, in the working directory
+    """
+    return os.path.join(os.getcwd(), '%s_downloaded.db' % database)
+
+
+def file_md5(path, chunk_size=64 * 1024):
+    """
+    Returns the md5 of a file on disk, reading it a chunk at a time
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def free_path(path):
+    """
+    Returns the path, or if something is already there the first free one
+    with a number added to the name, e.g. image_1.jpg. Call this with
+    SAVE_LOCK held and put the file in place before letting go of it.
+    """
+    if not os.path.exists(path):
+        return path
+    base, ext = os.path.splitext(path)
+    inc = 1
+    while os.path.exists('%s_%d%s' % (base, inc, ext)):
+        inc += 1
+    return '%s_%d%s' % (base, inc, ext)
+
+
+def link_or_copy(src, dst):
+    """
+    Hard links src to dst, copying it instead where hard links aren't
+    possible, e.g. across file systems or on Windows
+    """
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copy2(src, dst)
+
+
+def add_column(conn, table, column, column_type):
+    """
+    Adds a column to a table unless it is already there, so a migration that
+    was interrupted halfway can simply be run again
+    """
+    existing = [c[1] for c in conn.execute('PRAGMA table_info(%s)' % table)]
+    if column not in existing:
+        conn.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                     (table, column, column_type))
+
+
+def migration_1(conn):
+    """
+    The original schema
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS wallpapers (subreddit VARCHAR, '
+                 'title VARCHAR, url VARCHAR, filename VARCHAR, '
+                 'md5 VARCHAR NOT NULL, PRIMARY KEY (md5))')
+    conn.execute('CREATE TABLE IF NOT EXISTS retrieved ('
+                 'image_url VARCHAR NOT NULL, PRIMARY KEY (image_url))')
+
+
+def migration_2(conn):
+    """
+    Fetch times, file sizes and dimensions, plus indexes for looking things
+    up by url, subreddit and time
+    """
+    add_column(conn, 'wallpapers', 'fetched_at', 'INTEGER')
+    add_column(conn, 'wallpapers', 'file_size', 'INTEGER')
+    add_column(conn, 'wallpapers', 'width', 'INTEGER')
+    add_column(conn, 'wallpapers', 'height', 'INTEGER')
+    add_column(conn, 'retrieved', 'fetched_at', 'INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_wallpapers_url '
+                 'ON wallpapers (url)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_wallpapers_subreddit '
+                 'ON wallpapers (subreddit)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_wallpapers_fetched_at '
+                 'ON wallpapers (fetched_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_retrieved_fetched_at '
+                 'ON retrieved (fetched_at)')
+
+
+def migration_3(conn):
+    """
+    A key/value table for state that has to survive between runs, like the
+    upvote sync high-water mark
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                 'key VARCHAR NOT NULL, value VARCHAR, PRIMARY KEY (key))')
+
+
+def migration_4(conn):
+    """
+    The resolution cache, what image urls each post url resolved to
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS resolutions ('
+                 'post_url VARCHAR NOT NULL, images VARCHAR, '
+                 'resolved_at INTEGER, used_at INTEGER, '
+                 'PRIMARY KEY (post_url))')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_resolutions_used_at '
+                 'ON resolutions (used_at)')
+
+
+def migration_5(conn):
+    """
+    The ETag and Last-Modified of image urls, for conditional requests
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS http_validators ('
+                 'url VARCHAR NOT NULL, etag VARCHAR, last_modified VARCHAR, '
+                 'checked_at INTEGER, PRIMARY KEY (url))')
+
+
+def migration_6(conn):
+    """
+    Perceptual hashes, and which image replaced a near duplicate
+    """
+    add_column(conn, 'wallpapers', 'dhash', 'VARCHAR')
+    add_column(conn, 'wallpapers', 'replaced_by', 'VARCHAR')
+
+
+def migration_7(conn):
+    """
+    Every output directory each image has been placed in
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS copies ('
+                 'md5 VARCHAR NOT NULL, output_dir VARCHAR NOT NULL, '
+                 'filename VARCHAR, PRIMARY KEY (md5, output_dir))')
+
+#Each migration upgrades the schema by one version and the version a database
+# file is at is kept in its PRAGMA user_version. Only ever append to this.
+MIGRATIONS = [migration_1,
+              migration_2,
+              migration_3,
+              migration_4,
+              migration_5,
+              migration_6,
+              migration_7]
+
+
+class Database(object):
+    def __init__(self, database):
+        """
+        Owns the sqlite engine and the table definitions for a run. Creating
+        one of these creates the database if it is not there yet and
+        upgrades it to the current schema in place if it is.
+
+        :param str database: the prefix for the database filename.
+        """
+        self.db = database_file(database)
+        self.engine = create_engine('sqlite:///%s' % self.db)
+        event.listen(self.engine, 'connect', set_sqlite_pragmas)
+        self.metadata = MetaData(self.engine)
+        self.wallpapers = Table('wallpapers', self.metadata,
+                                Column('subreddit', String),
+                                Column('title', String),
+                                Column('url', String),
+                                Column('filename', String),
+                                Column('md5', String, primary_key=True),
+                                Column('fetched_at', Integer),
+                                Column('file_size', Integer),
+                                Column('width', Integer),
+                                Column('height', Integer),
+                                Column('dhash', String),
+                                Column('replaced_by', String))
+        self.retrieved = Table('retrieved', self.metadata,
+                               Column('image_url', String,
+                                      primary_key=True),
+                               Column('fetched_at', Integer))
+        self.sync_state = Table('sync_state', self.metadata,
+                                Column('key', String, primary_key=True),
+                                Column('value', String))
+        self.resolutions = Table('resolutions', self.metadata,
+                                 Column('post_url', String,
+                                        primary_key=True),
+                                 Column('images', String),
+                                 Column('resolved_at', Integer),
+                                 Column('used_at', Integer))
+        self.http_validators = Table('http_validators', self.metadata,
+                                     Column('url', String, primary_key=True),
+                                     Column('etag', String),
+                                     Column('last_modified', String),
+                                     Column('checked_at', Integer))
+        self.copies = Table('copies', self.metadata,
+                            Column('md5', String, primary_key=True),
+                            Column('output_dir', String, primary_key=True),
+                            Column('filename', String))
+        self.migrate()
+
+    def schema_version(self):
+        conn = self.engine.connect()
+        return conn.execute('PRAGMA user_version').scalar()
+
+    def migrate(self):
+        """
+        Runs any migrations the database file hasn't had yet
+        """
+        conn = self.engine.connect()
+        version = conn.execute('PRAGMA user_version').scalar()
+        for i in range(version, len(MIGRATIONS)):
+            MIGRATIONS[i](conn)
+            conn.execute('PRAGMA user_version = %d' % (i + 1))
+        conn.close()
+
+    def get_state(self, key, default=None):
+        """
+        Returns a value saved with :func: set_state, or the default
+        """
+        conn = self.engine.connect()
+        value = conn.execute(sql.select([self.sync_state.c.value]).where(
+            self.sync_state.c.key == key)).scalar()
+        return default if value is None else value
+
+    def set_state(self, key, value):
+        """
+        Saves a value that has to survive between runs. None removes it.
+        """
+        with self.engine.begin() as conn:
+            conn.execute(self.sync_state.delete().where(
+                self.sync_state.c.key == key))
+            if value is not None:
+                conn.execute(self.sync_state.insert(), key=key, value=value)
+
+    def get_validators(self, url, conn=None):
+        """
+        Returns the (etag, last_modified) saved for an image url, either of
+        which may be None, or None if nothing was saved
+        """
+        if conn is None:
+            conn = self.engine.connect()
+        table = self.http_validators
+        row = conn.execute(sql.select(
+            [table.c.etag, table.c.last_modified]).where(
+            table.c.url == url)).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def lookup(self, column, values, conn=None):
+        """
+        Returns which of the values are in the column, using its index. The
+        values are queried in chunks to stay under sqlite's variable limit.
+
+        :param column: the sqlalchemy column to look in
+        :param values: an iterable of values to look for
+        :returns set: the values that were found
+        """
+        if conn is None:
+            conn = self.engine.connect()
+        values = list(values)
+        found = set()
+        start = time.time()
+        #plain sql here, compiling a select with hundreds of bind parameters
+        # costs more than running it
+        query = 'SELECT %s FROM %s WHERE %s IN (%%s)' % \
+                (column.name, column.table.name, column.name)
+        for i in range(0, len(values), LOOKUP_CHUNK):
+            chunk = values[i:i + LOOKUP_CHUNK]
+            found.update(r[0] for r in conn.execute(
+                query % ', '.join('?' * len(chunk)), tuple(chunk)))
+        metrics.observe('db_lookup_seconds', time.time() - start)
+        return found
+
+    def reconcile(self, output_dir):
+        """
+        Catches up the database with the output directory after a run that
+        was killed before its last batch of writes was flushed. Leftover temp
+        files are removed and any image on disk that the wallpapers table
+        doesn't know about is hashed and recorded, so it is treated as a
+        duplicate from now on instead of being downloaded again.
+
+        :param str output_dir: the location images are saved to
+        :returns int: how many images were recorded
+        """
+        if not os.path.isdir(output_dir):
+            return 0
+        conn = self.engine.connect()
+        known = set(f[0] for f in conn.execute(
+            sql.select([self.wallpapers.c.filename])).fetchall())
+        rows = []
+        for name in os.listdir(output_dir):
+            path = os.path.join(output_dir, name)
+            if name.startswith(TEMP_PREFIX) and name.endswith(TEMP_SUFFIX):
+                os.remove(path)
+                continue
+            if name in known or not os.path.isfile(path):
+                continue
+            rows.append({'subreddit': None, 'title': None, 'url': None,
+                         'filename': name, 'md5': file_md5(path),
+                         'fetched_at': int(os.path.getmtime(path)),
+                         'file_size': os.path.getsize(path),
+                         'width': None, 'height': None})
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(self.wallpapers.insert().prefix_with(
+                    'OR IGNORE'), rows)
+        return len(rows)
+
+
+class WriteBuffer(object):
+    def __init__(self, database, max_rows=100, max_delay=5.0):
+        """
+        A write-behind buffer for the wallpapers, retrieved, resolutions,
+        http_validators and copies tables, and for marking replaced
+        wallpapers. Rows
+        are grouped up and written with executemany in one transaction when
+        max_rows of them are waiting, every max_delay seconds, and when the
+        buffer is closed, instead of one connection and one transaction per
+        row. A killed run loses at most the batch that was waiting, which
+        `func` Database.reconcile picks up on the next start.
+
+        :param database: the `class` Database to write to
+        :param int max_rows: flush once this many rows are waiting. 1 writes
+        every row straight away
+        :param float max_delay: the longest in seconds a row waits before
+        being written, None to only flush on size and close
+        """
+        self.database = database
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.wallpapers = []
+        self.retrieved = []
+        self.resolutions = []
+        self.validators = []
+        self.replacements = []
+        self.copies = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        if max_delay is not None and max_rows > 1:
+            self._timer = threading.Thread(target=self._flush_periodically,
+                                           name='write-buffer')
+            self._timer.daemon = True
+            self._timer.start()
+        OPEN_BUFFERS.add(self)
+
+    def add_wallpaper(self, download):
+        """
+        Queues the full handled link info of a `class` Download for the
+        wallpapers table
+        """
+        with self._lock:
+            self.wallpapers.append({'subreddit': download.subreddit,
+                                    'title': download.title,
+                                    'url': download.url,
+                                    'filename': download.filename,
+                                    'md5': download.md5,
+                                    'fetched_at': int(time.time()),
+                                    'file_size': download.file_size,
+                                    'width': download.width,
+                                    'height': download.height,
+                                    'dhash': download.dhash,
+                                    'replaced_by': None})
+        self._maybe_flush()
+
+    def add_replacement(self, md5, replaced_by):
+        """
+        Queues marking a wallpaper as replaced by a better copy, which is
+        written after the new wallpapers in the same batch
+        """
+        with self._lock:
+            self.replacements.append({'old': md5, 'new': replaced_by})
+        self._maybe_flush()
+
+    def add_retrieved(self, url):
+        """
+        Queues a finished post url for the retrieved table
+        """
+        with self._lock:
+            self.retrieved.append({'image_url': url,
+                                   'fetched_at': int(time.time())})
+        self._maybe_flush()
+
+    def add_resolution(self, post_url, images, resolved_at, used_at):
+        """
+        Queues a resolution cache entry, replacing any older one for the post
+
+        :param str images: the json encoded list of images
+        """
+        with self._lock:
+            self.resolutions.append({'post_url': post_url, 'images': images,
+                                     'resolved_at': resolved_at,
+                                     'used_at': used_at})
+        self._maybe_flush()
+
+    def add_validators(self, url, etag, last_modified):
+        """
+        Queues the ETag and Last-Modified an image url was served with
+        """
+        with self._lock:
+            self.validators.append({'url': url, 'etag': etag,
+                                    'last_modified': last_modified,
+                                    'checked_at': int(time.time())})
+        self._maybe_flush()
+
+    def add_copy(self, md5, output_dir, filename):
+        """
+        Queues where a copy of an image was placed
+        """
+        with self._lock:
+            self.copies.append({'md5': md5, 'output_dir': output_dir,
+                                'filename': filename})
+        self._maybe_flush()
+
+    def pending(self):
+        with self._lock:
+            return len(self.wallpapers) + len(self.retrieved) + \
+                len(self.resolutions) + len(self.validators) + \
+                len(self.replacements) + len(self.copies)
+
+    def _maybe_flush(self):
+        if self.pending() >= self.max_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes everything that is waiting in a single transaction
+        """
+        with self._flush_lock:
+            with self._lock:
+                wallpapers, self.wallpapers = self.wallpapers, []
+                retrieved, self.retrieved = self.retrieved, []
+                resolutions, self.resolutions = self.resolutions, []
+                validators, self.validators = self.validators, []
+                replacements, self.replacements = self.replacements, []
+                copies, self.copies = self.copies, []
+            if not (wallpapers or retrieved or resolutions or validators or
+                    replacements or copies):
+                return
+            start = time.time()
+            with self.database.engine.begin() as conn:
+                if wallpapers:
+                    conn.execute(self.database.wallpapers.insert().prefix_with(
+                        'OR IGNORE'), wallpapers)
+                if retrieved:
+                    conn.execute(self.database.retrieved.insert().prefix_with(
+                        'OR IGNORE'), retrieved)
+                if resolutions:
+                    conn.execute(self.database.resolutions.insert(
+                        ).prefix_with('OR REPLACE'), resolutions)
+                if validators:
+                    conn.execute(self.database.http_validators.insert(
+                        ).prefix_with('OR REPLACE'), validators)
+                if replacements:
+                    table = self.database.wallpapers
+                    conn.execute(table.update().where(
+                        table.c.md5 == bindparam('old')).values(
+                        replaced_by=bindparam('new')), replacements)
+                if copies:
+                    conn.execute(self.database.copies.insert().prefix_with(
+                        'OR REPLACE'), copies)
+            metrics.observe('db_flush_seconds', time.time() - start)
+            metrics.inc('db_rows_written', len(wallpapers) + len(retrieved) +
+                        len(resolutions) + len(validators) +
+                        len(replacements) + len(copies))
+
+    def close(self):
+        """
+        Stops the periodic flushing and writes anything still waiting
+        """
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush()
+        OPEN_BUFFERS.discard(self)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.max_delay):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Error flushing the write buffer')
+
+
+class IndexedLookup(object):
+    def __init__(self, index, column):
+        """
+        A set-like view of a database column. Membership checks are answered
+        from memory when the value has been seen this run and otherwise by an
+        indexed lookup, and the answer is remembered either way so each value
+        is only ever looked up once.
+
+        :param index: the `class` DedupIndex this belongs to
+        :param column: the indexed sqlalchemy column
+        """
+        self.index = index
+        self.column = column
+        self.found = set()
+        self.missing = set()
+
+    def __contains__(self, value):
+        if value in self.found:
+            return True
+        if value in self.missing:
+            return False
+        self.prefetch([value])
+        return value in self.found
+
+    def add(self, value):
+        with self.index._lock:
+            self.found.add(value)
+            self.missing.discard(value)
+
+    def prefetch(self, values):
+        """
+        Looks up many values in as few queries as possible so that checking
+        them afterwards doesn't touch the database
+        """
+        values = set(values) - self.found - self.missing
+        if not values:
+            return
+        found = self.index.database.lookup(self.column, values,
+                                           self.index.connection())
+        with self.index._lock:
+            self.found.update(found)
+            #something may have been added while we were looking
+            self.missing.update(values - found - self.found)
+
+
+class DedupIndex(object):
+    def __init__(self, database):
+        """
+        A hash based index of everything that has already been acquired. It
+        is shared by every plugin for the whole run and kept up to date in
+        place as images arrive. Nothing is loaded up front, membership
+        checks go to the database through its indexes the first time a value
+        is seen and are answered from memory after that.
+
+        :param database: a `class` Database or the prefix for the database
+        filename
+        """
+        if not isinstance(database, Database):
+            database = Database(database)
+        self.database = database
+        self._lock = threading.RLock()
+        self._md5_lock = threading.Lock()
+        self._local = threading.local()
+        self.md5s = IndexedLookup(self, database.wallpapers.c.md5)
+        self.image_urls = IndexedLookup(self, database.wallpapers.c.url)
+        self.post_urls = IndexedLookup(self, database.retrieved.c.image_url)
+
+    def connection(self):
+        """
+        Returns a connection for the calling thread, reused between lookups
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.database.engine.connect()
+        return conn
+
+    def add_md5(self, md5):
+        """
+        Records an md5 as acquired.
+
+        :param str md5: the hex digest of the image
+        :returns bool: True if the md5 was new, False if it was a duplicate
+        """
+        with self._md5_lock:
+            if md5 in self.md5s:
+                return False
+            self.md5s.add(md5)
+            return True
+
+    def add_image(self, download):
+        """
+        Records a successfully saved `class` Download in the index.
+        """
+        self.md5s.add(download.md5)
+        self.image_urls.add(download.url)
+
+    def add_post(self, url):
+        self.post_urls.add(url)
+
+    def prefetch(self, urls):
+        """
+        Looks up a batch of post urls at once ahead of :func: already_acquired
+        """
+        urls = list(urls)
+        self.image_urls.prefetch(urls)
+        self.post_urls.prefetch(urls)
+
+    def already_acquired(self, url):
+        """
+        True if the url is a previously fetched image or finished post
+        """
+        return url in self.image_urls or url in self.post_urls
+
+
+class CopyIndex(object):
+    def __init__(self, database, writer=None):
+        """
+        Keeps track of every output directory each image has been placed in,
+        so that when several accounts share a database an image one of them
+        already downloaded is hard linked into the other's output directory
+        instead of being downloaded again.
+
+        :param database: the `class` Database
+        :param writer: the `class` WriteBuffer copies are recorded through.
+        Without one every copy is written as soon as it is placed.
+        """
+        self.database = database
+        if writer is None:
+            writer = WriteBuffer(database, max_rows=1)
+        self.writer = writer
+        #what was placed this run, which may not have been written yet
+        self._md5s = {}
+        self._paths = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.database.engine.connect()
+        return conn
+
+    def add(self, download, output_dir):
+        """
+        Records that a `class` Download was saved into output_dir
+        """
+        output_dir = os.path.abspath(output_dir)
+        with self._lock:
+            self._md5s[download.url] = download.md5
+            self._paths.setdefault(download.md5, []).append(
+                os.path.join(output_dir, download.filename))
+        self.writer.add_copy(download.md5, output_dir, download.filename)
+
+    def adopt(self, output_dir):
+        """
+        Records the images in output_dir that the wallpapers table knows
+        about but that have no copy recorded there, i.e. ones saved before
+        copies were tracked, so that they can be linked from as well.
+
+        :returns int: how many were recorded
+        """
+        output_dir = os.path.abspath(output_dir)
+        if not os.path.isdir(output_dir):
+            return 0
+        on_disk = set(os.listdir(output_dir))
+        rows = [{'md5': md5, 'output_dir': output_dir, 'filename': filename}
+                for md5, filename in self.connection().execute(
+                    'SELECT md5, filename FROM wallpapers WHERE md5 NOT IN '
+                    '(SELECT md5 FROM copies WHERE output_dir = ?)',
+                    (output_dir,))
+                if filename in on_disk]
+        if rows:
+            with self.database.engine.begin() as conn:
+                conn.execute(self.database.copies.insert().prefix_with(
+                    'OR IGNORE'), rows)
+        return len(rows)
+
+    def md5_for_url(self, url):
+        """
+        Returns the md5 of the image saved from a url, or None
+        """
+        with self._lock:
+            if url in self._md5s:
+                return self._md5s[url]
+        table = self.database.wallpapers
+        return self.connection().execute(sql.select([table.c.md5]).where(
+            table.c.url == url).where(table.c.replaced_by == None)).scalar()
+
+    def paths(self, md5):
+        """
+        Returns every path a copy of the image was placed at
+        """
+        table = self.database.copies
+        rows = self.connection().execute(sql.select(
+            [table.c.output_dir, table.c.filename]).where(table.c.md5 == md5))
+        paths = [os.path.join(d, f) for d, f in rows]
+        with self._lock:
+            paths.extend(p for p in self._paths.get(md5, ())
+                         if p not in paths)
+        return paths
+
+    def place(self, md5, output_dir):
+        """
+        Makes sure there is a copy of an image in output_dir, hard linking
+        an existing copy there if there isn't.
+
+        :returns str: the filename of the copy in output_dir, or None if no
+        copy of the image could be found on disk
+        """
+        output_dir = os.path.abspath(output_dir)
+        with self._lock:
+            existing = [p for p in self.paths(md5) if os.path.isfile(p)]
+            for path in existing:
+                if os.path.dirname(path) == output_dir:
+                    return os.path.basename(path)
+            if not existing:
+                return None
+            src = existing[0]
+            with SAVE_LOCK:
+                dst = free_path(os.path.join(output_dir,
+                                             os.path.basename(src)))
+                link_or_copy(src, dst)
+            filename = os.path.basename(dst)
+            self._paths.setdefault(md5, []).append(dst)
+        self.writer.add_copy(md5, output_dir, filename)
+        return filename
+
+    def replace(self, old_md5, new_md5, new_path):
+        """
+        Swaps every copy of an image that a bigger copy has just replaced
+        for a hard link to the new one, in the output directories other than
+        the one the new image was saved to, which its plugin takes care of.
+
+        :param str new_path: where the new image was saved
+        :returns list: the paths of the new links
+        """
+        new_path = os.path.abspath(new_path)
+        placed = []
+        with self._lock:
+            for path in self.paths(old_md5):
+                output_dir = os.path.dirname(path)
+                if output_dir == os.path.dirname(new_path) or \
+                        not os.path.isfile(path):
+                    continue
+                with SAVE_LOCK:
+                    #linked before the old one goes so it can't take its
+                    # name, which the copies table still has for old_md5
+                    dst = free_path(os.path.join(
+                        output_dir, os.path.basename(new_path)))
+                    link_or_copy(new_path, dst)
+                    os.remove(path)
+                self._paths.setdefault(new_md5, []).append(dst)
+                placed.append(dst)
+            self._paths.pop(old_md5, None)
+        for dst in placed:
+            self.writer.add_copy(new_md5, os.path.dirname(dst),
+                                 os.path.basename(dst))
+        return placed
+
+    def link_url(self, url, output_dir):
+        """
+        Places the image saved from a url in output_dir, see :func: place.
+
+        :returns str: the filename in output_dir, or None if the url was
+        never saved or no copy of it could be found
+        """
+        md5 = self.md5_for_url(url)
+        if md5 is None:
+            return None
+        return self.place(md5, output_dir)
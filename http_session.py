@@ -0,0 +1,160 @@
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import RateLimiter
+from metrics import metrics, get_logger
+
+log = get_logger('http_session')
+
+#statuses that are worth asking again for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+#only these are retried on a connection error, a POST might have gone through
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+#a server sends these with a Retry-After when it turned a request away
+# without acting on it, so only then is it safe to send a POST again
+REFUSED_STATUSES = (429, 503)
+
+
+class HttpSession(object):
+    def __init__(self, headers=None, timeout=(10, 60), retries=3,
+                 backoff=0.5, max_backoff=30, pool_connections=20,
+                 pool_maxsize=10, limiter=None):
+        """
+        A pooled, keep-alive HTTP session shared by `class` RedditConnect and
+        all of the plugins. Every request gets a connect and read timeout so
+        a stalled host can't hang the job, and server errors and dropped
+        connections are retried with exponential backoff and jitter. This is
+        also the single place to set headers and cookies that should go out
+        with every request, or with every request to one host.
+
+        :param dict headers: headers to send with every request
+        :param timeout: seconds, either one number or a (connect, read) tuple
+        :param int retries: how many times to retry a failed request
+        :param float backoff: the base delay in seconds between retries, it
+        doubles with every attempt
+        :param float max_backoff: the longest to wait between retries
+        :param int pool_connections: how many hosts to keep a pool for
+        :param int pool_maxsize: the number of kept-alive connections per
+        host, this should be at least the number of download workers
+        :param limiter: the `class` RateLimiter every request waits on, so it
+        can be shared between sessions. A default one is made if this is not
+        passed in.
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.host_cookies = {}
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    @property
+    def headers(self):
+        return self.session.headers
+
+    def set_cookies(self, host, cookies):
+        """
+        Sends the cookies with every request to the host from now on.
+
+        :param str host: the host name, e.g. 'www.deviantart.com'
+        :param dict cookies: the cookies to send
+        """
+        self.host_cookies.setdefault(host.lower(), {}).update(cookies)
+
+    def delay(self, attempt):
+        """
+        Exponential backoff with full jitter for the given retry attempt
+        """
+        cap = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes a request, retrying it on connection errors and server errors,
+        see `func` retryable. Accepts the same keyword arguments as
+        `func` requests.request. If all of the retries fail the last response
+        is returned or the last exception is raised.
+        """
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout)
+        host = requests.utils.urlparse(url).hostname or ''
+        if host.lower() in self.host_cookies:
+            cookies = dict(self.host_cookies[host.lower()])
+            cookies.update(kwargs.get('cookies') or {})
+            kwargs['cookies'] = cookies
+        attempt = 0
+        while True:
+            self.limiter.acquire(host)
+            start = time.time()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout), e:
+                metrics.inc('http_requests', host=host, status='error')
+                if method not in IDEMPOTENT_METHODS or \
+                        attempt >= self.retries:
+                    raise
+                log.debug('Retrying %s %s after %s', method, url, e)
+            else:
+                #the time to the headers, the body may still be streaming
+                metrics.observe('http_request_seconds', time.time() - start,
+                                host=host)
+                metrics.inc('http_requests', host=host,
+                            status=resp.status_code)
+                self.limiter.update(host, resp)
+                if not self.retryable(method, resp) or \
+                        attempt >= self.retries:
+                    return resp
+                resp.close()
+            time.sleep(self.delay(attempt))
+            attempt += 1
+
+    def retryable(self, method, resp):
+        """
+        Whether a response is worth asking again for. Any of RETRY_STATUSES
+        is for an idempotent method, but another method, such as a POST, may
+        have taken effect before the error, so it is only sent again when
+        the server refused it with a Retry-After.
+        """
+        if resp.status_code not in RETRY_STATUSES:
+            return False
+        if method in IDEMPOTENT_METHODS:
+            return True
+        return resp.status_code in REFUSED_STATUSES and \
+            'retry-after' in resp.headers
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_default_session = None
+_default_lock = threading.Lock()
+
+
+def default_session():
+    """
+    Returns the process wide `class` HttpSession, creating it the first time
+    """
+    global _default_session
+    with _default_lock:
+        if _default_session is None:
+            _default_session = HttpSession()
+        return _default_session
@@ -0,0 +1,183 @@
+import struct
+
+JPEG = 'jpeg'
+PNG = 'png'
+GIF = 'gif'
+BMP = 'bmp'
+WEBP = 'webp'
+#the JPEG start of frame markers, the segment that holds the dimensions
+JPEG_SOF_MARKERS = set([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                        0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+#JPEG markers that have no length or payload
+JPEG_STANDALONE_MARKERS = set([0x01] + range(0xd0, 0xd9))
+#how many bytes from the end of a file to keep for :func: check_complete
+TAIL_SIZE = 1024
+
+
+class ImageError(ValueError):
+    """
+    Raised for data that isn't an image, or isn't all of one
+    """
+
+
+class ImageInfo(object):
+    """
+    The format and dimensions of an image, read from its header. For formats
+    that record their own length `expected_size` is the size in bytes the
+    whole file should be.
+    """
+    __slots__ = ('format', 'width', 'height', 'expected_size')
+
+    def __init__(self, format, width, height, expected_size=None):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.expected_size = expected_size
+
+    def __repr__(self):
+        return 'ImageInfo(%r, %r, %r)' % (self.format, self.width,
+                                          self.height)
+
+
+def sniff(data):
+    """
+    Returns the image format from the magic bytes at the start of the data,
+    or None if they aren't those of a supported image format
+    """
+    if data.startswith('\xff\xd8\xff'):
+        return JPEG
+    if data.startswith('\x89PNG\r\n\x1a\n'):
+        return PNG
+    if data[:6] in ('GIF87a', 'GIF89a'):
+        return GIF
+    if data.startswith('BM'):
+        return BMP
+    if data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+        return WEBP
+    return None
+
+
+def parse_header(data, final=False):
+    """
+    Reads the format and dimensions of an image from the start of its data
+    without decoding it.
+
+    :param str data: the first bytes of the image
+    :param bool final: True if this is all of the data there is
+    :returns: an `class` ImageInfo, or None if more data is needed to tell
+    :raises ImageError: if the data isn't an image, or it is all of the data
+    and the dimensions weren't in it
+    """
+    if len(data) < 12:
+        if final:
+            raise ImageError('Too short to be an image')
+        return None
+    image_format = sniff(data)
+    if image_format is None:
+        raise ImageError('Not a known image format')
+    info = PARSERS[image_format](data)
+    if info is None and final:
+        raise ImageError('Truncated %s header' % image_format)
+    return info
+
+
+def _png(data):
+    if len(data) < 24:
+        return None
+    if data[12:16] != 'IHDR':
+        raise ImageError('PNG without an IHDR chunk')
+    width, height = struct.unpack('>II', data[16:24])
+    return ImageInfo(PNG, width, height)
+
+
+def _gif(data):
+    width, height = struct.unpack('<HH', data[6:10])
+    return ImageInfo(GIF, width, height)
+
+
+def _bmp(data):
+    if len(data) < 26:
+        return None
+    file_size, = struct.unpack('<I', data[2:6])
+    dib_size, = struct.unpack('<I', data[14:18])
+    if dib_size == 12:
+        width, height = struct.unpack('<HH', data[18:22])
+    else:
+        width, height = struct.unpack('<ii', data[18:26])
+    return ImageInfo(BMP, width, abs(height), file_size)
+
+
+def _webp(data):
+    if len(data) < 30:
+        return None
+    riff_size, = struct.unpack('<I', data[4:8])
+    chunk = data[12:16]
+    if chunk == 'VP8 ':
+        if data[23:26] != '\x9d\x01\x2a':
+            raise ImageError('Bad VP8 frame')
+        width, height = struct.unpack('<HH', data[26:30])
+        width, height = width & 0x3fff, height & 0x3fff
+    elif chunk == 'VP8L':
+        if data[20] != '\x2f':
+            raise ImageError('Bad VP8L signature')
+        bits, = struct.unpack('<I', data[21:25])
+        width = (bits & 0x3fff) + 1
+        height = ((bits >> 14) & 0x3fff) + 1
+    elif chunk == 'VP8X':
+        width = struct.unpack('<I', data[24:27] + '\x00')[0] + 1
+        height = struct.unpack('<I', data[27:30] + '\x00')[0] + 1
+    else:
+        raise ImageError('Unknown WebP chunk %r' % chunk)
+    return ImageInfo(WEBP, width, height, riff_size + 8)
+
+
+def _jpeg(data):
+    #walk the segments until a start of frame turns up
+    i = 2
+    while True:
+        while i < len(data) and data[i] == '\xff':
+            i += 1
+        if i >= len(data):
+            return None
+        marker = ord(data[i])
+        i += 1
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xd9, 0xda):
+            raise ImageError('JPEG without a frame header')
+        if i + 2 > len(data):
+            return None
+        length, = struct.unpack('>H', data[i:i + 2])
+        if marker in JPEG_SOF_MARKERS:
+            if i + 7 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[i + 3:i + 7])
+            return ImageInfo(JPEG, width, height)
+        i += length
+        if i < len(data) and data[i] != '\xff':
+            raise ImageError('Corrupt JPEG segment')
+        i += 1
+
+PARSERS = {JPEG: _jpeg, PNG: _png, GIF: _gif, BMP: _bmp, WEBP: _webp}
+
+
+def check_complete(info, tail, size):
+    """
+    Makes sure an image was received in full by looking for the end marker
+    of its format, or comparing the size against the one in its header.
+
+    :param info: the `class` ImageInfo from :func: parse_header
+    :param str tail: the last TAIL_SIZE bytes of the data
+    :param int size: the total size of the data in bytes
+    :raises ImageError: if the image was cut short
+    """
+    if info.expected_size is not None:
+        complete = size >= info.expected_size
+    elif info.format == JPEG:
+        complete = '\xff\xd9' in tail
+    elif info.format == PNG:
+        complete = 'IEND' in tail[-32:]
+    else:
+        complete = tail.rstrip('\x00').endswith(';')
+    if not complete:
+        raise ImageError('Truncated %s' % info.format)
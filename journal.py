@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+
+#the states a post or an image goes through
+DISCOVERED = 'discovered'
+RESOLVED = 'resolved'
+DOWNLOADING = 'downloading'
+SAVED = 'saved'
+FAILED = 'failed'
+#what an entry is about
+POST = 'post'
+IMAGE = 'image'
+#failed posts are retried on the next runs until they are this many seconds
+# old or have failed this many times in a row
+FAILURE_TTL = 30 * 24 * 60 * 60
+MAX_FAILURES = 3
+
+
+def journal_path(database, folder):
+    """
+    The default journal file for a database prefix
+
+    :param str folder: the directory the database file is in
+    """
+    return os.path.join(folder, '%s_journal.log' %
+                        os.path.basename(database))
+
+
+class JournalState(object):
+    """
+    What a journal says happened, the last state of every post and image
+    """
+    def __init__(self):
+        self.entries = {}
+        self.failures = {}
+        self.lines = 0
+
+    def apply(self, entry):
+        self.lines += 1
+        key = (entry['kind'], entry['url'])
+        if entry['state'] == FAILED:
+            #how many times in a row, which compacting keeps with the entry
+            if 'failures' not in entry:
+                entry['failures'] = self.failures.get(key, 0) + 1
+            self.failures[key] = entry['failures']
+        elif entry['state'] == SAVED:
+            self.failures.pop(key, None)
+        self.entries[key] = entry
+
+    def last(self, kind, url):
+        """
+        Returns the last entry for a post or image url, or None
+        """
+        return self.entries.get((kind, url))
+
+    def with_state(self, kind, state):
+        return [e for e in self.entries.values()
+                if e['kind'] == kind and e['state'] == state]
+
+    def retries(self, failure_ttl=FAILURE_TTL):
+        """
+        The failed posts that are still worth another try, oldest first
+
+        :param int failure_ttl: posts that last failed longer ago than this
+        many seconds are given up on
+        """
+        cutoff = int(time.time()) - failure_ttl
+        return sorted((e for e in self.with_state(POST, FAILED)
+                       if e['at'] >= cutoff and
+                       e['failures'] < MAX_FAILURES),
+                      key=lambda e: e['at'])
+
+    def restore(self, database):
+        """
+        Writes what the journal saw finish into the database: the wallpapers
+        rows of saved images, the finished posts and the resolutions of
+        posts that got that far. This is whatever a killed run had queued up
+        but never written.
+
+        :param database: the `class` Database
+        :returns int: how many images were restored
+        """
+        wallpapers = []
+        for e in self.with_state(IMAGE, SAVED):
+            if e.get('md5'):
+                wallpapers.append({'subreddit': e.get('subreddit'),
+                                   'title': e.get('title'),
+                                   'url': e['url'],
+                                   'filename': e.get('filename'),
+                                   'md5': e['md5'],
+                                   'fetched_at': e['at'],
+                                   'file_size': e.get('file_size'),
+                                   'width': e.get('width'),
+                                   'height': e.get('height'),
+                                   'dhash': e.get('dhash'),
+                                   'replaced_by': None})
+        retrieved = [{'image_url': e['url'], 'fetched_at': e['at']}
+                     for e in self.with_state(POST, SAVED)]
+        resolutions = [{'post_url': e['url'],
+                        'images': json.dumps(e['images']),
+                        'resolved_at': e['at'], 'used_at': e['at']}
+                       for e in self.with_state(POST, RESOLVED)]
+        with database.engine.begin() as conn:
+            if wallpapers:
+                conn.execute(database.wallpapers.insert().prefix_with(
+                    'OR IGNORE'), wallpapers)
+            if retrieved:
+                conn.execute(database.retrieved.insert().prefix_with(
+                    'OR IGNORE'), retrieved)
+            if resolutions:
+                conn.execute(database.resolutions.insert().prefix_with(
+                    'OR IGNORE'), resolutions)
+        return len(wallpapers)
+
+
+class Journal(object):
+    def __init__(self, path):
+        """
+        An append-only log of what happens to every candidate post and every
+        image during a run, one JSON object per line: discovered, resolved
+        (with the images it resolved to), downloading, saved (with what the
+        wallpapers table needs) and failed (with the reason). Every line is
+        flushed as it is written, so it survives the process being killed,
+        and a run that died partway is picked up by replaying it with
+        :func: replay.
+
+        :param str path: the journal file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def replay(self):
+        """
+        Reads the journal back. A line cut short by the process dying is
+        ignored.
+
+        :returns: a `class` JournalState
+        """
+        state = JournalState()
+        if not os.path.exists(self.path):
+            return state
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    state.apply(json.loads(line))
+                except ValueError:
+                    continue
+        return state
+
+    def record(self, kind, url, state, **fields):
+        """
+        Appends a state change for a post or an image.
+
+        :param str kind: POST or IMAGE
+        :param str url: the post or image url
+        :param str state: DISCOVERED, RESOLVED, DOWNLOADING, SAVED or FAILED
+        :param fields: anything else to keep with it, e.g. reason
+        """
+        fields.update({'at': int(time.time()), 'kind': kind, 'url': url,
+                       'state': state})
+        line = json.dumps(fields, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(line)
+            self._file.flush()
+
+    def post(self, url, state, **fields):
+        self.record(POST, url, state, **fields)
+
+    def image(self, url, state, **fields):
+        self.record(IMAGE, url, state, **fields)
+
+    def saved(self, download, post):
+        """
+        Records a saved `class` Download with everything its wallpapers row
+        needs
+        """
+        self.image(download.url, SAVED, post=post, md5=download.md5,
+                   filename=download.filename, title=download.title,
+                   subreddit=download.subreddit,
+                   file_size=download.file_size, width=download.width,
+                   height=download.height, dhash=download.dhash)
+
+    def compact(self, failure_ttl=FAILURE_TTL):
+        """
+        Rewrites the journal keeping only the posts that
+        :func: JournalState.retries would try again, so it doesn't grow
+        without bound. Only call this once everything else it recorded has
+        been written to the database. The new journal replaces the old one
+        atomically.
+
+        :param int failure_ttl: failures older than this many seconds are
+        dropped too
+        :returns int: how many lines are left
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            kept = self.replay().retries(failure_ttl)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for e in kept:
+                    f.write(json.dumps(e, separators=(',', ':')) + '\n')
+            if os.name == 'nt' and os.path.exists(self.path):
+                #rename won't replace a file on windows
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        return len(kept)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+#every module logs under this logger, see :func: setup_logging
+LOGGER_NAME = 'reddit_scraper'
+#seconds, for latencies
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                10.0, 30.0, 60.0)
+#counts, for queue depths
+DEPTH_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+#prefixed to every metric in the Prometheus textfile
+PROMETHEUS_PREFIX = 'reddit_scraper_'
+
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+def get_logger(name):
+    """
+    Returns the logger for a module, e.g. get_logger('reddit_connect')
+    """
+    return logging.getLogger('%s.%s' % (LOGGER_NAME, name))
+
+
+def setup_logging(level=logging.INFO, stream=None):
+    """
+    Sends everything logged at level or above to the stream, stderr by
+    default, with a timestamp and the level. Scripts call this once, the
+    modules themselves never configure logging.
+
+    :param level: a logging level, e.g. logging.DEBUG to also see every
+    request and skipped image
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)-7s %(message)s'))
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
+
+
+class Counter(object):
+    """
+    A number that only goes up
+    """
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def summary(self):
+        return {'value': self.value}
+
+
+class Histogram(object):
+    """
+    Counts observations into cumulative buckets, Prometheus style, and keeps
+    their count, sum, min and max
+    """
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+    def cumulative(self):
+        with self._lock:
+            total = 0
+            result = []
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                result.append((bound, total))
+            return result
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min,
+                'max': self.max,
+                'mean': float(self.sum) / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95)}
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        The counters and histograms for a process. Each metric is a name
+        plus labels, e.g. counter('downloads', host='imgur.com',
+        result='saved'), and is created the first time it is asked for.
+        """
+        self.started = time.time()
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels, factory):
+        key = (kind, name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get('counter', name, labels, Counter)
+
+    def histogram(self, name, buckets=TIME_BUCKETS, **labels):
+        return self._get('histogram', name, labels,
+                         lambda: Histogram(buckets))
+
+    def inc(self, name, amount=1, **labels):
+        self.counter(name, **labels).inc(amount)
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        self.histogram(name, buckets, **labels).observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes how long the with block takes into a histogram of seconds
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def value(self, name, **labels):
+        """
+        The value of a counter, 0 if it was never incremented
+        """
+        key = ('counter', name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        return metric.value if metric is not None else 0
+
+    def total(self, name, **labels):
+        """
+        The sum of a counter over every label value not given, e.g.
+        total('downloads', result='saved') for all hosts
+        """
+        wanted = set(labels.items())
+        with self._lock:
+            items = self._metrics.items()
+        return sum(m.value for (kind, n, l), m in items
+                   if kind == 'counter' and n == name and
+                   wanted.issubset(l))
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+        self.started = time.time()
+
+    def summary(self):
+        """
+        Everything as a dict that can be dumped to JSON
+        """
+        with self._lock:
+            items = sorted(self._metrics.items())
+        result = {'started': self.started,
+                  'seconds': time.time() - self.started,
+                  'counters': [], 'histograms': []}
+        for (kind, name, labels), metric in items:
+            entry = {'name': name, 'labels': dict(labels)}
+            entry.update(metric.summary())
+            result[kind + 's'].append(entry)
+        return result
+
+    def write_json(self, path):
+        """
+        Writes :func: summary to a file
+        """
+        write_atomically(path, json.dumps(self.summary(), indent=1,
+                                          sort_keys=True))
+
+    def prometheus(self):
+        """
+        Everything in the Prometheus text exposition format
+        """
+        with self._lock:
+            items = sorted(self._metrics.items())
+        lines = []
+        typed = set()
+        for (kind, name, labels), metric in items:
+            full = PROMETHEUS_PREFIX + name
+            if kind == 'counter':
+                full += '_total'
+            if full not in typed:
+                typed.add(full)
+                lines.append('# TYPE %s %s' % (full, kind))
+            if kind == 'counter':
+                lines.append('%s%s %s' % (full, format_labels(labels),
+                                          metric.value))
+                continue
+            for bound, count in metric.cumulative():
+                lines.append('%s_bucket%s %d' % (
+                    full, format_labels(labels + (('le', repr(bound)),)),
+                    count))
+            lines.append('%s_bucket%s %d' % (
+                full, format_labels(labels + (('le', '+Inf'),)),
+                metric.count))
+            lines.append('%s_sum%s %s' % (full, format_labels(labels),
+                                          metric.sum))
+            lines.append('%s_count%s %d' % (full, format_labels(labels),
+                                            metric.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Writes :func: prometheus to a file for the node exporter's textfile
+        collector, which needs the file replaced in one go
+        """
+        write_atomically(path, self.prometheus())
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def write_atomically(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(text)
+    if os.name == 'nt' and os.path.exists(path):
+        #rename won't replace a file on windows
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+#the process wide metrics everything records into
+metrics = Metrics()
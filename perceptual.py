@@ -0,0 +1,237 @@
+import os
+import sys
+import threading
+from multiprocessing import Pool
+
+from PIL import Image
+
+from database import Database
+
+#hashes are HASH_SIZE x HASH_SIZE bits
+HASH_SIZE = 8
+#the most bits two hashes can differ by and still be the same picture
+DEFAULT_THRESHOLD = 6
+#what to do with a near duplicate, either drop the new image or keep
+# whichever of the two has more pixels
+SKIP = 'skip'
+KEEP_LARGER = 'keep-larger'
+
+
+def dhash(path, size=HASH_SIZE):
+    """
+    The difference hash of an image file: the image is shrunk to
+    (size + 1) x size greyscale pixels and each bit says whether a pixel is
+    brighter than the one to its right. Recompressing or resizing an image
+    barely changes it.
+
+    :returns int: the hash, size * size bits long
+    """
+    image = Image.open(path)
+    #JPEGs can be decoded at a fraction of their size, which is all we need
+    image.draft('L', (size * 8, size * 8))
+    pixels = list(image.convert('L').resize((size + 1, size),
+                                            Image.ANTIALIAS).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    """
+    The number of bits two hashes differ by
+    """
+    return bin(a ^ b).count('1')
+
+
+def to_hex(value):
+    return '%016x' % value
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree of hashes under the Hamming distance. Finding
+    everything within a small distance of a hash only visits the few
+    branches the triangle inequality can't rule out, instead of comparing
+    against every hash.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        node = [value, [item], {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            if distance == 0:
+                current[1].append(item)
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, radius):
+        """
+        Returns (distance, item) for everything within radius of the value,
+        closest first
+        """
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item) for item in node[1])
+            for d in range(max(1, distance - radius), distance + radius + 1):
+                child = node[2].get(d)
+                if child is not None:
+                    stack.append(child)
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class Entry(object):
+    """
+    What the index knows about an image that is already saved
+    """
+    __slots__ = ('md5', 'filename', 'width', 'height')
+
+    def __init__(self, md5, filename, width, height):
+        self.md5 = md5
+        self.filename = filename
+        self.width = width
+        self.height = height
+
+
+def area(image):
+    return (image.width or 0) * (image.height or 0)
+
+
+class NearDuplicateIndex(object):
+    def __init__(self, database, threshold=DEFAULT_THRESHOLD, policy=SKIP):
+        """
+        Finds images that are the same picture as one already saved even
+        though their bytes differ, e.g. a recompressed or resized repost.
+        The perceptual hash of every saved image is loaded into a
+        `class` BKTree once and new images are added as they are saved.
+
+        :param database: a `class` Database or the prefix for the database
+        filename
+        :param int threshold: the most bits the hashes may differ by for two
+        images to count as the same
+        :param str policy: SKIP to drop near duplicates, KEEP_LARGER to
+        replace the saved image when the new one has more pixels
+        """
+        if not isinstance(database, Database):
+            database = Database(database)
+        if policy not in (SKIP, KEEP_LARGER):
+            raise ValueError('Unknown near duplicate policy %r' % policy)
+        self.database = database
+        self.threshold = threshold
+        self.policy = policy
+        self.tree = BKTree()
+        self.replaced = set()
+        self._lock = threading.Lock()
+        conn = database.engine.connect()
+        for row in conn.execute('SELECT dhash, md5, filename, width, height '
+                                'FROM wallpapers WHERE dhash IS NOT NULL '
+                                'AND replaced_by IS NULL'):
+            self.tree.add(int(row[0], 16), Entry(*row[1:]))
+        conn.close()
+
+    def claim(self, download, path):
+        """
+        Hashes a new image, setting dhash on the download, and decides
+        whether to keep it. Kept images are added to the index straight
+        away so that two copies arriving at once can't both be kept.
+
+        :param download: the `class` Download, with its dimensions set
+        :param str path: where the image is on disk
+        :returns: (keep, match) where match is the saved image it is a near
+        duplicate of, or None. If keep is True and match isn't None the new
+        image replaces the match.
+        """
+        value = dhash(path)
+        download.dhash = to_hex(value)
+        with self._lock:
+            match = None
+            for distance, entry in self.tree.search(value, self.threshold):
+                if entry.md5 not in self.replaced:
+                    match = entry
+                    break
+            if match is not None and (self.policy == SKIP or
+                                      area(download) <= area(match)):
+                return False, match
+            if match is not None:
+                self.replaced.add(match.md5)
+            self.tree.add(value, download)
+            return True, match
+
+
+def _hash_file(path):
+    #runs in the pool's worker processes, so it has to be at module level
+    try:
+        return path, to_hex(dhash(path))
+    except IOError:
+        return path, None
+
+
+def backfill(database, output_dir, processes=None):
+    """
+    Computes the perceptual hash of every image in the output directory that
+    the database doesn't have one for yet, spread over a pool of processes.
+
+    :param database: a `class` Database or the prefix for the database
+    filename
+    :param str output_dir: the location the images were saved to
+    :param int processes: the number of worker processes, None for one per
+    CPU
+    :returns int: how many images were hashed
+    """
+    if not isinstance(database, Database):
+        database = Database(database)
+    conn = database.engine.connect()
+    by_path = {}
+    for md5, filename in conn.execute('SELECT md5, filename FROM wallpapers '
+                                      'WHERE dhash IS NULL AND '
+                                      'filename IS NOT NULL AND '
+                                      'replaced_by IS NULL'):
+        path = os.path.join(output_dir, filename)
+        if os.path.isfile(path):
+            by_path[path] = md5
+    conn.close()
+    if not by_path:
+        return 0
+    pool = Pool(processes)
+    try:
+        rows = [(value, by_path[path]) for path, value in
+                pool.imap_unordered(_hash_file, by_path, chunksize=16)
+                if value is not None]
+    finally:
+        pool.close()
+        pool.join()
+    with database.engine.begin() as conn:
+        conn.execute('UPDATE wallpapers SET dhash = ? WHERE md5 = ?', rows)
+    return len(rows)
+
+
+if __name__ == '__main__':
+    #python -m perceptual <database prefix> <output dir> [processes]
+    print '%d images hashed.' % backfill(
+        sys.argv[1], sys.argv[2],
+        int(sys.argv[3]) if len(sys.argv) > 3 else None)
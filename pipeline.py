@@ -0,0 +1,130 @@
+import threading
+from Queue import Queue
+
+from plugin_interface import PluginInterface, PluginRouter
+from plugins import loaded_plugins
+from reddit_connect import INCREMENTAL
+from metrics import metrics, get_logger, DEPTH_BUCKETS
+
+log = get_logger('pipeline')
+
+#put on the candidate queue once per resolver to tell it to finish up
+STOP = object()
+
+
+class Pipeline(PluginInterface):
+    def __init__(self, reddit, subs, database, output, mode=INCREMENTAL,
+                 max_pages=None, limit=100, resolvers=4, queue_size=200,
+                 max_pending=500, **kwargs):
+        """
+        Runs the whole job as concurrent stages instead of one after the
+        other: the upvotes are paged in on the calling thread, each page's
+        candidates go onto a bounded queue for a pool of resolver threads
+        that run the plugins, and the plugins queue images into the
+        `class` AcquisitionEngine as usual. Images from the first page are
+        downloading while later pages are still being fetched. Each queue is
+        bounded, so a slow stage holds up the ones before it instead of
+        letting work pile up in memory. The stages are threads rather than
+        asyncio coroutines, which Python 2.7 doesn't have.
+
+        Everything else, the dedup, the database writes, the resolution
+        cache and the reporting, is the same as `class` PluginInterface,
+        which takes the rest of the keyword arguments. Call
+        `func` RedditConnect.save_sync_mark after :func: acquire, the same
+        as after `func` RedditConnect.sync_upvotes.
+
+        :param reddit: a logged in `class` RedditConnect
+        :param list subs: the subreddits to get images from
+        :param str database: the prefix for the database filename
+        :param str output: the location to save images to
+        :param str mode: the sync mode, see `func` RedditConnect.sync_upvotes
+        :param int max_pages: stop paging after this many pages, None for no
+        limit
+        :param int limit: posts per page, reddit allows up to 100
+        :param int resolvers: how many threads run the plugins
+        :param int queue_size: the most candidates waiting for a resolver
+        :param int max_pending: the most images queued or downloading before
+        the resolvers wait
+        """
+        PluginInterface.__init__(self, database, [], output, **kwargs)
+        self.reddit = reddit
+        self.subs = subs
+        self.mode = mode
+        self.max_pages = max_pages
+        self.limit = limit
+        self.resolvers = resolvers
+        self.queue_size = queue_size
+        self.acquirer.max_pending = max_pending
+
+    def hand_off_to_plugins(self):
+        """
+        Starts the resolvers, pages in the upvotes feeding them candidates,
+        and waits for the resolvers and then the downloads to finish
+        """
+        self.prepare()
+        router = PluginRouter(loaded_plugins)
+        queue = Queue(self.queue_size)
+        threads = []
+        for i in range(self.resolvers):
+            t = threading.Thread(target=self.resolve, args=(queue, router),
+                                 name='resolver-%d' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            self.page(queue)
+        finally:
+            for t in threads:
+                queue.put(STOP)
+            for t in threads:
+                t.join()
+        #wait for the downloads that are still queued or in flight
+        self.acquirer.join()
+        self.finish_plugins(self.instances)
+
+    def page(self, queue):
+        """
+        The first stage. Queues the posts :func: resume is retrying, then
+        pages in the upvotes and queues the ones in the wanted subreddits,
+        blocking while the resolvers are behind.
+        """
+        retries = list(self.candidates)
+        self.dedup.prefetch(c.url for c in retries)
+        for candidate in retries:
+            queue.put(candidate)
+        log.info('Syncing upvotes (%s)...', self.mode)
+        found = 0
+        for page in self.reddit._sync_pages(self.database, self.mode,
+                                            self.max_pages, self.limit):
+            candidates = list(self.reddit.iter_candidates(self.subs, page))
+            self.dedup.prefetch(c.url for c in candidates)
+            found += len(candidates)
+            log.info('Candidates found so far: %d', found)
+            for candidate in candidates:
+                metrics.observe('candidate_queue_depth', queue.qsize(),
+                                DEPTH_BUCKETS)
+                queue.put(candidate)
+        log.info('Upvotes retrieved!')
+
+    def resolve(self, queue, router):
+        """
+        The second stage. Runs candidates through the plugins until told to
+        stop. Plugin instances keep per candidate state, so every resolver
+        thread has its own.
+        """
+        by_plugin = {}
+
+        def get_instance(plugin):
+            if plugin not in by_plugin:
+                by_plugin[plugin] = self.make_plugin(plugin)
+                self.add_instance(by_plugin[plugin])
+            return by_plugin[plugin]
+
+        while True:
+            candidate = queue.get()
+            if candidate is STOP:
+                return
+            try:
+                self.dispatch(candidate, router, get_instance)
+            except Exception:
+                log.exception('Error dispatching %s', candidate.url)
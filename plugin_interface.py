@@ -1,12 +1,25 @@
 import os
 import re
+import threading
+from itertools import islice, chain
+from collections import OrderedDict
 
-from plugins import loaded_plugins
+from acquisition import AcquisitionEngine
+from data_types import Download, convert_candidates
+from http_session import HttpSession
+from journal import Journal, journal_path, DISCOVERED
+from metrics import metrics, get_logger
+from plugins import loaded_plugins, LazyPlugin
+
+DOMAIN_PATTERN = re.compile(r'^.*://(?:[wW]{3}\.)?([^:/]*).*$')
+#candidates are converted and looked up in the database this many at a time
+CANDIDATE_BATCH = 500
+
+log = get_logger('plugin_interface')
 
 
 def extract_domain(url):
-    dom_pat = re.compile(r'^.*://(?:[wW]{3}\.)?([^:/]*).*$')
-    domain = re.findall(dom_pat, url)[0]
+    domain = re.findall(DOMAIN_PATTERN, url)[0]
     #truncate username subdomains like for e.g. deviant art and useless ones
     # like www
     if domain.count('.') > 1:
@@ -20,8 +33,83 @@ def extract_domain(url):
     return domain
 
 
+class PluginRouter(object):
+    def __init__(self, plugins):
+        """
+        Routes each candidate straight to the plugin that owns it using the
+        domains and url_pattern that the plugins declare. The plugins for
+        each domain are compiled into one combined regex so a candidate
+        costs a single dict lookup and a single match no matter how many
+        plugins there are. Plugins with a url_pattern but no domains are
+        tried on every host after the domain specific ones, and plugins that
+        declare neither are returned as fallbacks.
+
+        :param list plugins: `class` BasePlugin subclasses, in priority order
+        """
+        self.plugins = {}
+        self.fallbacks = []
+        by_domain = {}
+        any_domain = []
+        for i, plugin in enumerate(plugins):
+            name = 'p%d' % i
+            self.plugins[name] = plugin
+            if plugin.url_pattern is None and plugin.domains is None:
+                self.fallbacks.append(plugin)
+            elif plugin.domains is None:
+                any_domain.append((name, plugin.url_pattern))
+            else:
+                for domain in plugin.domains:
+                    by_domain.setdefault(domain.lower(), []).append(
+                        (name, plugin.url_pattern or ''))
+        self.by_domain = dict((d, self.combine(p))
+                              for d, p in by_domain.items())
+        self.any_domain = self.combine(any_domain) if any_domain else None
+
+    @staticmethod
+    def combine(patterns):
+        return re.compile('|'.join('(?P<%s>%s)' % (name, pattern)
+                                   for name, pattern in patterns),
+                          re.IGNORECASE)
+
+    def route(self, url):
+        """
+        Returns the plugin class that owns the url or None if no plugin
+        declared that they can handle it.
+
+        :param str url: the post url
+        """
+        routes = self.routes(url)
+        return routes[0] if routes else None
+
+    def routes(self, url):
+        """
+        Returns the plugin classes that declared they can handle the url,
+        the domain specific one first and then the one for any host, so a
+        candidate the first can't resolve can be offered to the second.
+
+        :param str url: the post url
+        """
+        try:
+            domain = extract_domain(url).lower()
+        except IndexError:
+            domain = None
+        plugins = []
+        for pattern in (self.by_domain.get(domain), self.any_domain):
+            if pattern is None:
+                continue
+            match = pattern.match(url)
+            if match is not None:
+                plugins.append(self.plugins[match.lastgroup])
+        return plugins
+
+
 class PluginInterface():
-    def __init__(self, database, candidates, output):
+    def __init__(self, database, candidates, output, workers=8, per_host=2,
+                 session=None, max_image_size=None, flush_rows=100,
+                 flush_interval=5.0, preflight=False, min_width=None,
+                 min_height=None, near_duplicates=None,
+                 near_threshold=None, dedup=None, copies=None,
+                 journal=None, metrics_file=None, prometheus_file=None):
         """
         The PluginInterface takes care of reading the plugins, determining
         which ones are valid, and iterating through them. It is a wrapper
@@ -29,43 +117,264 @@ class PluginInterface():
         the BasePlugin class.
 
         :param str database: the prefix for the database filename.
-        :param list candidates: a list of candidate json objects from the
-        `class` RedditConnect class
+        :param candidates: a list of candidate json objects from the
+        `class` RedditConnect class, or any iterable of them or of
+        `class` Download objects, e.g. `func` RedditConnect.iter_candidates.
+        They are consumed a batch at a time and never all held at once.
         :param str output: the location on disk to store your images (note
         that this can be changed and the database data will handle all
         duplicate filtering
+        :param int workers: how many images to download at once. 0 downloads
+        them one at a time as the plugins find them
+        :param int per_host: how many images to download at once from any
+        single host
+        :param session: the `class` HttpSession to make every request
+        through. One sized for the number of workers is made if this is not
+        passed in. Every download waits on the session's per host
+        `class` RateLimiter.
+        :param int max_image_size: the largest image in bytes to download,
+        anything bigger is abandoned partway through. None means no limit.
+        :param int flush_rows: database rows are written in batches of this
+        many
+        :param float flush_interval: the longest in seconds a database row
+        waits to be written
+        :param bool preflight: check every image with a HEAD request before
+        downloading it, see `class` BasePlugin. Off by default.
+        :param int min_width: skip images narrower than this many pixels,
+        e.g. 1920 to only keep full HD wallpapers. None means no limit.
+        :param int min_height: skip images shorter than this many pixels
+        :param str near_duplicates: also dedup on a perceptual hash so that
+        recompressed or resized copies of a saved image are caught. 'skip'
+        drops them and 'keep-larger' keeps whichever copy has more pixels.
+        None (the default) only dedups on the md5.
+        :param int near_threshold: how many of the 64 bits of the perceptual
+        hashes may differ for two images to count as the same, None for
+        the default of `module` perceptual
+        :param dedup: a `class` DedupIndex shared with other runs in the same
+        process. One is built from the database if this is not passed in.
+        :param copies: a `class` CopyIndex shared with runs saving to other
+        output directories. Images one of them already saved are hard linked
+        into this output directory instead of being downloaded again.
+        :param str journal: the file to journal the run to, so that if it
+        dies partway the next run picks up where it stopped. None (the
+        default) uses <database>_journal.log next to the database, False
+        keeps no journal.
+        :param str metrics_file: where to write the JSON summary of the
+        `module` metrics at the end of the run. None (the default) uses
+        <database>_metrics.json next to the database, False writes none.
+        :param str prometheus_file: also write the metrics here for the
+        Prometheus node exporter's textfile collector, e.g.
+        /var/lib/node_exporter/reddit_scraper.prom
         """
         self.database = database
         self.candidates = candidates
         self.output = output
+        self.max_image_size = max_image_size
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.preflight = preflight
+        self.min_width = min_width
+        self.min_height = min_height
+        self.near_duplicates = near_duplicates
+        self.near_threshold = near_threshold
+        self.near_index = None
+        self.writer = None
+        self.resolution_cache = None
         #set up some class variables
         self.handled = []
         self.unhandled = []
+        self.dedup = dedup
+        self.copies = copies
+        #database, resolution_cache and perceptual import sqlalchemy and
+        # PIL, so they are only imported once a run needs them, which keeps
+        # importing this module cheap
+        from database import database_file
+        #where the database file is, or will be
+        folder = os.path.dirname(dedup.database.db if dedup is not None
+                                 else database_file(database))
+        if journal is None:
+            journal = journal_path(database, folder)
+        self.journal = Journal(journal) if journal else None
+        if metrics_file is None:
+            metrics_file = os.path.join(folder, '%s_metrics.json' %
+                                        os.path.basename(database))
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
         self.posts_already_finished = None
         self.image_urls_already_fetched = None
-        self.candidates_backup = set()
+        self.instances = []
+        self.unclaimed = []
+        self._instances_lock = threading.Lock()
+        self.acquirer = AcquisitionEngine(workers=workers, per_host=per_host)
+        if session is None:
+            session = HttpSession(pool_maxsize=max(10, workers))
+        self.session = session
+
+    def prepare(self):
+        """
+        Builds the state shared by every plugin for the run: the
+        `class` DedupIndex, the `class` WriteBuffer, the resolution cache
+        and the near duplicate index
+        """
+        from database import DedupIndex, WriteBuffer
+        from resolution_cache import ResolutionCache
+        from perceptual import NearDuplicateIndex, DEFAULT_THRESHOLD
+        if self.dedup is None:
+            self.dedup = DedupIndex(self.database)
+        if self.writer is None:
+            self.writer = WriteBuffer(self.dedup.database,
+                                      max_rows=self.flush_rows,
+                                      max_delay=self.flush_interval)
+        if self.resolution_cache is None:
+            self.resolution_cache = ResolutionCache(self.dedup.database,
+                                                    self.writer)
+        if self.near_duplicates is not None and self.near_index is None:
+            threshold = self.near_threshold
+            if threshold is None:
+                threshold = DEFAULT_THRESHOLD
+            self.near_index = NearDuplicateIndex(self.dedup.database,
+                                                 threshold,
+                                                 self.near_duplicates)
+        self.posts_already_finished = self.dedup.post_urls
+        self.image_urls_already_fetched = self.dedup.image_urls
+
+    def make_plugin(self, plugin):
+        """
+        Creates an instance of a plugin class wired up to the shared state.
+        Plugins are imported here the first time they are needed.
+
+        :param plugin: the plugin class or its `class` LazyPlugin
+        :returns: the instance, or None if the plugin failed to import
+        """
+        log.debug('Loading plugin: %s.', plugin.__name__)
+        if isinstance(plugin, LazyPlugin):
+            plugin = plugin.load()
+            if plugin is None:
+                return None
+        return plugin(self.database, [], self.output,
+                      dedup=self.dedup,
+                      acquirer=self.acquirer,
+                      session=self.session,
+                      max_image_size=self.max_image_size,
+                      writer=self.writer,
+                      resolution_cache=self.resolution_cache,
+                      preflight=self.preflight,
+                      min_width=self.min_width,
+                      min_height=self.min_height,
+                      near_duplicates=self.near_index,
+                      copies=self.copies,
+                      journal=self.journal)
+
+    def dispatch(self, candidate, router, get_instance):
+        """
+        Hands a candidate to the plugin that owns it. If none does, or it
+        finds no images, the candidate is offered to the plugin for any host
+        and then to the fallback plugins in turn. Candidates that are
+        already in the database are skipped.
+
+        :param router: the `class` PluginRouter
+        :param get_instance: returns the instance to use for a plugin class,
+        None if the plugin can't be used
+        """
+        if self.dedup.already_acquired(candidate.url):
+            if self.copies is None or self.link_existing(candidate):
+                metrics.inc('candidates', result='already_acquired')
+                return
+        metrics.inc('candidates', result='dispatched')
+        if self.journal is not None:
+            self.journal.post(candidate.url, DISCOVERED,
+                              subreddit=candidate.subreddit,
+                              title=candidate.title)
+        for plugin in router.routes(candidate.url) + router.fallbacks:
+            instance = get_instance(plugin)
+            if instance is not None and \
+                    instance.process_candidate(candidate):
+                return
+        metrics.inc('candidates', result='unclaimed')
+        self.unclaimed.append(candidate)
+
+    def link_existing(self, candidate):
+        """
+        Hard links the images of an already acquired candidate into the
+        output directory, from wherever they were saved before. Posts are
+        looked up in the resolution cache rather than scraped again.
+
+        :returns bool: False if an image couldn't be linked and the
+        candidate has to go through the plugins again
+        """
+        if candidate.url in self.image_urls_already_fetched:
+            urls = [candidate.url]
+        else:
+            images = self.resolution_cache.get(candidate.url)
+            if images is None:
+                #nothing to go on, leave it as done like before
+                return True
+            urls = [image['url'] for image in images]
+        linked = [self.copies.link_url(url, self.output) for url in urls]
+        return None not in linked
+
+    def add_instance(self, instance):
+        if instance is None:
+            #a plugin that failed to import
+            return
+        with self._instances_lock:
+            self.instances.append(instance)
 
     def hand_off_to_plugins(self):
-        """Calls each plugin module and hand the CandidateList off to it.
-        """
-        for plugin in loaded_plugins:
-            print 'Loading plugin: %s.\n' % plugin.__name__
-            plug_inst = plugin(self.database, self.candidates, self.output)
-            self.handled.extend(plug_inst.handled)
-            print '%s handled the following urls:\n' % plugin.__name__
-            if len(plug_inst.handled) > 0:
-                for h in plug_inst.handled:
-                    print '\t', h.url
-                print '\n'
-            else:
-                print '\tNone\n'
-            #trim down the candidates from what got parsed
-            self.candidates = plug_inst.revised
-            #the last instance of these should be fine
-            self.posts_already_finished = plug_inst.posts_already_finished
-            self.image_urls_already_fetched = \
-                plug_inst.image_urls_already_fetched
-            self.candidates_backup.update(plug_inst.candidates_backup)
+        """Takes one pass over the candidates and hands each one to the
+        plugin that owns it. Candidates that no plugin claims are offered to
+        the fallback plugins in turn. The `class` DedupIndex is built once
+        here and shared by every plugin. Images are queued into the
+        `class` AcquisitionEngine as the plugins find them and this waits for
+        all of them to finish before reporting.
+        """
+        self.prepare()
+        router = PluginRouter(loaded_plugins)
+        by_plugin = {}
+
+        def get_instance(plugin):
+            if plugin not in by_plugin:
+                by_plugin[plugin] = self.make_plugin(plugin)
+                self.add_instance(by_plugin[plugin])
+            return by_plugin[plugin]
+
+        candidates = iter(self.candidates)
+        while True:
+            batch = convert_candidates(islice(candidates, CANDIDATE_BATCH))
+            if not len(batch):
+                break
+            self.dedup.prefetch(c.url for c in batch)
+            for candidate in batch:
+                self.dispatch(candidate, router, get_instance)
+
+        #wait for the downloads that are still queued or in flight
+        self.acquirer.join()
+        self.finish_plugins(self.instances)
+
+    def finish_plugins(self, instances):
+        """
+        Records the posts the plugins finished and reports what they handled
+        """
+        for plug_inst in instances:
+            plug_inst.add_to_previous_aquisitions()
+        self.report_plugins(instances)
+
+    def report_plugins(self, instances):
+        """
+        Logs what each plugin handled, and collects it into self.handled
+        """
+        by_name = OrderedDict()
+        for plug_inst in instances:
+            by_name.setdefault(plug_inst.__class__.__name__, []).extend(
+                plug_inst.handled)
+        for name, handled in by_name.items():
+            self.handled.extend(handled)
+            log.info('%s handled %d urls', name, len(handled))
+            for h in handled:
+                log.debug('\t%s', h.url)
+        stats = self.resolution_cache.stats()
+        log.info('Resolution cache: %d hits, %d misses (%.0f%% hit rate).',
+                 stats['hits'], stats['misses'], stats['hit_rate'] * 100)
 
     def check_unhandled_links(self):
         """
@@ -73,15 +382,49 @@ class PluginInterface():
         links which we output at the end to help target plugin
         development/maintenance
         """
-        for original in self.candidates_backup:
-            if original in self.handled or original in \
-                    self.image_urls_already_fetched or \
-                    original in self.posts_already_finished:
+        handled = set(self.handled)
+        seen = set()
+        failed = list(self.unclaimed)
+        for plug_inst in self.instances:
+            failed.extend(plug_inst.unhandled)
+        for original in failed:
+            if original.url in seen or original in handled or \
+                    original.url in self.image_urls_already_fetched or \
+                    original.url in self.posts_already_finished:
                 continue
             else:
+                seen.add(original.url)
                 self.unhandled.append((extract_domain(original.url),
                                        original.url))
 
+    def resume(self):
+        """
+        Replays the journal left by an earlier run. Whatever that run
+        finished but never wrote to the database, because it died first, is
+        written now, so none of it is fetched or resolved again. The posts
+        that failed are tried again ahead of the candidates, see
+        `func` JournalState.retries.
+        """
+        from database import Database
+        if self.journal is None:
+            return
+        state = self.journal.replay()
+        if not state.lines:
+            return
+        database = self.dedup.database if self.dedup is not None else \
+            Database(self.database)
+        restored = state.restore(database)
+        if restored:
+            log.info('Resumed from the journal: %d images restored that the '
+                     'last run saved but never recorded.', restored)
+        retries = [Download(e.get('title'), e.get('subreddit'), e['url'])
+                   for e in state.retries()]
+        if retries:
+            log.info('Retrying %d posts that failed on an earlier run.',
+                     len(retries))
+            self.candidates = chain(retries, self.candidates)
+        self.journal.compact()
+
     def acquire(self):
         """
         Handles the calls to the database and the requests out to the world
@@ -97,24 +440,55 @@ class PluginInterface():
         :param str output: The location to save the downloaded images to as a
          string
         """
+        from database import Database, DedupIndex
+        self.resume()
         if not os.path.exists(self.output):
             os.makedirs(self.output)
+        elif self.dedup is None:
+            #pick up anything a killed run saved but never recorded
+            database = Database(self.database)
+            recovered = database.reconcile(self.output)
+            if recovered:
+                log.info('Recovered %d images from %s that were missing from '
+                         'the database.', recovered, self.output)
+            self.dedup = DedupIndex(database)
 
         #parse links through plugins
-        print '\nProcessing: parse links through plugins...'
-        self.hand_off_to_plugins()
+        log.info('Processing: parse links through plugins...')
+        try:
+            self.hand_off_to_plugins()
+        finally:
+            self.acquirer.shutdown()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            if self.resolution_cache is not None:
+                self.resolution_cache.evict()
+                self.resolution_cache = None
+            if self.journal is not None:
+                #everything that finished is in the database now
+                self.journal.compact()
 
-        print 'The following posts had links that were unhandled:'
         self.check_unhandled_links()
-        if len(self.unhandled) > 0:
-            #iterating through these sorted puts them in alpha order by domain
-            #so you should be able to see which domains you want or need to
-            # target
-            for uh in sorted(self.unhandled):
-                print uh[0], '\t', uh[1]
-            print '\n'
-        else:
-            print 'None\n'
+        log.info('%d posts had links that were unhandled.',
+                 len(self.unhandled))
+        #iterating through these sorted puts them in alpha order by domain
+        #so you should be able to see which domains you want or need to
+        # target
+        for uh in sorted(self.unhandled):
+            log.info('\t%s\t%s', uh[0], uh[1])
 
-        print '\nComplete. %d new images were acquired this run.' \
-              % len(self.handled)
\ No newline at end of file
+        log.info('Complete. %d new images were acquired this run.',
+                 len(self.handled))
+        self.write_metrics()
+
+    def write_metrics(self):
+        """
+        Writes the JSON summary of the metrics, and the Prometheus textfile
+        if there is one. The metrics are process wide, so when several runs
+        share a process each summary covers all of them so far.
+        """
+        if self.metrics_file:
+            metrics.write_json(self.metrics_file)
+        if self.prometheus_file:
+            metrics.write_prometheus(self.prometheus_file)
\ No newline at end of file
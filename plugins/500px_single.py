@@ -1,18 +1,22 @@
-from bs4 import BeautifulSoup
 from plugins.base_plugin import *
 
 
 class Get500pxSingle(BasePlugin):
+    domains = ('500px.com',)
+    url_pattern = r'http://500px\.com/photo/'
+    PHOTO_LINK = Selector(None, 'descendant::a[1]/@href', {'id': 'thephoto'},
+                          final=True)
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        if self.candidate.url.lower().startswith(
-                'http://500px.com/photo/'):
+        if self.handles(self.candidate.url):
             img_url = self.get_500px_img(self.candidate.url)
-            self.current = Download(self.candidate.title,
-                                    self.candidate.subreddit,
-                                    img_url)
+            if img_url is not None:
+                self.current = Download(self.candidate.title,
+                                        self.candidate.subreddit,
+                                        img_url)
 
     def get_500px_img(self, url):
         """Helper for the 500px execute function
@@ -21,11 +25,9 @@ class Get500pxSingle(BasePlugin):
         :rtype str: a url that is a direct link to an image
         """
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error contacting imgur (%s):' % url
-            print e
-            return []
-        root = BeautifulSoup(resp.text)
-        a = root.find(id='thephoto').find('a')
-        return a.attrs.get('href')
\ No newline at end of file
+            resp = self.session.get(url, stream=True)
+        except requests.RequestException, e:
+            log.warning('Error contacting imgur (%s): %s', url, e)
+            return
+        for _, href in select(resp, self.PHOTO_LINK):
+            return href
\ No newline at end of file
@@ -1,38 +1,287 @@
+#Finds the plugins in the plugins folder without importing them. Every module
+# is read with the ast module for the BasePlugin subclasses it defines and the
+# domains and url_pattern they declare, which is all that routing needs, and
+# that is cached in a manifest keyed on each file's mtime and size so
+# unchanged files aren't even parsed again. A plugin module is only imported
+# the first time a candidate is routed to one of its plugins.
 import os
+import imp
 import sys
-from base_plugin import *
+import ast
+import json
+import time
+import warnings
+import threading
 
-#Load an arbitrary number of arbitrarily named plugins from the plugins folder
+from metrics import metrics, get_logger, write_atomically
+
+log = get_logger('plugins')
+
+PLUGINS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+#plugin modules are imported long after this one, by when the working
+# directory may have changed. A relative path to the package, which comes
+# from a relative sys.path entry such as the '' that python -m adds, would
+# no longer find anything in it then.
+__path__[:] = [os.path.abspath(path) for path in __path__]
+#the same goes for base_plugin and the modules of the scraper it imports, so
+# the absolute form of every relative sys.path entry is added as a fallback
+for path in list(sys.path):
+    if not os.path.isabs(path) and os.path.abspath(path) not in sys.path:
+        sys.path.append(os.path.abspath(path))
+MANIFEST_FILE = os.path.join(PLUGINS_FOLDER, 'plugin_manifest.json')
+#bumped whenever what the manifest holds changes
+MANIFEST_VERSION = 2
+#modules in the plugins folder that aren't plugins
+NOT_PLUGINS = ('__init__', 'base_plugin')
+#the class attributes the router needs, see `class` PluginRouter
+ROUTING_ATTRIBUTES = ('domains', 'url_pattern')
+#plugins can be loaded from several resolver threads at once
+IMPORT_LOCK = threading.Lock()
+
+
+class LazyPlugin(object):
+    def __init__(self, name, module, package, folder, domains=None,
+                 url_pattern=None):
+        """
+        Stands in for a plugin class until it is needed. It has the name,
+        domains and url_pattern of the class so it can be routed to, and
+        imports the module the first time anything else is asked of it.
+        Calling it makes an instance of the plugin.
+
+        :param str name: the class name
+        :param str module: the module it is in, e.g. 'tumblr'
+        :param str package: the package the module is in
+        :param str folder: the absolute path of the package, so the module
+        is found whatever the working directory is by then
+        """
+        self.__name__ = name
+        self.module = module
+        self.package = package
+        self.folder = folder
+        self.domains = tuple(domains) if domains is not None else None
+        self.url_pattern = url_pattern
+        self.import_seconds = None
+        self._cls = None
+        self._failed = False
+
+    def load(self):
+        """
+        Imports the plugin class, only once
+
+        :returns: the class, or None if its module failed to import
+        """
+        if self._cls is not None or self._failed:
+            return self._cls
+        with IMPORT_LOCK:
+            if self._cls is None and not self._failed:
+                start = time.time()
+                try:
+                    #not until now, as it imports sqlalchemy, lxml and PIL
+                    from plugins import base_plugin
+                    self._cls = getattr(self.import_module(), self.__name__)
+                except (ImportError, AttributeError), e:
+                    log.error('%s failed to load: %s', self.module, e)
+                    #logging may not be set up, and its candidates quietly
+                    # going unclaimed would look like nothing was posted
+                    warnings.warn('Plugin %s failed to load: %s' %
+                                  (self.module, e), RuntimeWarning)
+                    failed_plugins.append(self.module)
+                    self._failed = True
+                    return None
+                self.import_seconds = time.time() - start
+                metrics.observe('plugin_import_seconds',
+                                self.import_seconds, plugin=self.__name__)
+                log.info('Imported plugin %s in %.1fms', self.__name__,
+                         self.import_seconds * 1000)
+        return self._cls
+
+    def import_module(self):
+        name = '%s.%s' % (self.package, self.module)
+        if name in sys.modules:
+            return sys.modules[name]
+        f, path, description = imp.find_module(self.module, [self.folder])
+        try:
+            module = imp.load_module(name, f, path, description)
+        finally:
+            if f is not None:
+                f.close()
+        #as import does, so package.module finds it too
+        if self.package in sys.modules:
+            setattr(sys.modules[self.package], self.module, module)
+        return module
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        cls = self.load()
+        if cls is None:
+            raise AttributeError(name)
+        return getattr(cls, name)
+
+    def __repr__(self):
+        return '<plugin %s.%s>' % (self.module, self.__name__)
 
-plugin_list = []
-#what the fuck is good and loaded and why are they different??
-good_plugins = []
-loaded_plugins = []
-failed_plugins = []
 
-plugins_folder = os.path.abspath(os.path.dirname(__file__))
-for r, d, f in os.walk(plugins_folder):
-    for p in f:
-        if p.endswith('.py'):
-            plugin_list.append(p.rstrip('.py'))
-
-sys.path.insert(0, plugins_folder)
-
-for plugin in plugin_list:
-    try:
-        loaded = __import__(plugin)
-        for attr in dir(loaded):
-            try:
-                cls = getattr(loaded, attr)
-                if issubclass(cls, BasePlugin) and cls.__name__ != 'BasePlugin':
-                    good_plugins.append(cls.__name__)
-                    loaded_plugins.append(cls)
-            except TypeError:
-                pass
-    except ImportError, e:
-        print '%s failed to load: %s\n' % (cls.__name__, e)
-        failed_plugins.append(cls)
-
-sys.path.remove(plugins_folder)
-
-print 'Loaded the following plugins successfully: %s\n' % ', '.join(good_plugins)
\ No newline at end of file
+class PluginRegistry(object):
+    def __init__(self, folder=PLUGINS_FOLDER, package='plugins',
+                 manifest=MANIFEST_FILE):
+        """
+        Discovers the plugins in a folder, see the top of this module.
+
+        :param str folder: the plugins folder
+        :param str package: the package the folder is imported as
+        :param str manifest: where the manifest is kept. It is rebuilt if it
+        can't be read, and not kept at all if it can't be written.
+        """
+        self.folder = os.path.abspath(folder)
+        self.package = package
+        self.manifest = manifest
+        self.scanned = []
+
+    def discover(self):
+        """
+        :returns list: a `class` LazyPlugin for every plugin, ordered by
+        module and class name
+        """
+        cached = self.read_manifest()
+        modules = {}
+        for filename in sorted(os.listdir(self.folder)):
+            module, ext = os.path.splitext(filename)
+            if ext != '.py' or module in NOT_PLUGINS:
+                continue
+            stat = os.stat(os.path.join(self.folder, filename))
+            entry = cached.get(module)
+            if entry is None or entry['mtime'] != stat.st_mtime or \
+                    entry['size'] != stat.st_size:
+                self.scanned.append(module)
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+                try:
+                    entry['classes'] = self.scan(filename)
+                except SyntaxError, e:
+                    log.error('%s failed to load: %s', module, e)
+                    warnings.warn('Plugin %s failed to load: %s' %
+                                  (module, e), RuntimeWarning)
+                    failed_plugins.append(module)
+                    continue
+            modules[module] = entry
+        if self.scanned or set(modules) != set(cached):
+            self.write_manifest(modules)
+        found = self.resolve(modules)
+        plugins = []
+        for module in sorted(modules):
+            for cls in found[module]:
+                plugin = LazyPlugin(cls['name'], module, self.package,
+                                    self.folder, cls['domains'],
+                                    cls['url_pattern'])
+                if cls['dynamic']:
+                    #can't be routed to without importing it
+                    if plugin.load() is None:
+                        continue
+                    plugin.domains = plugin.load().domains
+                    plugin.url_pattern = plugin.load().url_pattern
+                plugins.append(plugin)
+        return plugins
+
+    def scan(self, filename):
+        """
+        Reads the classes a module defines out of its source, with the names
+        of their bases and the routing attributes they set. Attributes that
+        aren't literals can't be read this way, so classes that have one are
+        marked dynamic.
+
+        :returns list: dicts with the name, bases, attributes and whether it
+        is dynamic for every class
+        """
+        with open(os.path.join(self.folder, filename), 'rb') as f:
+            tree = ast.parse(f.read(), filename)
+        classes = []
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            cls = {'name': node.name, 'bases': [], 'attributes': {},
+                   'dynamic': False}
+            for base in node.bases:
+                #BasePlugin and plugins.base_plugin.BasePlugin alike
+                if isinstance(base, ast.Name):
+                    cls['bases'].append(base.id)
+                elif isinstance(base, ast.Attribute):
+                    cls['bases'].append(base.attr)
+            for statement in node.body:
+                if not isinstance(statement, ast.Assign):
+                    continue
+                for target in statement.targets:
+                    if isinstance(target, ast.Name) and \
+                            target.id in ROUTING_ATTRIBUTES:
+                        try:
+                            cls['attributes'][target.id] = \
+                                ast.literal_eval(statement.value)
+                        except ValueError:
+                            cls['dynamic'] = True
+            classes.append(cls)
+        return classes
+
+    def resolve(self, modules):
+        """
+        Works out which of the scanned classes are plugins. A class is one if
+        it subclasses BasePlugin, or a plugin from the same module or any
+        other, and it inherits the routing attributes of that base. Bases
+        are matched on their name, the one in the same module first.
+
+        :param dict modules: the manifest entry of every module
+        :returns dict: the name, domains, url_pattern and whether it is
+        dynamic for every plugin, as a list for each module in source order
+        """
+        found = {}
+        by_name = {'BasePlugin': {'domains': None, 'url_pattern': None,
+                                  'dynamic': False}}
+        changed = True
+        while changed:
+            #until a pass finds no more, as a base can be in a later module
+            changed = False
+            for module in sorted(modules):
+                for cls in modules[module]['classes']:
+                    if (module, cls['name']) in found:
+                        continue
+                    bases = [found.get((module, name), by_name.get(name))
+                             for name in cls['bases']]
+                    bases = [base for base in bases if base is not None]
+                    if not bases:
+                        continue
+                    plugin = dict(bases[0], name=cls['name'])
+                    plugin.update(cls['attributes'])
+                    plugin['dynamic'] = bases[0]['dynamic'] or cls['dynamic']
+                    found[(module, cls['name'])] = plugin
+                    by_name.setdefault(cls['name'], plugin)
+                    changed = True
+        return dict((module, [found[(module, cls['name'])]
+                              for cls in modules[module]['classes']
+                              if (module, cls['name']) in found])
+                    for module in modules)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest, 'rb') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['modules']
+
+    def write_manifest(self, modules):
+        try:
+            write_atomically(self.manifest, json.dumps(
+                {'version': MANIFEST_VERSION, 'modules': modules},
+                indent=1, sort_keys=True))
+        except (IOError, OSError), e:
+            log.debug('Could not write the plugin manifest %s: %s',
+                      self.manifest, e)
+
+
+#the modules that failed to load, some only show up once they are imported
+failed_plugins = []
+#every plugin found, in priority order
+loaded_plugins = PluginRegistry().discover()
+good_plugins = [p.__name__ for p in loaded_plugins]
+log.info('Found the following plugins: %s', ', '.join(good_plugins))
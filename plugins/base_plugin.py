@@ -1,22 +1,330 @@
 import os
+import re
+import json
+import time
 import hashlib
-import traceback
+import tempfile
+import threading
+from Queue import Queue
+from collections import deque
 
-from PIL import Image
 import requests
+from lxml import etree
 from sqlalchemy import *
 import sqlalchemy.sql as sql
-from data_types import CandidatesList, DownloadList, Download
+from data_types import CandidatesList, DownloadList, Download, \
+    convert_candidates
+from database import DedupIndex, WriteBuffer, TEMP_PREFIX, TEMP_SUFFIX, \
+    SAVE_LOCK, free_path
+from http_session import HttpSession, default_session
+from resolution_cache import ResolutionCache
+from image_info import parse_header, check_complete, TAIL_SIZE
+from journal import RESOLVED, DOWNLOADING, SAVED, FAILED
+from metrics import metrics, get_logger
 
 IMAGE_HEADERS = ['image/bmp',
                  'image/png',
                  'image/jpg',
                  'image/jpeg',
-                 'image/gif']
+                 'image/gif',
+                 'image/webp']
+
+HOST_PATTERN = re.compile(r'^[^:]*://([^:/?#]*)')
+#plugins log through this too, it comes with the import *
+log = get_logger('plugins')
+#how much of an image to read into memory at once while downloading
+CHUNK_SIZE = 64 * 1024
+#how far into an image to look for its dimensions before giving up on it,
+# JPEGs with big EXIF blocks keep them a long way in
+HEADER_LIMIT = 512 * 1024
+#what the pre-flight HEAD request of an image can tell us
+PREFLIGHT_OK = 'ok'
+NOT_MODIFIED = 'not modified'
+REJECTED = 'rejected'
+#HEAD responses that only mean the host doesn't answer HEAD requests properly,
+# the GET still gets a go
+HEAD_UNSUPPORTED = (403, 405, 501)
+#how much of a page to read and parse at once, see :func: select
+PAGE_CHUNK_SIZE = 16 * 1024
+CHARSET_PATTERN = re.compile(r'charset=["\']?([^"\';\s]+)', re.IGNORECASE)
+#the strings and brackets of a JavaScript literal, for finding where it ends
+JS_BRACKETS = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[\[\]{}]',
+                         re.DOTALL)
+#the bits of a JavaScript literal that aren't JSON: single quoted strings,
+# unquoted keys, trailing commas and undefined. Double quoted strings are
+# matched first so nothing inside them is touched.
+JS_NOT_JSON = re.compile(r'("(?:[^"\\]|\\.)*")|\'((?:[^\'\\]|\\.)*)\'|'
+                         r'([{,]\s*)([A-Za-z_$][\w$]*)(\s*:)|'
+                         r',(\s*[}\]])|\bundefined\b', re.DOTALL)
+#what has to change in a single quoted string to double quote it
+SINGLE_QUOTED_ESCAPES = re.compile(r'\\(.)|"', re.DOTALL)
+JSON_DECODER = json.JSONDecoder()
+
+
+def host_of(url):
+    """
+    The lowercased host of a url, '' if it doesn't have one
+    """
+    match = HOST_PATTERN.match(url)
+    return match.group(1).lower() if match else ''
+
+
+class Selector(object):
+    def __init__(self, tag, path=None, attrs=None, final=False):
+        """
+        Something to pick out of a page with :func: select. The XPath is
+        compiled once, so plugins keep their selectors as class attributes.
+
+        :param str tag: the elements it looks at, e.g. 'meta'. None looks at
+        every element, which is slower.
+        :param str path: an XPath expression evaluated on each matching
+        element once it is complete, e.g. '@content' or 'string()'. What it
+        finds is what select yields, the element itself if there is no path.
+        :param dict attrs: attribute values the element must have, a tuple
+        meaning any of them. 'class' matches any one of the element's
+        classes, like BeautifulSoup does.
+        :param bool final: stop reading the page after the first element
+        this matches, whether the path found anything in it or not, e.g.
+        for something in the <head>
+        """
+        self.tag = tag
+        self.path = etree.XPath(path) if path is not None else None
+        self.attrs = [(k, v if isinstance(v, tuple) else (v,))
+                      for k, v in (attrs or {}).items()]
+        self.final = final
+
+    def matches(self, element):
+        if self.tag is not None and element.tag != self.tag:
+            return False
+        for name, wanted in self.attrs:
+            value = element.get(name)
+            if value is None:
+                return False
+            if name == 'class':
+                if not set(value.split()).intersection(wanted):
+                    return False
+            elif value not in wanted:
+                return False
+        return True
+
+    def values(self, element):
+        """
+        What the path finds in an element, as a list
+        """
+        if self.path is None:
+            return [element]
+        found = self.path(element)
+        if isinstance(found, list):
+            return found
+        return [found] if found else []
+
+
+def select(resp, *selectors):
+    """
+    Parses an HTML response as it is read, yielding (selector, value) for
+    everything the `class` Selector s find, in the order it appears in the
+    page. Stop iterating as soon as you have what you need and the rest of
+    the page is neither read nor parsed, and the response is closed. Only
+    the elements the selectors are on are looked at. Request the page with
+    stream=True for this to save anything.
+
+    :param resp: the response for the page
+    """
+    tags = set(s.tag for s in selectors)
+    #a charset in the header wins, otherwise lxml goes by the page's <meta>
+    match = CHARSET_PATTERN.search(resp.headers.get('content-type') or '')
+    parser = etree.HTMLPullParser(
+        events=('end',), tag=None if None in tags else list(tags),
+        encoding=match.group(1) if match else None)
+    rest = ''
+    try:
+        for chunk in resp.iter_content(PAGE_CHUNK_SIZE):
+            #libxml2's push parser can stall until the end of the page if it
+            # is fed half a tag, so only ever feed it up to the last '>'
+            data = rest + chunk
+            cut = data.rfind('>') + 1
+            rest = data[cut:]
+            if not cut:
+                continue
+            parser.feed(data[:cut])
+            for found in found_by(parser, selectors):
+                if found is None:
+                    return
+                yield found
+        if rest:
+            parser.feed(rest)
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            #there was nothing in the page at all
+            return
+        for found in found_by(parser, selectors):
+            if found is None:
+                return
+            yield found
+    finally:
+        resp.close()
+
+
+def found_by(parser, selectors):
+    """
+    The (selector, value) pairs in what the parser has read so far, followed
+    by None if a final selector matched
+    """
+    for event, element in parser.read_events():
+        for selector in selectors:
+            if not selector.matches(element):
+                continue
+            for value in selector.values(element):
+                yield selector, value
+            if selector.final:
+                yield None
+                return
+
+
+def js_literal(text, pattern):
+    """
+    Finds a JavaScript object or array literal embedded in a page, e.g. in
+    an inline <script>, and parses it without evaluating anything. Plain
+    JSON is parsed as it is, anything else is turned into JSON first, so
+    single quoted strings, unquoted keys, trailing commas and undefined are
+    all fine.
+
+    :param str text: the page or the script
+    :param pattern: a compiled regex that matches right up to where the
+    literal starts, e.g. re.compile(r'var album\s*=\s*')
+    :returns: the dict or list, or None if the pattern isn't found or what
+    follows it isn't a literal
+    """
+    match = pattern.search(text)
+    if match is None:
+        return None
+    start = match.end()
+    try:
+        return JSON_DECODER.raw_decode(text, start)[0]
+    except ValueError:
+        pass
+    end = literal_end(text, start)
+    if end is None:
+        return None
+    try:
+        return json.loads(JS_NOT_JSON.sub(to_json, text[start:end]))
+    except ValueError:
+        return None
+
+
+def literal_end(text, start):
+    """
+    Where the object or array literal starting at start ends, or None if it
+    doesn't start with a bracket or never closes
+    """
+    depth = 0
+    for token in JS_BRACKETS.finditer(text, start):
+        if depth == 0 and token.start() != start:
+            return None
+        bracket = token.group()
+        if bracket in '[{':
+            depth += 1
+        elif bracket in ']}':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return None
+
+
+def to_json(match):
+    double, single, before, key, colon, closing = match.groups()
+    if double is not None:
+        return double
+    if single is not None:
+        return '"%s"' % SINGLE_QUOTED_ESCAPES.sub(double_quoted, single)
+    if key is not None:
+        return '%s"%s"%s' % (before, key, colon)
+    if closing is not None:
+        return closing
+    return 'null'
+
+
+def double_quoted(match):
+    escaped = match.group(1)
+    if escaped is None:
+        return '\\"'
+    return "'" if escaped == "'" else match.group()
+
+
+class Fetcher(object):
+    def __init__(self, acquirer=None):
+        """
+        Runs the requests a plugin needs to resolve one post, e.g. the pages
+        of a gallery, on the workers of the `class` AcquisitionEngine, so
+        they are bounded by its per host limit and run alongside the
+        downloads. More can be submitted while the results come in, so each
+        result can be followed up on straight away. Without an acquirer, or
+        one without workers, everything runs in turn.
+
+        :param acquirer: the plugin's `class` AcquisitionEngine
+        """
+        self.acquirer = acquirer
+        self._results = Queue()
+        self._inline = deque()
+        self._waiting = 0
+
+    def submit(self, func, url):
+        """
+        Queues func(url), url being what it requests
+        """
+        self._waiting += 1
+        if self.acquirer is None or self.acquirer.workers <= 0:
+            self._inline.append((func, url))
+        else:
+            self.acquirer.submit(host_of(url), self._run, func, url)
+
+    def _run(self, func, url):
+        try:
+            result = func(url)
+        except Exception, e:
+            log.warning('Error fetching %s: %s', url, e)
+            result = e
+        self._results.put((func, url, result))
+
+    def results(self):
+        """
+        Yields (func, url, result) for everything submitted, in the order
+        they finish, until there is nothing left, including whatever is
+        submitted in the meantime. Anything that raised is logged and left
+        out, so a post resolves to whatever could be fetched.
+        """
+        while self._waiting:
+            if self._inline:
+                self._run(*self._inline.popleft())
+            func, url, result = self._results.get()
+            self._waiting -= 1
+            if not isinstance(result, Exception):
+                yield func, url, result
 
 
 class BasePlugin(object):
-    def __init__(self, database, candidates, output):
+    #The hosts this plugin handles, as returned by
+    # `func` plugin_interface.extract_domain, e.g. ('imgur.com',). None means
+    # the plugin can handle links on any host.
+    domains = None
+    #A regex that a post url must match (from the start, ignoring case) for
+    # this plugin to handle it. None matches any url on the declared domains.
+    # Plugins that declare neither are fallbacks that see every candidate no
+    # other plugin claimed.
+    url_pattern = None
+    #Whether what execute finds for a post is kept in the resolution cache.
+    # Plugins that work out the image url from the post url alone, without
+    # requesting anything, gain nothing from it and should turn it off.
+    cache_resolutions = True
+    _compiled_patterns = {}
+    _compiled_literals = {}
+
+    def __init__(self, database, candidates, output, dedup=None,
+                 acquirer=None, session=None, max_image_size=None,
+                 writer=None, resolution_cache=None, preflight=False,
+                 min_width=None, min_height=None, near_duplicates=None,
+                 copies=None, journal=None):
         """The BasePlugin class actually does all of the work under the hood.
         It creates the database, performs the database calls. Retrieves images
         from content servers, does any error handling that plugins neglect to
@@ -28,28 +336,77 @@ class BasePlugin(object):
         :param str output: the location on disk to store your images (note
         that this can be changed and the database data will handle all
         duplicate filtering
+        :param dedup: a `class` DedupIndex shared between plugins. One is
+        built from the database if this is not passed in.
+        :param acquirer: an `class` AcquisitionEngine that image downloads
+        are queued into. Without one images are downloaded one at a time as
+        soon as the plugin hands them off.
+        :param session: the `class` HttpSession that plugins make all of
+        their requests through as self.session. The process wide default
+        session is used if this is not passed in.
+        :param int max_image_size: images bigger than this many bytes are
+        abandoned partway through the download. None means no limit.
+        :param writer: the `class` WriteBuffer that database rows are queued
+        into. Without one every row is written as soon as it is added.
+        :param resolution_cache: the `class` ResolutionCache shared between
+        plugins. One is made on the database if this is not passed in.
+        :param bool preflight: send a HEAD request for every image before
+        downloading it, so error pages, non-images and images over
+        max_image_size are turned away without transferring them. The GET
+        makes the same checks on its headers and closes the connection
+        before reading the body, so this only saves the connection setup,
+        and it is off by default as it costs a second request per image
+        against the host's rate limit.
+        :param int min_width: images narrower than this many pixels are
+        abandoned as soon as their header arrives, e.g. 1920. None means no
+        limit.
+        :param int min_height: the same for the height
+        :param near_duplicates: a `class` NearDuplicateIndex that new images
+        are checked against, so recompressed or resized copies of an image
+        that is already saved are skipped or replace it. None only dedups on
+        the md5.
+        :param copies: a `class` CopyIndex shared by several output
+        directories. Images that were already saved into another output
+        directory are hard linked into this one instead of being skipped.
+        :param journal: the `class` Journal that what happens to each post
+        and image is recorded in, so a run that dies can be picked up where
+        it stopped. None keeps no journal.
         """
         self.candidates = candidates
         self.output_dir = output
         self.to_acquire = []
         self.handled = []
         self.unhandled = []
-        self.db = os.path.join(os.getcwd(), '%s_downloaded.db' % database)
-        self.engine = create_engine('sqlite:///%s' % self.db)
-        metadata = MetaData(self.engine)
-        self.wallpapers = Table('wallpapers', metadata,
-                                Column('subreddit', String),
-                                Column('title', String),
-                                Column('url', String),
-                                Column('filename', String),
-                                Column('md5', String, primary_key=True))
-        self.retrieved = Table('retrieved', metadata,
-                               Column('image_url', String,
-                                      primary_key=True))
-        #Create the DB tables if not there
-        metadata.create_all()
+        if dedup is None:
+            dedup = DedupIndex(database)
+        self.dedup = dedup
+        self.acquirer = acquirer
+        self.max_image_size = max_image_size
+        self.preflight = preflight
+        self.min_width = min_width
+        self.min_height = min_height
+        self.near_duplicates = near_duplicates
+        self.copies = copies
+        self.journal = journal
+        self.session = session if session is not None else default_session()
+        if writer is None:
+            writer = WriteBuffer(dedup.database, max_rows=1)
+        self.writer = writer
+        if resolution_cache is None:
+            resolution_cache = ResolutionCache(dedup.database, writer)
+        self.resolution_cache = resolution_cache
+        self.db = dedup.database.db
+        self.engine = dedup.database.engine
+        self.wallpapers = dedup.database.wallpapers
+        self.retrieved = dedup.database.retrieved
         self.unique_img_hashes = self.get_previous_md5s()
+        self._lock = threading.Lock()
         self._current = None
+        self._emitted = 0
+        self._resolved = []
+        #the images each post is still waiting on, see :func: image_done
+        self._progress = {}
+        self.finished_posts = []
         self.enforcer()
 
     @property
@@ -60,126 +417,410 @@ class BasePlugin(object):
     def current(self, value):
         self._current = value
         if value is not None:
-            self.acquisition_tasks()
+            self._emitted += 1
+            self._resolved.append(value)
+            with self._lock:
+                progress = self._progress.get(self.candidate.url)
+                if progress is not None:
+                    progress['waiting'].add(value.url)
+                    progress['urls'].add(value.url)
+            if self.acquirer is not None:
+                self.acquirer.submit(host_of(value.url),
+                                     self.acquisition_tasks, value,
+                                     self.candidate)
+            else:
+                self.acquisition_tasks(value, self.candidate)
         else:
-            print '%s: Skipping %s: not handled by this plugin\n' % \
-                  (self.__class__.__name__, self.candidate.url)
+            log.info('%s: Skipping %s: not handled by this plugin',
+                     self.__class__.__name__, self.candidate.url)
             self.unhandled.append(self.candidate)
 
-    def acquisition_tasks(self):
-        if self.current.url in self.posts_already_finished:
+    def acquisition_tasks(self, download, candidate):
+        """
+        Fetches, checks, dedups, saves and records a single image, and keeps
+        the journal and the post's progress up to date. This can run on a
+        worker thread so it only works with what it is passed and never with
+        self.current or self.candidate.
+
+        :param download: the `class` Download for the image
+        :param candidate: the `class` Download for the post it came from
+        """
+        if self.journal is not None:
+            self.journal.image(download.url, DOWNLOADING,
+                               post=candidate.url)
+        try:
+            reason = self.download_image(download, candidate)
+        except Exception, e:
+            self.image_done(download, candidate, str(e) or repr(e))
+            raise
+        self.image_done(download, candidate, reason)
+
+    def download_image(self, download, candidate):
+        """
+        Does the work of :func: acquisition_tasks.
+
+        :returns str: why the image couldn't be acquired, or None if it was
+        saved or there was nothing to do for it
+        """
+        if download.url in self.posts_already_finished:
             #skip any posts that already have been done
-            print '%s: Skipping post: %s - previously acquired' % \
-                  (self.__class__.__name__, self.current.url)
+            log.debug('%s: Skipping post: %s - previously acquired',
+                      self.__class__.__name__, download.url)
         else:
-            self.posts_already_finished.append(self.current.url)
+            self.dedup.add_post(download.url)
 
-        if self.current.url in self.image_urls_already_fetched:
-            #skip any exact url matches from the db
-            print '%s: Skipping url %s: already downloaded\n' % \
-                  (self.__class__.__name__, self.current.url)
-        else:
-            #print data about the current acquisition
-            print '%s: Requesting: %s \n' % \
-                  (self.__class__.__name__, self.current.url)
-            #CLUTTER CLUTTER CLUTTER
-            #print self.current.title.encode('ascii', 'replace'),
-            #self.current.subreddit.encode('ascii', 'replace'),
-            #self.current.url.encode('ascii', 'replace'), '\n'
-
-            #snag the image! woot! that's what it all leads up to
-            # in the end!
-            try:
-                #use the cookie if we have one
-                if hasattr(self.current, 'cookies') and \
-                        self.current.cookies is not None:
-                    self.resp = requests.get(self.current.url,
-                                             cookies=self.current.cookies)
-                else:
-                    self.resp = requests.get(self.current.url)
-            except requests.HTTPError, e:
-                #or abject failure, you know, whichever...
-                print '%s: Failure: %s \n' % \
-                      (self.__class__.__name__, e.message)
-                self.current = None
+        if download.url in self.image_urls_already_fetched:
+            #skip any exact url matches from the db, making sure this output
+            # directory has a copy when it is shared with others
+            filename = None
+            if self.copies is not None:
+                filename = self.copies.link_url(download.url, self.output_dir)
+            if self.copies is None or filename is not None:
+                log.debug('%s: Skipping url %s: already downloaded',
+                          self.__class__.__name__, download.url)
+                self.count(download, 'already_downloaded')
+                return
+
+        #log data about the current acquisition
+        log.debug('%s: Requesting: %s', self.__class__.__name__,
+                  download.url)
+
+        #ask for the image only if it changed since we last turned it away
+        headers = self.conditional_headers(download.url)
+        if self.preflight:
+            result = self.preflight_check(download, headers)
+            if result == NOT_MODIFIED:
+                log.debug('%s: Not modified since it was last checked. '
+                          'Skipping: %s', self.__class__.__name__,
+                          download.url)
+                self.count(download, 'not_modified')
+                return
+            if result == REJECTED:
+                self.count(download, 'rejected')
+                self.unhandled.append(candidate)
+                return 'rejected by the pre-flight check'
 
+        #snag the image! woot! that's what it all leads up to
+        # in the end!
+        start = time.time()
+        try:
+            #use the cookie if we have one
+            resp = self.session.get(download.url, stream=True,
+                                    headers=headers, cookies=download.cookies)
+        except requests.RequestException, e:
+            #or abject failure, you know, whichever...
+            log.warning('%s: Failure: %s', self.__class__.__name__, e)
+            self.count(download, 'failed')
+            self.unhandled.append(candidate)
+            return str(e)
+
+        try:
+            if resp.status_code == 304:
+                log.debug('%s: Not modified since it was last checked. '
+                          'Skipping: %s', self.__class__.__name__,
+                          download.url)
+                self.count(download, 'not_modified')
+                return
+            if resp.status_code >= 400:
+                log.warning('%s: Failure: HTTP %d for %s',
+                            self.__class__.__name__, resp.status_code,
+                            download.url)
+                self.count(download, 'failed')
+                self.unhandled.append(candidate)
+                return 'HTTP %d' % resp.status_code
             #maybe we got very close, or an image got removed, in any case
             # MAKE SURE IT'S AN IMAGE!
-            if not self.valid_image_header():
+            if not self.valid_image_header(resp):
                 e = ValueError('Non-image header \"%s\" was found at the '
                                'link: %s' %
-                               (self.resp.headers.get('content-type'),
-                                self.current.url))
-                print e.message
-                self.current = None
+                               (resp.headers.get('content-type'),
+                                download.url))
+                log.warning(e.message)
+                self.count(download, 'failed')
+                self.unhandled.append(candidate)
+                return e.message
+            validators = (resp.headers.get('etag'),
+                          resp.headers.get('last-modified'))
+            #finally! we have image! stream it to a temp file, hashing it as
+            # it arrives so we never hold the whole thing in memory
+            tmp_path = self.stream_to_temp(resp, download)
+        finally:
+            resp.close()
+        if tmp_path is None:
+            self.count(download, 'failed')
+            self.unhandled.append(candidate)
+            return 'not a valid, complete image'
+        host = host_of(download.url)
+        metrics.observe('download_seconds', time.time() - start, host=host)
+        metrics.inc('download_bytes', download.file_size, host=host)
+
+        self.remember_validators(download, validators)
+        if not self.dedup.add_md5(download.md5):
+            if self.copies is not None and \
+                    self.copies.place(download.md5, self.output_dir) is None:
+                #no copy to link to, so this one becomes it
+                self.save_img(download, tmp_path)
+                self.copies.add(download, self.output_dir)
+                log.info('%s: MD5 duplicate with no copy left on disk. '
+                         'Saved: %s.', self.__class__.__name__,
+                         download.filename)
+                self.count(download, 'duplicate_saved')
             else:
-                #finally! we have image!
-                new_img = self.resp.content
-                self.current.md5 = hashlib.md5(new_img).hexdigest()
-                if self.current.md5 not in self.unique_img_hashes:
-                    self.save_img(new_img)
-                    self.unique_img_hashes.append(self.current.md5)
-                    self.add_to_main_db_table()
-                    self.revised.remove(self.candidate)
-                    self.handled.append(self.current)
-                    print '%s: Success! %s saved.\n' % \
-                          (self.__class__.__name__, self.current.filename)
-                else:
-                    print '%s: MD5 duplicate. Discarding: %s.\n' % \
-                          (self.__class__.__name__, self.current.filename)
-                    #remove successes so the whole run goes faster
-                    if self.current in self.candidates:
-                        # print '@@@@@@@@@@@@@@@@@@IT MATTERS'
-                        self.candidates.remove(self.current)
-
-    def add_to_main_db_table(self):
+                os.remove(tmp_path)
+                log.info('%s: MD5 duplicate. Discarding: %s.',
+                         self.__class__.__name__, download.filename)
+                self.count(download, 'duplicate')
+            #remove successes so the whole run goes faster
+            with self._lock:
+                self.candidates.remove(download)
+            return
+        keep, replaced = self.check_near_duplicates(download, tmp_path)
+        if not keep:
+            os.remove(tmp_path)
+            log.info('%s: Near duplicate of %s. Discarding: %s.',
+                     self.__class__.__name__, replaced.filename,
+                     download.filename)
+            self.count(download, 'near_duplicate')
+            with self._lock:
+                self.candidates.remove(download)
+            return
+        self.save_img(download, tmp_path)
+        self.dedup.add_image(download)
+        self.add_to_main_db_table(download)
+        if self.copies is not None:
+            self.copies.add(download, self.output_dir)
+        if self.journal is not None:
+            self.journal.saved(download, candidate.url)
+        if replaced is not None:
+            self.replace_img(replaced, download)
+        with self._lock:
+            self.revised.remove(candidate)
+        self.handled.append(download)
+        self.count(download, 'saved')
+        log.info('%s: Success! %s saved.', self.__class__.__name__,
+                 download.filename)
+
+    def count(self, download, result):
+        """
+        Counts how an image turned out, by host
+        """
+        metrics.inc('images', host=host_of(download.url), result=result)
+
+    def check_near_duplicates(self, download, tmp_path):
+        """
+        Looks the image up in the perceptual hash index, if there is one.
+
+        :returns: (keep, match) as returned by
+        `func` NearDuplicateIndex.claim
+        """
+        if self.near_duplicates is None:
+            return True, None
+        try:
+            return self.near_duplicates.claim(download, tmp_path)
+        except IOError, e:
+            #PIL can't decode everything we can validate, keep those
+            log.warning('%s: Could not hash %s: %s', self.__class__.__name__,
+                        download.url, e)
+            return True, None
+
+    def replace_img(self, old, new):
+        """
+        Removes a saved image that a bigger copy of the same picture has just
+        replaced, and records which image replaced it. Copies of it that were
+        linked into other output directories are linked to the new image.
+        """
+        old_path = os.path.join(self.output_dir, old.filename or '')
+        if old.filename and os.path.isfile(old_path):
+            os.remove(old_path)
+        if self.copies is not None:
+            self.copies.replace(old.md5, new.md5, os.path.join(
+                self.output_dir, new.filename))
+        self.writer.add_replacement(old.md5, new.md5)
+        log.info('%s: %s replaces the smaller %s.', self.__class__.__name__,
+                 new.filename, old.filename)
+
+    def conditional_headers(self, url):
+        """
+        Returns the If-None-Match and If-Modified-Since headers for an image
+        url that was downloaded before, so an unchanged image comes back as
+        a 304 instead of being transferred again
+        """
+        headers = {}
+        validators = self.dedup.database.get_validators(
+            url, self.dedup.connection())
+        if validators is not None:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def remember_validators(self, download, validators):
+        """
+        Saves the ETag and Last-Modified an image was served with, if it had
+        either
+        """
+        etag, last_modified = validators
+        if etag or last_modified:
+            self.writer.add_validators(download.url, etag, last_modified)
+
+    def preflight_check(self, download, headers):
+        """
+        Sends a HEAD request for the image to look at its status, content
+        type and length before downloading any of it. Anything the HEAD
+        request can't tell us for certain is left for the real request.
+
+        :param headers: the conditional request headers
+        :returns str: PREFLIGHT_OK, NOT_MODIFIED or REJECTED
+        """
+        try:
+            resp = self.session.head(download.url, headers=headers,
+                                     cookies=download.cookies,
+                                     allow_redirects=True)
+        except requests.RequestException:
+            return PREFLIGHT_OK
+        try:
+            if resp.status_code == 304:
+                return NOT_MODIFIED
+            if resp.status_code in HEAD_UNSUPPORTED:
+                return PREFLIGHT_OK
+            if resp.status_code >= 400:
+                log.warning('%s: Failure: HTTP %d for %s',
+                            self.__class__.__name__, resp.status_code,
+                            download.url)
+                return REJECTED
+            if resp.headers.get('content-type') and \
+                    not self.valid_image_header(resp):
+                log.warning('Non-image header "%s" was found at the link: '
+                            '%s', resp.headers.get('content-type'),
+                            download.url)
+                return REJECTED
+            if self.too_big(resp, download):
+                return REJECTED
+            return PREFLIGHT_OK
+        finally:
+            resp.close()
+
+    def too_big(self, resp, download):
+        """
+        True if the response says the image is bigger than max_image_size
+        """
+        length = resp.headers.get('content-length')
+        if self.max_image_size is not None and length is not None and \
+                length.isdigit() and int(length) > self.max_image_size:
+            log.warning('%s: Too big (%s bytes). Skipping: %s',
+                        self.__class__.__name__, length, download.url)
+            return True
+        return False
+
+    def stream_to_temp(self, resp, download):
+        """
+        Streams the response body in chunks to a temp file in the output
+        directory, computing the md5 as it goes so memory use stays the same
+        no matter how big the image is. The magic bytes and dimensions are
+        read from the first chunks without decoding anything, so anything
+        that isn't really an image, or is smaller than min_width and
+        min_height, is abandoned right there, and an image that was cut short
+        is never kept. Sets the md5, size and dimensions on the download.
+
+        :returns str: the path to the temp file, or None if the download
+        failed, went over max_image_size or wasn't a usable image, in which
+        case nothing is left on disk
+        """
+        if self.too_big(resp, download):
+            return None
+        md5 = hashlib.md5()
+        size = 0
+        head = ''
+        info = None
+        tail = ''
+        fd, tmp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX, prefix=TEMP_PREFIX,
+                                        dir=self.output_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if self.max_image_size is not None and \
+                            size > self.max_image_size:
+                        raise ValueError('Went over the maximum size of %d '
+                                         'bytes' % self.max_image_size)
+                    if info is None:
+                        head += chunk
+                        info = parse_header(head, len(head) >= HEADER_LIMIT)
+                        if info is not None:
+                            head = None
+                            self.check_dimensions(info)
+                    tail = (tail + chunk)[-TAIL_SIZE:]
+                    md5.update(chunk)
+                    f.write(chunk)
+            if info is None:
+                info = parse_header(head, final=True)
+                self.check_dimensions(info)
+            check_complete(info, tail, size)
+        except (requests.RequestException, ValueError, IOError), e:
+            log.warning('%s: Failure downloading %s: %s',
+                        self.__class__.__name__, download.url, e)
+            os.remove(tmp_path)
+            return None
+        download.md5 = md5.hexdigest()
+        download.file_size = size
+        download.width = info.width
+        download.height = info.height
+        return tmp_path
+
+    def check_dimensions(self, info):
+        """
+        Raises a ValueError if the image is smaller than min_width or
+        min_height
+        """
+        if (self.min_width is not None and info.width < self.min_width) or \
+                (self.min_height is not None and
+                 info.height < self.min_height):
+            raise ValueError('%dx%d is smaller than the minimum of %sx%s' %
+                             (info.width, info.height, self.min_width or '-',
+                              self.min_height or '-'))
+
+    def add_to_main_db_table(self, download):
         """
         Inserts the full handled link info into the wallpapers table of the db
         """
-        conn = self.engine.connect()
-        wall_data = (self.current.subreddit, self.current.title,
-                     self.current.url, self.current.filename, self.current.md5)
-        wall_ins = self.wallpapers.insert(wall_data)
-        conn.execute(wall_ins)
+        self.writer.add_wallpaper(download)
 
     def add_to_previous_aquisitions(self):
         """
-        Adds to the list of previously handled links
+        Adds the posts that every image was acquired from to the list of
+        previously handled links, so that a gallery is only skipped once all
+        of it has been fetched
         """
+        with self._lock:
+            finished, self.finished_posts = self.finished_posts, []
         #prevent hash collision in the table
         uniques = set()
-        for h in self.handled:
-            if h.url not in self.posts_already_finished:
-                uniques.add(h.url)
+        for url in finished:
+            if url not in self.posts_already_finished:
+                uniques.add(url)
         for u in uniques:
-            conn = self.engine.connect()
-            retrieved_ins = sql.insert(table=self.retrieved,
-                                       values=[u])
-            conn.execute(retrieved_ins)
+            self.writer.add_retrieved(u)
 
     def check_db_for_finished_image_urls(self):
         """
-        Returns a `class` DownloadList of urls that has successfully been
-        downloaded. This helps make sure that if a gallery post is picked up
-        partway that we don't re-attempt the first already fetched posts as
-        well as for skipping already fetched single image posts.
+        Exposes the set of urls that have successfully been downloaded from
+        the shared `class` DedupIndex. This helps make sure that if a gallery
+        post is picked up partway that we don't re-attempt the first already
+        fetched posts as well as for skipping already fetched single image
+        posts.
         """
-        conn = self.engine.connect()
-        finished_urls_select = sql.select([self.wallpapers])
-        self.image_urls_already_fetched = DownloadList(
-            [a[2] for a in conn.execute(
-                finished_urls_select).fetchall()])
+        self.image_urls_already_fetched = self.dedup.image_urls
 
     def check_db_for_finished_post_urls(self):
         """
-        Returns a `class` DownloadList of previous posts that successfully
-        went allthe way through the scraper, this is needed for gallery posts
-        that may fail partway through a job to not get skipped on retry
+        Exposes the set of previous posts that successfully went all the way
+        through the scraper from the shared `class` DedupIndex, this is
+        needed for gallery posts that may fail partway through a job to not
+        get skipped on retry
         """
-        conn = self.engine.connect()
-        finished_posts_select = sql.select([self.retrieved])
-        self.posts_already_finished = DownloadList([a[0] for a in conn.execute(
-            finished_posts_select).fetchall()])
+        self.posts_already_finished = self.dedup.post_urls
 
     def convert_candidates(self):
         """
@@ -189,15 +830,7 @@ class BasePlugin(object):
         necessary information and makes the code much easier to read and
         understand
         """
-        new_cands = []
-        for c in self.candidates:
-            if c.__class__.__name__ == 'Download':
-                new_cands.append(c)
-            else:
-                new_cands.append(Download(c['data']['title'],
-                                          c['data']['subreddit'],
-                                          c['data']['url']))
-        self.candidates = CandidatesList(new_cands)
+        self.candidates = convert_candidates(self.candidates)
         self.candidates_backup = self.candidates
         self.revised = self.candidates
 
@@ -220,16 +853,188 @@ class BasePlugin(object):
         # anything
         self.prune()
         for candidate in self.candidates:
-            #make the candidate object easily available everywhere
-            self.candidate = candidate
-            #reset the Download object to None on each iteration of the loop
-            self.current = None
-            try:
-                #this creates a Download object at self.current
-                self.execute()
-            except Exception, e:
-                print traceback.print_exc()
-                self.unhandled.append(self.candidate)
+            self.process_candidate(candidate)
+
+    def process_candidate(self, candidate):
+        """
+        Runs the plugin over a single candidate, catching anything the plugin
+        throws. This is what the `class` PluginInterface calls for each
+        candidate that gets routed to this plugin.
+
+        :param candidate: the `class` Download for the post
+        :returns bool: True if the plugin handed off at least one image
+        """
+        #make the candidate object easily available everywhere
+        self.candidate = candidate
+        #reset the Download object to None on each candidate
+        self._current = None
+        self._emitted = 0
+        self._resolved = []
+        with self._lock:
+            self._progress[candidate.url] = {'waiting': set(), 'urls': set(),
+                                             'resolved': False,
+                                             'failed': None}
+        cached = None
+        if self.cache_resolutions:
+            cached = self.resolution_cache.get(candidate.url)
+        if cached is not None:
+            #resolved on an earlier run, skip straight to the downloads
+            for image in cached:
+                self.current = Download(image['title'], candidate.subreddit,
+                                        image['url'], image['cookies'])
+            metrics.inc('resolutions', plugin=self.__class__.__name__,
+                        result='cached')
+            self.post_resolved(candidate)
+            return self._emitted > 0
+        start = time.time()
+        try:
+            #this creates a Download object at self.current
+            self.execute()
+        except Exception, e:
+            log.exception('%s: Error resolving %s', self.__class__.__name__,
+                          candidate.url)
+            self.count_resolution(start, 'failed')
+            self.unhandled.append(self.candidate)
+            self.post_resolved(candidate, str(e) or repr(e))
+            return False
+        self.count_resolution(start, 'resolved' if self._emitted else
+                              'unhandled')
+        if self._resolved:
+            if self.cache_resolutions:
+                self.resolution_cache.put(candidate.url, self._resolved)
+            if self.journal is not None:
+                self.journal.post(candidate.url, RESOLVED, images=[
+                    {'url': d.url, 'title': d.title, 'cookies': d.cookies}
+                    for d in self._resolved])
+        self.post_resolved(candidate)
+        if not self._emitted:
+            log.info('%s: Skipping %s: not handled by this plugin',
+                     self.__class__.__name__, self.candidate.url)
+            self.unhandled.append(self.candidate)
+        return self._emitted > 0
+
+    def count_resolution(self, start, result):
+        """
+        Times and counts a post being resolved, by plugin
+        """
+        name = self.__class__.__name__
+        metrics.observe('resolve_seconds', time.time() - start, plugin=name)
+        metrics.inc('resolutions', plugin=name, result=result)
+
+    def post_resolved(self, candidate, reason=None):
+        """
+        Called once the plugin is done finding images for a post. The post
+        is finished when all of them are, which may be straight away.
+
+        :param str reason: why resolving the post failed, if it did
+        """
+        with self._lock:
+            progress = self._progress.get(candidate.url)
+            if progress is None:
+                return
+            progress['resolved'] = True
+            if reason is not None:
+                progress['failed'] = reason
+            if not progress['urls'] and reason is None:
+                #nothing was found, which isn't the post being finished
+                del self._progress[candidate.url]
+                return
+            if progress['waiting']:
+                return
+            del self._progress[candidate.url]
+        self.post_done(candidate, progress)
+
+    def image_done(self, download, candidate, reason=None):
+        """
+        Records how an image turned out, and finishes its post if it was the
+        last one the post was waiting on.
+
+        :param str reason: why the image couldn't be acquired, None if it
+        was saved or there was nothing to do for it
+        """
+        if reason is not None and self.journal is not None:
+            self.journal.image(download.url, FAILED, post=candidate.url,
+                               reason=reason)
+        with self._lock:
+            progress = self._progress.get(candidate.url)
+            if progress is None:
+                return
+            progress['waiting'].discard(download.url)
+            if reason is not None:
+                progress['failed'] = reason
+            if not progress['resolved'] or progress['waiting']:
+                return
+            del self._progress[candidate.url]
+        self.post_done(candidate, progress)
+
+    def post_done(self, candidate, progress):
+        """
+        Records a post whose images have all been dealt with, as finished if
+        none of them failed
+        """
+        if progress['failed'] is not None:
+            if self.journal is not None:
+                #with what it takes to retry it on the next run
+                self.journal.post(candidate.url, FAILED,
+                                  reason=progress['failed'],
+                                  title=candidate.title,
+                                  subreddit=candidate.subreddit)
+            return
+        if self.journal is not None:
+            self.journal.post(candidate.url, SAVED)
+        #a direct link is its own image and the wallpapers table has it
+        if progress['urls'] != set([candidate.url]):
+            with self._lock:
+                self.finished_posts.append(candidate.url)
+
+    @classmethod
+    def handles(cls, url):
+        """
+        Checks a url against the declared domains and url_pattern of the
+        plugin. Plugins that declare neither have to decide for themselves
+        in execute so this always returns True for them.
+
+        :param str url: the post url
+        :rtype bool:
+        """
+        if cls.domains is not None:
+            host = host_of(url)
+            if not [d for d in cls.domains
+                    if host == d or host.endswith('.' + d)]:
+                return False
+        pattern = cls.compiled_pattern()
+        return pattern is None or pattern.match(url) is not None
+
+    @classmethod
+    def compiled_pattern(cls):
+        """
+        Returns the compiled url_pattern of the plugin, compiling it only once
+        """
+        if cls.url_pattern is None:
+            return None
+        if cls not in BasePlugin._compiled_patterns:
+            BasePlugin._compiled_patterns[cls] = re.compile(cls.url_pattern,
+                                                            re.IGNORECASE)
+        return BasePlugin._compiled_patterns[cls]
+
+    def fetcher(self):
+        """
+        Returns a `class` Fetcher for making the requests that resolving a
+        post needs in parallel
+        """
+        return Fetcher(self.acquirer)
+
+    def find_literal(self, text, pattern):
+        """
+        Finds and parses a JavaScript literal in a page with
+        `func` js_literal, compiling the pattern only once for the plugin
+
+        :param str pattern: a regex that matches right up to the literal
+        """
+        key = (self.__class__, pattern)
+        if key not in BasePlugin._compiled_literals:
+            BasePlugin._compiled_literals[key] = re.compile(pattern)
+        return js_literal(text, BasePlugin._compiled_literals[key])
 
     def execute(self):
         """
@@ -242,12 +1047,9 @@ class BasePlugin(object):
 
     def get_previous_md5s(self):
         """
-        Returns the list of md5s already in the database
+        Returns the set-like view of the md5s already acquired
         """
-        conn = self.engine.connect()
-        md5_select = sql.select(from_obj=self.wallpapers, columns=['md5'])
-        unique_img_hashes = [h[0] for h in conn.execute(md5_select).fetchall()]
-        return unique_img_hashes
+        return self.dedup.md5s
 
     def prune(self):
         """
@@ -255,45 +1057,33 @@ class BasePlugin(object):
         the database from the beginning, try to be as econmoical as possible
         and avoid getting ip or other form of blacklisted at all costs
         """
-        for fetched in self.image_urls_already_fetched.downloads:
-            if fetched in self.candidates:
-                self.candidates.remove(fetched)
-                continue
-        for finished in self.posts_already_finished.downloads:
-            if finished in self.candidates:
-                self.candidates.remove(finished)
-                continue
+        self.dedup.prefetch(c.url for c in self.candidates)
+        for candidate in self.candidates:
+            if self.dedup.already_acquired(candidate.url):
+                self.candidates.remove(candidate)
 
-    def save_img(self, data):
+    def save_img(self, download, tmp_path):
         """
-        What it sounds like. Code responsible for saving off the image to the
-        filesystem and display any errors that might arise
+        What it sounds like. Code responsible for moving the downloaded temp
+        file into place in the filesystem under the image's filename. The
+        rename is atomic so a half written image never shows up in the output
+        directory.
         """
         #Move the logic that strips url args here in case they were needed for
         # downloads (was stripping it before acquisition like a total noob)
-        if '?' in self.current.filename:
-            self.current.filename = self.current.filename.split('?')[0]
-        #Add the output path the the filename
-        orig_img_path = os.path.join(self.output_dir, self.current.filename)
+        if '?' in download.filename:
+            download.filename = download.filename.split('?')[0]
         #handle incrementing the image name with a number if we pass the MD5
-        # but the filename was taken
-        img_path = orig_img_path
-        orig_path, orig_ext = orig_img_path.rsplit('.', 1)
-        inc = 1
-        #prevent stupidly named files like image.jpg from being overwritten
-        # all the time
-        while os.path.exists(img_path):
-            img_path = '%s_%d.%s' % (orig_path, inc, orig_ext)
-            inc += 1
-        with open(img_path, 'wb') as f:
-            f.write(data)
-        try:
-            Image.open(img_path)
-        except IOError:
-            print traceback.print_exc()
-            os.remove(img_path)
+        # but the filename was taken, to prevent stupidly named files like
+        # image.jpg from being overwritten all the time. The lock stops two
+        # workers from picking the same name
+        with SAVE_LOCK:
+            img_path = free_path(os.path.join(self.output_dir,
+                                              download.filename))
+            os.rename(tmp_path, img_path)
+        download.filename = os.path.basename(img_path)
 
-    def valid_image_header(self):
+    def valid_image_header(self, resp):
         """
         This checks the response header for the content type so we aren't
         saving bunk data into a file and calling it an image. This happens a
@@ -303,7 +1093,7 @@ class BasePlugin(object):
         for header in IMAGE_HEADERS:
             #this handles headers that look like this:
             #image/jpeg; charset=UTF-8
-            if header in self.resp.headers.get('content-type'):
+            if header in resp.headers.get('content-type', ''):
                 return True
         #if we get here no header matched
-        return False
\ No newline at end of file
+        return False
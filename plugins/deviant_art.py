@@ -1,17 +1,24 @@
-from bs4 import BeautifulSoup
 from plugins.base_plugin import *
 
 
 class DeviantArt(BasePlugin):
+    domains = ('deviantart.com',)
+    NOT_FOUND = 'deviantART: 404 Not Found'
+    TITLE = Selector('title', 'string()')
+    OG_IMAGE = Selector('meta', '@content', {'name': 'og:image'})
+    PAGE_BUTTONS = Selector('a', '@href', {'class': (
+        'dev-page-button', 'dev-page-button-with-text', 'dev-page-download')})
+    DOWNLOAD_BUTTON = Selector(None, '@href', {'id': 'download-button'})
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        if 'deviantart.com' in self.candidate.url.lower():
+        if self.handles(self.candidate.url):
             deviant_art_img_url, deviant_art_cookie = self\
                 .get_deviant_art_image(self.candidate.url)
             if deviant_art_img_url is not None:
-                if deviant_art_img_url == 'deviantART: 404 Not Found':
+                if deviant_art_img_url == self.NOT_FOUND:
                     return
                 self.current = Download(self.candidate.title,
                                         self.candidate.subreddit,
@@ -26,33 +33,30 @@ class DeviantArt(BasePlugin):
         """
 
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error reaching deviantart (%s):' % url
-            print e
-            return
-        root = BeautifulSoup(resp.text)
-
-        for title in root.find_all('title'):
-            if title.text == 'deviantART: 404 Not Found':
-                print '%s: %s' % (url, title.text)
-                return title.text, resp.cookies.get_dict()
-
-        dl = root.find('meta', {'name': 'og:image'})
-        if dl is not None:
-            return dl.attrs.get('content'), resp.cookies.get_dict()
-
-        for dl in root.find_all('a', ['dev-page-button',
-                                      'dev-page-button-with-text',
-                                      'dev-page-download']):
-            if '/download/' in dl.attrs.get('href') and '?token' in \
-                dl.attrs.get('href'):
-                href = dl.attrs.get('href')
-                #why do we split off the token here? let's turn that off
-                # for now...
-                # href = href.split('?token')[0]
-                return href, resp.cookies.get_dict()
-
-        for dl in root.find_all(id='download-button'):
-            if '/download/' in dl.attrs.get('href'):
-                return dl.attrs.get('href'), resp.cookies.get_dict()
\ No newline at end of file
+            resp = self.session.get(url, stream=True)
+        except requests.RequestException, e:
+            log.warning('Error reaching deviantart (%s): %s', url, e)
+            return None, None
+        cookies = resp.cookies.get_dict()
+        #the title and og:image are in the head, so a page that has them
+        # is only read that far
+        download = None
+        for selector, value in select(resp, self.TITLE, self.OG_IMAGE,
+                                      self.PAGE_BUTTONS,
+                                      self.DOWNLOAD_BUTTON):
+            if selector is self.TITLE:
+                if value == self.NOT_FOUND:
+                    log.warning('%s: %s', url, value)
+                    return value, cookies
+            elif selector is self.OG_IMAGE:
+                return value, cookies
+            elif selector is self.PAGE_BUTTONS:
+                if '/download/' in value and '?token' in value:
+                    #why do we split off the token here? let's turn that off
+                    # for now...
+                    # value = value.split('?token')[0]
+                    return value, cookies
+            elif download is None and '/download/' in value:
+                #the page buttons are preferred wherever they are
+                download = value
+        return download, cookies
\ No newline at end of file
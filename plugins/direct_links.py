@@ -2,6 +2,14 @@ from plugins.base_plugin import *
 
 
 class DirectLinks(BasePlugin):
+    #any host, as long as the path ends in an image extension. This also
+    # matches the new imgur direct links with a reddit argument, e.g.
+    # http://i.imgur.com/nbsQ4SF.jpg#.UTtRkqYGmy0.reddit
+    url_pattern = r'[^?]*\.(?:jpg|jpeg|gif|bmp|png)(?:\?.*)?$|' \
+                  r'http://i\.imgur\.com/[^?#]*#.*\.reddit$'
+    #the image url is the post url, there is nothing to cache
+    cache_resolutions = False
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
@@ -9,13 +17,12 @@ class DirectLinks(BasePlugin):
         #This helps handle the new imgur links that are direct links but have
         #  some kind of reddit argument e.g.
         # http://i.imgur.com/nbsQ4SF.jpg#.UTtRkqYGmy0.reddit
-        if self.candidate.url.startswith('http://i.imgur.com') and \
-                self.candidate.url.endswith('.reddit'):
-            self.candidate.url = self.candidate.url.split('#')[0]
+        url = self.candidate.url
+        if url.startswith('http://i.imgur.com') and url.endswith('.reddit'):
+            url = url.split('#')[0]
         for img_type in ['.jpg', '.jpeg', '.gif', '.bmp', '.png']:
-            if self.candidate.url.lower().rsplit('?')[0].endswith(
-                    img_type):
+            if url.lower().rsplit('?')[0].endswith(img_type):
                 self.current = Download(self.candidate.title,
                                         self.candidate.subreddit,
-                                        self.candidate.url)
+                                        url)
                 break
\ No newline at end of file
@@ -1,19 +1,22 @@
-import re
-
 from plugins.base_plugin import *
 
 
 class FlickrSingle(BasePlugin):
+    domains = ('flickr.com',)
+    url_pattern = r'https?://www\.flickr\.com/photos/'
+    PHOTO_START = r'Y\.photo\.init\(\s*'
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        if 'www.flickr.com/photos/' in self.candidate.url:
+        url = self.candidate.url
+        if self.handles(url):
             #This just throws us back in case the link we have is for a
             # pre-selected size, so we can choose high quality like normal
-            if '/sizes/' in self.candidate.url:
-                self.candidate.url = self.candidate.url.split('/sizes/')[0]
-            flickr_img_url = self.get_best_quality(self.candidate.url)
+            if '/sizes/' in url:
+                url = url.split('/sizes/')[0]
+            flickr_img_url = self.get_best_quality(url)
             if flickr_img_url is not None:
                 self.current = Download(self.candidate.title,
                                         self.candidate.subreddit,
@@ -21,17 +24,14 @@ class FlickrSingle(BasePlugin):
 
     def get_best_quality(self, url):
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error reaching Flickr (%s)' % url
-            print e
+            resp = self.session.get(url)
+        except requests.RequestException, e:
+            log.warning('Error reaching Flickr (%s): %s', url, e)
+            return
+        qualities = self.find_literal(resp.text, self.PHOTO_START)
+        if qualities is None:
+            log.warning('No photo data found on Flickr page %s', url)
             return
-        page = resp.text
-        find_qualities = re.compile(r'Y.photo.init\((.+)\)', re.MULTILINE)
-        match = re.search(find_qualities, page)
-        #some ugly de-jsification hackery here
-        qualities = eval(match.group(1).replace(
-            'true', 'True').replace('false', 'False').replace('null', 'None'))
         if type(qualities) != dict:
             raise ValueError('Did not resolve to a dict. That\'s really '
                              '*really* bad! You got a: %s' % type(qualities))
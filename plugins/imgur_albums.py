@@ -1,14 +1,18 @@
 #Handles getting all of the images from an album linked to on imgur
-from bs4 import BeautifulSoup
 from plugins.base_plugin import *
 
 
 class ImgurAlbum(BasePlugin):
+    domains = ('imgur.com',)
+    url_pattern = r'http://imgur\.com/a/'
+    BODY_SCRIPTS = Selector('script', 'string(self::*[ancestor::body])')
+    ALBUM_START = r'^\s*var\s+album\s*=\s*'
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        if self.candidate.url.lower().startswith('http://imgur.com/a/'):
+        if self.handles(self.candidate.url):
             album_imgs = self.get_imgur_album(self.candidate.url)
             for album_img in album_imgs:
                 self.current = Download(self.candidate.title,
@@ -22,32 +26,30 @@ class ImgurAlbum(BasePlugin):
         :rtype list: a list of urls that is are direct links to images
         """
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error contacting imgur (%s):' % url
-            print e
+            resp = self.session.get(url, stream=True)
+        except requests.RequestException, e:
+            log.warning('Error contacting imgur (%s): %s', url, e)
             return []
-        root = BeautifulSoup(resp.text)
         urls = []
-        for script in root.find('body').find_all('script'):
-            if script.attrs.get('text') is not None:
-                if script.text.replace('\n', '').lstrip().rstrip()\
-                        .startswith('var album'):
-                    album = eval('[{%s}]' % script.text.split('[{')[1].split(
-                        '}]')[0])
-                    #this check in case the album has one image,
-                    # which returns dict instead of list
-                    if type(album) == list or type(album) == tuple:
-                        for image in album:
-                            url = 'http://i.imgur.com/%s%s' % (image['hash'],
-                                                               image['ext'])
-                            urls.append(url)
-                    elif type(album) == dict:
-                        url = 'http://i.imgur.com/%s%s' % (album['hash'],
-                                                           album['ext'])
+        for _, text in select(resp, self.BODY_SCRIPTS):
+            album = self.find_literal(text, self.ALBUM_START)
+            if album is not None:
+                #this check in case the album has one image,
+                # which returns dict instead of list
+                if type(album) == list:
+                    for image in album:
+                        url = 'http://i.imgur.com/%s%s' % (image['hash'],
+                                                           image['ext'])
                         urls.append(url)
-                    else:
-                        print type(album), album
-                        print 'Unhandled album type!'
-                        raise ValueError
+                elif type(album) == dict:
+                    url = 'http://i.imgur.com/%s%s' % (album['hash'],
+                                                       album['ext'])
+                    urls.append(url)
+                else:
+                    log.warning('Unhandled album type! %s %r',
+                                type(album), album)
+                    raise ValueError
+                #there is only the one album, the rest of the page is not
+                # needed
+                break
         return urls
\ No newline at end of file
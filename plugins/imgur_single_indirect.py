@@ -2,24 +2,24 @@
 # link to its imgur page
 
 #works as of 09-30-13
-from bs4 import BeautifulSoup
 from plugins.base_plugin import *
 
 
 class ImgurSingleIndirect(BasePlugin):
+    domains = ('imgur.com',)
+    #imgur pages that aren't albums, and prevent this plugin from handling
+    # direct links such as the following:
+    #http://i.imgur.com/nbsQ4SF.jpg#.UTtRkqYGmy0.reddit
+    url_pattern = r'http://(?:imgur\.com/(?!a/)|i\.imgur\.com/)' \
+                  r'(?![^?#]*\.(?:jpe?g|bmp|png|gif)(?:\?[^#]*)?(?:#.*)?$)'
+    #the image is one of the <link>s, the body is never read
+    HEAD_LINKS = Selector('head', './/link/@href', final=True)
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        #prevent this plugin from handling links such as the following:
-        #http://i.imgur.com/nbsQ4SF.jpg#.UTtRkqYGmy0.reddit
-        if (self.candidate.url.lower().startswith('http://imgur.com/')
-            and not self.candidate.url.split('#')[0].lower().startswith(
-            'http://imgur.com/a/') and not self.candidate.url.lower()[-4:] in
-                ['.jpg', '.bmp', '.png', '.gif']) or \
-                (self.candidate.url.lower().startswith('http://i.imgur.com/')
-                 and not self.candidate.url.lower()[-4:] in ['.jpg', '.bmp',
-                                                             '.png', '.gif']):
+        if self.handles(self.candidate.url):
             img_url = self.get_imgur_single(self.candidate.url)
             if img_url is not None:
                 self.current = Download(self.candidate.title,
@@ -33,15 +33,11 @@ class ImgurSingleIndirect(BasePlugin):
         :rtype str: a url that is a direct link to an image
         """
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error contacting imgur (%s):' % url
-            print e
+            resp = self.session.get(url, stream=True)
+        except requests.RequestException, e:
+            log.warning('Error contacting imgur (%s): %s', url, e)
             return []
-        root = BeautifulSoup(resp.text)
-        al = root.find('head').find_all('link')
-        for a in al:
-            href = a.attrs.get('href')
+        for _, href in select(resp, self.HEAD_LINKS):
             if url.lstrip('http://') in href:
                 #Fix The single indirect links that look like this:
                 #<link rel="image_src" href="//i.imgur.com/IZZayKa.png" />
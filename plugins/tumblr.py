@@ -1,13 +1,27 @@
-from bs4 import BeautifulSoup
+import re
+
 from plugins.base_plugin import *
 
+#the original size of a photo, which is all we want
+HIGHRES = re.compile(r'https?://[^/]*media\.tumblr\.com/\S+_1280\.'
+                     r'(?:jpe?g|png|gif|bmp)$', re.IGNORECASE)
+
 
 class Tumblr(BasePlugin):
+    domains = ('tumblr.com',)
+    #posts, the photos themselves are direct links
+    url_pattern = r'https?://(?![^/]*media\.tumblr\.com/)' \
+                  r'(?![^?#]*\.(?:jpe?g|bmp|png|gif)(?:[?#].*)?$)'
+    PHOTOSETS = Selector('iframe', '@src', {'class': 'photoset'})
+    PHOTOS = Selector('a', '@href', {'class': 'photoset_photo'})
+    LINKS = Selector('a', '@href')
+    IMAGES = Selector('img', '@src')
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        if 'tumblr.com' in self.candidate.url.lower():
+        if self.handles(self.candidate.url):
             img_urls = self.get_tumblr_imgs(self.candidate.url)
             for img_url in img_urls:
                 self.current = Download(self.candidate.title,
@@ -15,26 +29,43 @@ class Tumblr(BasePlugin):
                                         img_url)
 
     def get_tumblr_imgs(self, url):
+        """
+        Yields the photos of a post. If the page links the original size
+        photos itself they are used straight away, otherwise the photoset
+        iframes are fetched in parallel and each photo is yielded as soon as
+        its iframe is in. An iframe that can't be fetched is skipped and the
+        rest of the photos are still found.
+
+        :param str url: the post url
+        """
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error contacting tumblr (%s):' % url
-            print e
-            return []
-        root = BeautifulSoup(resp.text)
-        imgs = []
-
-        for iframe in root.find_all('iframe', {'class': 'photoset'}):
-            src = iframe.attrs.get('src')
-
-            try:
-                resp = requests.get(src)
-            except requests.HTTPError, e:
-                print 'Error contacting tumblr (%s):' % url
-                print e
-                return []
-            root = BeautifulSoup(resp.text)
-
-            for img in root.find_all({'class': 'photoset_photo'}):
-                imgs.append(img.attrs.get('href'))
-        return imgs
\ No newline at end of file
+            resp = self.session.get(url, stream=True)
+        except requests.RequestException, e:
+            log.warning('Error contacting tumblr (%s): %s', url, e)
+            return
+        photosets = []
+        seen = set()
+        for selector, value in select(resp, self.PHOTOSETS, self.LINKS,
+                                      self.IMAGES):
+            if selector is self.PHOTOSETS:
+                photosets.append(value)
+            elif HIGHRES.match(value) and value not in seen:
+                seen.add(value)
+                yield value
+        if seen:
+            return
+        fetcher = self.fetcher()
+        for src in photosets:
+            fetcher.submit(self.get_photoset, src)
+        for _, _, photos in fetcher.results():
+            for photo in photos:
+                if photo not in seen:
+                    seen.add(photo)
+                    yield photo
+
+    def get_photoset(self, src):
+        """
+        :returns list: the photos linked from a photoset iframe
+        """
+        return [href for _, href in select(self.session.get(src, stream=True),
+                                           self.PHOTOS)]
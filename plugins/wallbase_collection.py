@@ -4,19 +4,27 @@
 
 import re
 import base64
-import time
 
-from bs4 import BeautifulSoup
 from plugins.base_plugin import *
 
+#the image is written out by a script on the page, base64 encoded
+BIGWALL_SRC = re.compile(r'src="\'\+B\(\'([a-zA-Z0-9=\+/\\]+)\'\)\+\'"')
+
 
 class WallbaseCollection(BasePlugin):
+    domains = ('wallbase.cc',)
+    url_pattern = r'http://wallbase\.cc/user/collection/'
+    IMAGE_COUNT = Selector(None, 'string(div[2]/div[4]/span[2])',
+                           {'id': 'delwrap'}, final=True)
+    THUMBS = Selector('a', '@href', {'class': 'thumb'})
+    BIGWALL_SCRIPT = Selector(None, 'string(descendant::script[1])',
+                              {'id': 'bigwall'}, final=True)
+
     def execute(self):
         """Executor for this plugin. The entry function by which any plugin must
         operate to handle links.
         """
-        if self.candidate.url.lower().startswith(
-                'http://wallbase.cc/user/collection/'):
+        if self.handles(self.candidate.url):
             collection_imgs = self.get_wallbase_collection(self.candidate.url)
             for img_url in collection_imgs:
                 self.current = Download(self.candidate.title,
@@ -26,51 +34,61 @@ class WallbaseCollection(BasePlugin):
     def get_wallbase_collection(self, url):
         """Helper for the wallbase collection function. This will try to
         retirieve all of the pages of a collection and then stitch together a
-        listing of all the different images from that collection.
+        listing of all the different images from that collection. The pages
+        and then the wallpaper page of every thumbnail on them are fetched in
+        parallel, and each image is yielded as soon as it is found.
 
         :param str url: a url to retrieve and execute the xpath on
         :rtype str: a url that is a direct link to an image
         """
         try:
-            resp = requests.get(url)
-        except requests.HTTPError, e:
-            print 'Error contacting wallbase (%s):' % url
-            print e
-            return []
-        root = BeautifulSoup(resp.text)
-        max_images = int(root.find({'id': 'delwrap'})
-                             .find_all('div', recursive=False)[1]
-                             .find_all('div', recursive=False)[3]
-                             .find_all('span', recursive=False)[1].text)
-        pages = []
+            resp = self.session.get(url, stream=True)
+        except requests.RequestException, e:
+            log.warning('Error contacting wallbase (%s): %s', url, e)
+            return
+        max_images = 0
+        for _, count in select(resp, self.IMAGE_COUNT):
+            max_images = int(count)
+        fetcher = self.fetcher()
         start = 1
         end = 32
         while end <= max_images + 64:  # for some reason everything is shifted
         #  by 32, plus we add an extra 32 for a full exceed above the required
-            p = '%s%d/%d' % (url, start, end)
-            pages.append(p)
+            fetcher.submit(self.get_thumb_links, '%s%d/%d' % (url, start, end))
             start += 32
             end += 32
-        urls = []
-        for i, p in enumerate(pages):
-            thumb_links = []
-            root = BeautifulSoup(requests.get(p).text)
-            for script in root.find_all({'class': 'thumb'}, 'a'):
-                img_link = script.attrs.get('href')
-                thumb_links.append(img_link)
-            for link in thumb_links:
-                try:
-                    resp = requests.get(link)
-                except requests.HTTPError, e:
-                    print 'Error contacting wallbase (%s):' % url
-                    print e
-                    continue
-                root = BeautifulSoup(resp.text)
-                js = root.find(id='bigwall').find('script').text
-                pat = re.compile(r'src="\'\+B\(\'[a-zA-Z0-9=\+\\]+\'\)\+\'"')
-                match = re.search(pat, js)
-                m = match.group().lstrip(r'src="\'\+B\(\'').rstrip(r'\'\)\+\'"')
-                img_url = base64.b64decode(m)
-                if img_url not in urls:
-                    urls.append(img_url)
-        return urls
\ No newline at end of file
+        links = set()
+        images = set()
+        for func, _, result in fetcher.results():
+            if func == self.get_thumb_links:
+                #the wallpaper pages are queued as soon as their thumbnails
+                # are found
+                for link in result:
+                    if link not in links:
+                        links.add(link)
+                        fetcher.submit(self.get_wallpaper, link)
+            elif result is not None and result not in images:
+                images.add(result)
+                yield result
+
+    def get_thumb_links(self, page):
+        """
+        :returns list: the wallpaper page of every thumbnail on a page of the
+        collection
+        """
+        return [link for _, link in select(
+            self.session.get(page, stream=True), self.THUMBS)]
+
+    def get_wallpaper(self, link):
+        """
+        :returns str: the image on a wallpaper page, or None
+        """
+        js = ''
+        for _, js in select(self.session.get(link, stream=True),
+                            self.BIGWALL_SCRIPT):
+            pass
+        match = BIGWALL_SRC.search(js)
+        if match is None:
+            log.warning('No wallpaper found on %s', link)
+            return None
+        return base64.b64decode(match.group(1).replace('\\', ''))
@@ -0,0 +1,186 @@
+import time
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+#reddit's API rules allow 30 requests a minute, unless its X-Ratelimit headers
+# say otherwise
+REDDIT_HOST = 'reddit.com'
+REDDIT_RATE = 0.5
+#politeness towards everybody else
+DEFAULT_RATE = 5.0
+DEFAULT_CAPACITY = 10
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        """
+        A token bucket. Tokens trickle in at `rate` a second up to
+        `capacity`, every request takes one and waits for one if there are
+        none left. The bucket can also be blocked outright for a while, which
+        is what a Retry-After or an exhausted reddit budget does.
+
+        :param float rate: tokens added per second
+        :param int capacity: the most tokens that can be saved up, i.e. how
+        big a burst is allowed
+        """
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.blocked_until = 0
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def _delay(self, now):
+        #must be called with the lock held
+        self._refill(now)
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Takes a token, sleeping only as long as it takes for one to arrive
+        """
+        while True:
+            with self._lock:
+                delay = self._delay(time.time())
+                if delay <= 0:
+                    self.tokens -= 1
+                    return
+            time.sleep(delay)
+
+    def wait(self):
+        """
+        Sleeps until a token is available without taking it
+        """
+        while True:
+            with self._lock:
+                delay = self._delay(time.time())
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def block(self, seconds):
+        """
+        Lets nothing through for the given number of seconds
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+    def set_budget(self, remaining, reset):
+        """
+        Spreads what is left of a server announced budget over the time until
+        it resets, so the whole budget gets used without going over it.
+
+        :param float remaining: requests left in the current window
+        :param float reset: seconds until the window resets
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if remaining < 1:
+                self.tokens = 0
+                self.blocked_until = max(self.blocked_until, now + reset)
+                return
+            if reset > 0:
+                self.rate = remaining / float(reset)
+            self.tokens = min(self.tokens, remaining)
+
+
+class RateLimiter(object):
+    def __init__(self, default_rate=DEFAULT_RATE,
+                 default_capacity=DEFAULT_CAPACITY):
+        """
+        Keeps a `class` TokenBucket per host. Hosts can be given their own
+        rate with :func: set_rate, which also covers their subdomains and
+        shares one bucket between them, everything else gets a bucket of its
+        own at the default rate. Responses are fed back in with :func: update
+        so Retry-After and reddit's X-Ratelimit headers are honoured.
+
+        :param float default_rate: requests per second for hosts without a
+        rate of their own, None for no limit
+        :param int default_capacity: the burst allowed at the default rate
+        """
+        self.default_rate = default_rate
+        self.default_capacity = default_capacity
+        self.rates = {REDDIT_HOST: (REDDIT_RATE, 1)}
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def set_rate(self, host, rate, capacity=1):
+        """
+        Sets the rate for a host and its subdomains. None means no limit.
+        """
+        with self._lock:
+            self.rates[host.lower()] = (rate, capacity)
+            self.buckets.pop(host.lower(), None)
+
+    def bucket(self, host):
+        """
+        Returns the bucket for the host or None if it isn't limited
+        """
+        host = (host or '').lower()
+        key = host
+        rate, capacity = self.default_rate, self.default_capacity
+        for configured, limits in self.rates.items():
+            if host == configured or host.endswith('.' + configured):
+                key = configured
+                rate, capacity = limits
+                break
+        if rate is None:
+            return None
+        with self._lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(rate, capacity)
+            return self.buckets[key]
+
+    def acquire(self, host):
+        bucket = self.bucket(host)
+        if bucket is not None:
+            bucket.acquire()
+
+    def wait(self, host):
+        bucket = self.bucket(host)
+        if bucket is not None:
+            bucket.wait()
+
+    def update(self, host, resp):
+        """
+        Adjusts the host's bucket from the response headers
+        """
+        bucket = self.bucket(host)
+        if bucket is None:
+            return
+        retry_after = parse_retry_after(resp.headers.get('retry-after'))
+        if retry_after is not None:
+            bucket.block(retry_after)
+        remaining = resp.headers.get('x-ratelimit-remaining')
+        reset = resp.headers.get('x-ratelimit-reset')
+        if remaining is not None and reset is not None:
+            try:
+                bucket.set_budget(float(remaining), float(reset))
+            except ValueError:
+                pass
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait from a Retry-After header, which is either a
+    number of seconds or an HTTP date, or None if there isn't a usable one
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
@@ -1,14 +1,25 @@
 import os
-import time
 import json
 import string
 
 import requests
 
+from data_types import Download
+from database import Database
+from http_session import HttpSession
+from rate_limit import REDDIT_HOST
+from metrics import metrics, get_logger
+
 HERE = os.path.abspath(os.path.dirname(__file__))
 with open(os.path.join(HERE, 'VERSION')) as f:
     VERSION = f.read()
 
+#sync modes for :func: RedditConnect.sync_upvotes
+INCREMENTAL = 'incremental'
+BACKFILL = 'backfill'
+
+log = get_logger('reddit_connect')
+
 
 class RedditConnect():
     """
@@ -17,8 +28,10 @@ class RedditConnect():
 
     :param str username: The reddit username
     :param str password: The password for above username
+    :param session: the `class` HttpSession to make requests through, so it
+    can be shared with the plugins. One is made if this is not passed in.
     """
-    def __init__(self, username, password):
+    def __init__(self, username, password, session=None):
         self.username = username
         self.password = password
         self.headers = {
@@ -27,6 +40,10 @@ class RedditConnect():
                           'https://github.com/oscillot/reddit-scraper' %
                           VERSION}
         self.cookie = None
+        self.sync_mark = None
+        if session is None:
+            session = HttpSession()
+        self.session = session
 
     def login(self):
         """
@@ -35,22 +52,23 @@ class RedditConnect():
         reddit's API throttling rules! You can't upvote fast enough that you
         would have to break them anyway!
         """
-        print 'Logging in...'
+        log.info('Logging in...')
         data = {'user': self.username,
                 'passwd': self.password,
                 'rem': 'True'}
 
         try:
-            resp = requests.post('https://ssl.reddit.com/api/login/%s?' %
-                                 self.username, data, headers=self.headers)
-        except requests.HTTPError, e:
-            print 'Error contacting reddit:'
+            resp = self.session.post('https://ssl.reddit.com/api/login/%s?' %
+                                     self.username, data,
+                                     headers=self.headers)
+        except requests.RequestException, e:
+            log.error('Error contacting reddit: %s', e)
             raise e
         json_str = resp.text
         json_resp = json.loads(json_str)
 
         self.cookie = dict(resp.cookies.items())
-        print 'Logged in as %s\n' % self.username
+        log.info('Logged in as %s', self.username)
         return json_resp
 
     def basic_request(self, url):
@@ -63,10 +81,10 @@ class RedditConnect():
         :returns str: the read response
         """
         try:
-            resp = requests.get(url, headers=self.headers,
-                                cookies=self.cookie)
+            resp = self.session.get(url, headers=self.headers,
+                                    cookies=self.cookie)
         except requests.HTTPError, e:
-            print 'Error in basic request (%s): %s\n' % (url, e)
+            log.warning('Error in basic request (%s): %s', url, e)
             return
         return resp.text
 
@@ -80,7 +98,7 @@ class RedditConnect():
         the_page = self.basic_request('http://www.reddit.com/r/%s.json' %
                                       sub_name)
         if the_page is None:
-            print 'Nothing returned trying to request \"%s\"!\n' % sub_name
+            log.error('Nothing returned trying to request "%s"!', sub_name)
             raise ValueError
         return the_page
 
@@ -93,7 +111,8 @@ class RedditConnect():
         """
         the_page = self.basic_request('http://www.reddit.com/reddits/mine.json')
         if the_page is None:
-            print 'Nothing returned trying to request your subs (mine.json)!\n'
+            log.error('Nothing returned trying to request your subs '
+                      '(mine.json)!')
             raise ValueError
         return the_page
 
@@ -106,7 +125,8 @@ class RedditConnect():
         """
         the_page = self.basic_request('http://www.reddit.com/api/me.json')
         if the_page is None:
-            print 'Nothing returned trying to request your info (me.json)!\n'
+            log.error('Nothing returned trying to request your info '
+                      '(me.json)!')
             raise ValueError
         return the_page
 
@@ -119,18 +139,18 @@ class RedditConnect():
          25 posts.
         :returns list: A list of dictionaries converted from the json response
         """
-        print 'Retrieving upvotes...'
+        log.info('Retrieving upvotes...')
         total_upvoted_data = []
         upvoted_json = self.basic_request('http://www.reddit.com/user/%s/liked'
                                           '.json' % self.username)
         if upvoted_json is None:
-            print 'Nothing returned trying to request your upvotes (%s/liked' \
-                  '.json)!\n' % self.username
+            log.error('Nothing returned trying to request your upvotes '
+                      '(%s/liked.json)!', self.username)
             raise ValueError
         json_data = json.loads(upvoted_json)
         total_upvoted_data += json_data['data']['children']
-        print '1 Page Processed: %d Upvotes Found So Far...' % \
-              len(total_upvoted_data)
+        log.info('1 Page Processed: %d Upvotes Found So Far...',
+                 len(total_upvoted_data))
         if max_pages > 1:
             for r in range(1, max_pages + 1):
                 try:
@@ -140,22 +160,207 @@ class RedditConnect():
                                                       % (self.username, r * 25,
                                                       json_data['data']
                                                       ['after']))
-                except requests.exceptions.ConnectionError, e:
+                except (requests.ConnectionError, requests.Timeout), e:
                     if len(total_upvoted_data) > 0:
-                        print 'WARNING: Connection error!'
-                        print e
-                        print 'Upvotes only partially retrieved.'
+                        log.warning('Connection error! Upvotes only '
+                                    'partially retrieved: %s', e)
                         return total_upvoted_data
                     else:
                         raise e
                 json_data = json.loads(upvoted_json)
                 total_upvoted_data += json_data['data']['children']
-                print '%d Pages Processed: %d Upvotes Found So Far...' % \
-                      (r + 1, len(total_upvoted_data))
-                self.wait()
-        print 'Upvotes retrieved!\n'
+                log.info('%d Pages Processed: %d Upvotes Found So Far...',
+                         r + 1, len(total_upvoted_data))
+        log.info('Upvotes retrieved!')
         return total_upvoted_data
 
+    def get_upvotes_page(self, after=None, count=0, limit=25):
+        """
+        Get one page of the json listing of the user's upvoted posts. Must be
+        logged in and cookied for this to work!
+
+        :param str after: the fullname of the post to start after, None for
+        the newest page
+        :param int count: how many posts have been seen before this page
+        :param int limit: how many posts to ask for, reddit allows up to 100
+        :returns dict: the converted json response
+        """
+        url = 'http://www.reddit.com/user/%s/liked.json?limit=%d' % \
+              (self.username, limit)
+        if after is not None:
+            url += '&count=%d&after=%s' % (count, after)
+        upvoted_json = self.basic_request(url)
+        if upvoted_json is None:
+            log.error('Nothing returned trying to request your upvotes '
+                      '(%s/liked.json)!', self.username)
+            raise ValueError
+        return json.loads(upvoted_json)
+
+    def sync_upvotes(self, database, mode=INCREMENTAL, max_pages=None,
+                     limit=100):
+        """
+        Get the user's upvoted posts, only paging as far as needed. Must be
+        logged in and cookied for this to work!
+
+        In INCREMENTAL mode paging stops as soon as it reaches the newest post
+        seen by the last incremental sync, so on most runs this is a single
+        request. If that post has been un-upvoted since, paging stops after
+        the first page of posts that are all older than it was. In BACKFILL
+        mode it pages all the way back, saving the after cursor after every
+        page so an interrupted backfill picks up where it left off on the
+        next call.
+
+        The new high-water mark isn't saved until :func: save_sync_mark is
+        called, do that once the upvotes have actually been processed so a
+        crashed run doesn't skip them next time.
+
+        :param database: a `class` Database or the prefix for the database
+        filename to keep the sync state in
+        :param str mode: INCREMENTAL or BACKFILL
+        :param int max_pages: stop after this many pages, None for no limit
+        :param int limit: posts per page, reddit allows up to 100
+        :returns list: A list of dictionaries converted from the json response
+        """
+        log.info('Syncing upvotes (%s)...', mode)
+        upvotes = []
+        for page in self._sync_pages(database, mode, max_pages, limit):
+            upvotes.extend(page)
+        log.info('Upvotes retrieved!')
+        return upvotes
+
+    def _sync_pages(self, database, mode=INCREMENTAL, max_pages=None,
+                    limit=100):
+        """
+        The paging behind :func: sync_upvotes, yielding the new upvotes of
+        each page as soon as it arrives. The sync mark is only set once the
+        generator has been run to the end. Without a database it just pages
+        from the newest upvote, keeping no sync state.
+        """
+        mark_key = 'upvotes_high_water:%s' % self.username
+        #when the post at the mark was created, for if it disappears
+        created_key = 'upvotes_high_water_created:%s' % self.username
+        cursor_key = 'upvotes_backfill_after:%s' % self.username
+        if database is not None and not isinstance(database, Database):
+            database = Database(database)
+        mark_created = None
+        if database is None:
+            mark = None
+            after = None
+        elif mode == INCREMENTAL:
+            mark = database.get_state(mark_key)
+            if mark is not None:
+                mark_created = database.get_state(created_key)
+            if mark_created is not None:
+                mark_created = float(mark_created)
+            after = None
+        elif mode == BACKFILL:
+            mark = None
+            after = database.get_state(cursor_key)
+        else:
+            raise ValueError('Unknown sync mode: %s' % mode)
+        from_top = after is None
+
+        seen = 0
+        newest = None
+        reached_mark = False
+        pages = 0
+        while True:
+            try:
+                json_data = self.get_upvotes_page(after, seen, limit)
+            except (requests.ConnectionError, requests.Timeout), e:
+                if seen > 0:
+                    log.warning('Connection error! Upvotes only partially '
+                                'retrieved: %s', e)
+                    return
+                raise e
+            children = json_data['data']['children']
+            if from_top and newest is None and children:
+                newest = children[0]['data']
+            page = []
+            for child in children:
+                if mark is not None and child['data']['name'] == mark:
+                    reached_mark = True
+                    break
+                page.append(child)
+            #upvotes are listed in the order they were made, not by how old
+            # the post is, so one old post is no reason to stop but a whole
+            # page of them means the mark was passed
+            if mark_created is not None and not reached_mark and page and \
+                    all(child['data'].get('created_utc', 0) <= mark_created
+                        for child in page):
+                reached_mark = True
+            seen += len(page)
+            pages += 1
+            after = json_data['data']['after']
+            metrics.inc('reddit_pages')
+            metrics.inc('upvotes', len(page))
+            log.info('%d Pages Processed: %d New Upvotes Found So Far...',
+                     pages, seen)
+            yield page
+            #only once the page has been used, so a run that stops partway
+            # through it starts from it again
+            if database is not None and mode == BACKFILL:
+                database.set_state(cursor_key, after)
+            if reached_mark or after is None or \
+                    (max_pages is not None and pages >= max_pages):
+                break
+        #only move the mark if nothing between it and the top was skipped
+        if database is not None and newest is not None and \
+                (reached_mark or after is None):
+            self.sync_mark = (database, {
+                mark_key: newest['name'],
+                created_key: repr(newest['created_utc'])
+                if newest.get('created_utc') is not None else None})
+
+    def iter_upvotes(self, max_pages=None, limit=100, database=None,
+                     mode=INCREMENTAL):
+        """
+        A generator of the user's upvoted posts, requesting each page only
+        when the one before it has been used up, so no more than a page is
+        ever held in memory. Must be logged in and cookied for this to work!
+
+        Without a database this pages from the newest upvote. With one it
+        syncs like :func: sync_upvotes, and :func: save_sync_mark can be
+        called once the generator has been used up.
+
+        :param int max_pages: stop after this many pages, None for no limit
+        :param int limit: posts per page, reddit allows up to 100
+        :param database: a `class` Database or the prefix for the database
+        filename to keep the sync state in, or None
+        :param str mode: INCREMENTAL or BACKFILL, only used with a database
+        """
+        for page in self._sync_pages(database, mode, max_pages, limit):
+            for child in page:
+                yield child
+
+    def iter_candidates(self, subs, upvotes):
+        """
+        A generator of `class` Download candidates for the upvotes in the
+        given subreddits, which `class` PluginInterface can consume directly.
+
+        :param list subs: A list of strings naming each subreddit to get
+        images from.
+        :param upvotes: any iterable of upvoted posts, e.g. from
+        :func: iter_upvotes with the database that keeps the sync mark, so
+        only the new ones are paged through
+        """
+        subs = set(map(string.lower, subs))
+        for child in upvotes:
+            data = child['data']
+            if data['subreddit'].lower() in subs:
+                yield Download(data['title'], data['subreddit'], data['url'])
+
+    def save_sync_mark(self):
+        """
+        Saves the high-water mark found by the last :func: sync_upvotes so
+        the next incremental sync stops there
+        """
+        if self.sync_mark is not None:
+            database, state = self.sync_mark
+            for key, value in state.items():
+                database.set_state(key, value)
+            self.sync_mark = None
+
     def get_upvoted_wallpapers(self, subs, upvotes_data):
         """
         Get the urls for upvotes in a specific subset of subreddits. This is
@@ -173,7 +378,7 @@ class RedditConnect():
         :returns list: A list of dictionaries where each key 'url' is a
         direct link to an image
         """
-        print 'Getting candidates...\n'
+        log.info('Getting candidates...')
         #make the list of subreddits lowercase for easier comparisons
         subs = map(string.lower, subs)
 
@@ -183,16 +388,19 @@ class RedditConnect():
             if child['data']['subreddit'].lower() in subs:
                 candidates.append(child)
                 matches += 1
-                print 'Candidates found so far: %d' % matches
+                log.debug('Candidates found so far: %d', matches)
         return candidates
 
     def wait(self):
         """
-        Waits two seconds whenever the API agreement decrees that you must
-        wait. This prevents the bot from getting blocked and having requests
-        sit around for the max timeout, the effects of which are worse on
-        large jobs which is usually when this happens anyway.
+        Waits until the API agreement allows another request. Requests are
+        throttled by the token bucket rate limiter on the session, which
+        follows reddit's X-Ratelimit headers, so this only sleeps when the
+        budget is actually used up. This prevents the bot from getting
+        blocked and having requests sit around for the max timeout, the
+        effects of which are worse on large jobs which is usually when this
+        happens anyway.
 
         https://github.com/reddit/reddit/wiki/API#rules
         """
-        time.sleep(2)
\ No newline at end of file
+        self.session.limiter.wait(REDDIT_HOST)
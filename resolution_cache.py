@@ -0,0 +1,144 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import sqlalchemy.sql as sql
+
+from database import Database, WriteBuffer
+
+#how long in seconds a resolution is trusted before the post page is scraped
+# again, hosts do move their images around eventually
+DEFAULT_TTL = 7 * 24 * 60 * 60
+#the most posts kept in the database, the least recently used go first
+MAX_ENTRIES = 50000
+#the most posts kept in memory
+MEMORY_ENTRIES = 1000
+
+
+class ResolutionCache(object):
+    def __init__(self, database, writer=None, ttl=DEFAULT_TTL,
+                 max_entries=MAX_ENTRIES, memory_entries=MEMORY_ENTRIES):
+        """
+        A persistent cache of what image urls (and cookies) each post url
+        resolved to, kept in the resolutions table. A post that was resolved
+        on an earlier run, e.g. a gallery that failed partway through, is
+        handed straight to the downloads without fetching and parsing its
+        page again. Entries expire after the ttl and the least recently used
+        are evicted once there are more than max_entries of them.
+
+        :param database: a `class` Database or the prefix for the database
+        filename
+        :param writer: the `class` WriteBuffer new entries are queued into.
+        Without one every entry is written as soon as it is added.
+        :param int ttl: seconds an entry stays valid, None for forever
+        :param int max_entries: the most entries kept by :func: evict, None
+        for no limit
+        :param int memory_entries: the most entries kept in memory
+        """
+        if not isinstance(database, Database):
+            database = Database(database)
+        self.database = database
+        if writer is None:
+            writer = WriteBuffer(database, max_rows=1)
+        self.writer = writer
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connection(self):
+        """
+        Returns a connection for the calling thread, reused between lookups
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.database.engine.connect()
+        return conn
+
+    def expired(self, resolved_at, now):
+        return self.ttl is not None and resolved_at + self.ttl < now
+
+    def get(self, post_url):
+        """
+        Returns the images a post resolved to, as a list of dicts with url,
+        title and cookies keys, or None if the post isn't cached or the entry
+        has expired
+        """
+        now = int(time.time())
+        with self._lock:
+            entry = self._memory.pop(post_url, None)
+        if entry is None:
+            table = self.database.resolutions
+            row = self.connection().execute(
+                sql.select([table.c.images, table.c.resolved_at]).where(
+                    table.c.post_url == post_url)).fetchone()
+            if row is not None:
+                entry = (json.loads(row[0]), row[1])
+        if entry is None or self.expired(entry[1], now):
+            with self._lock:
+                self.misses += 1
+            return None
+        images, resolved_at = entry
+        self._remember(post_url, entry)
+        with self._lock:
+            self.hits += 1
+        #bump it so eviction sees it was used
+        self.writer.add_resolution(post_url, json.dumps(images), resolved_at,
+                                   now)
+        return images
+
+    def put(self, post_url, downloads):
+        """
+        Caches what a post resolved to.
+
+        :param downloads: the `class` Download objects the plugin found
+        """
+        images = [{'url': d.url, 'title': d.title, 'cookies': d.cookies}
+                  for d in downloads]
+        now = int(time.time())
+        self._remember(post_url, (images, now))
+        self.writer.add_resolution(post_url, json.dumps(images), now, now)
+
+    def _remember(self, post_url, entry):
+        with self._lock:
+            self._memory.pop(post_url, None)
+            self._memory[post_url] = entry
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def evict(self):
+        """
+        Removes expired entries and the least recently used ones over
+        max_entries from the database. Call this after the writer has been
+        flushed.
+
+        :returns int: how many entries were removed
+        """
+        table = self.database.resolutions
+        removed = 0
+        with self.database.engine.begin() as conn:
+            if self.ttl is not None:
+                removed += conn.execute(table.delete().where(
+                    table.c.resolved_at < int(time.time()) - self.ttl)
+                ).rowcount
+            if self.max_entries is not None:
+                removed += conn.execute(
+                    'DELETE FROM resolutions WHERE post_url NOT IN '
+                    '(SELECT post_url FROM resolutions ORDER BY used_at DESC '
+                    'LIMIT ?)', (self.max_entries,)).rowcount
+        return removed
+
+    def stats(self):
+        """
+        Returns the hit and miss counts and the hit rate
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': float(hits) / total if total else 0.0}
@@ -1,15 +1,37 @@
 import os
+import logging
+from metrics import setup_logging
+from http_session import HttpSession
+from rate_limit import RateLimiter
 from reddit_connect import RedditConnect
 from plugin_interface import PluginInterface
 
 #run this manually, through jenkins or as a cron job
 
+#everything is logged through the logging module, this shows it on stderr.
+# Use logging.DEBUG to also see every request and every skipped image, or
+# logging.WARNING for just the problems.
+setup_logging(logging.INFO)
+
+#one pooled session with timeouts and retries is shared by everything. Its
+# rate limiter keeps reddit at 30 requests a minute (or whatever reddit's
+# X-Ratelimit headers allow) and every other host at 5 a second, raise or
+# lower a host with limiter.set_rate('imgur.com', 2)
+limiter = RateLimiter()
+session = HttpSession(timeout=(10, 60), retries=3, pool_maxsize=8,
+                      limiter=limiter)
 #pass in your username and pw. All connections are ssl, see reddit_connect.py
-rc = RedditConnect('username', 'password')
+rc = RedditConnect('username', 'password', session=session)
 #perform the login
 rc.login()
-#retrieve X pages of likes
-liked_data = rc.get_upvotes(max_pages=5)
+#retrieve the likes since the last run, this stops paging as soon as it gets
+# to what was seen last time. Use mode=BACKFILL (from reddit_connect) to page
+# all the way back instead, it resumes where it left off if interrupted. To
+# just get X pages of likes use rc.iter_upvotes(max_pages=X) instead. This is
+# a generator, pages are only requested as the candidates are used up so
+# memory stays flat however far back it goes. rc.sync_upvotes('db_name')
+# returns the same as a list.
+liked_data = rc.iter_upvotes(database='db_name')
 #if you use jenkins with envinject, you can specify a multi-reddit or list
 # there, otherwise pass a list in directly
 # e.g.
@@ -21,13 +43,53 @@ my_subs = ['apocalypseporn', 'bigwallpapers', 'conceptart',
            'imaginarytechnology', 'multiscreen', 'originalbackgrounds',
            'postapocalyptic', 'sciencefiction', 'scifi', 'specart',
            'steampunk']
-#get the list of candidate images
-candidates = rc.get_upvoted_wallpapers(my_subs, liked_data)
+#get the candidate images, also a generator
+candidates = rc.iter_candidates(my_subs, liked_data)
 #instaniate the image acquisition class with a daabase name,
-# list of candidates and set a location to save images to.
+# list of candidates and set a location to save images to. Images are
+# downloaded by `workers` threads at once, but never more than `per_host` at
+# once from the same host. Pass min_width=1920 to only keep images at least
+# that wide, anything smaller is dropped as soon as its header arrives. Pass
+# near_duplicates='skip' or 'keep-larger' to also catch reposts that were
+# recompressed or resized, run python -m perceptual db_name <output> once
+# first so the images you already have are hashed too.
+#Counters and latency histograms for the run (resolve times per plugin,
+# download times and bytes per host, dedup hits, database flushes, queue
+# depths) are written to db_name_metrics.json at the end, and to a Prometheus
+# textfile as well if you pass prometheus_file='/path/to/scraper.prom'.
+#Pass preflight=True to send a HEAD request for every image first, which
+# turns away error pages, non-images and images over max_image_size before
+# the GET is even made. The GET checks the same headers and drops anything
+# bad before reading its body, so this is off by default: it is two requests
+# per image against each host's rate limit for the sake of a connection.
 plugins = PluginInterface(database='db_name', candidates=candidates,
-                 output=os.path.join('X:\\', 'location_to_save_to'))
+                 output=os.path.join('X:\\', 'location_to_save_to'),
+                 workers=8, per_host=2, session=session)
+#Everything the run does is journaled to db_name_journal.log as it happens,
+# so if it is killed partway the next run writes whatever it had saved but
+# not recorded yet and carries on from there. Posts that failed are tried
+# again on the next few runs. Pass journal=False to turn it off.
 plugins.acquire()
+#everything was processed, so the next sync can stop here
+rc.save_sync_mark()
+
+#Or, instead of the sync_upvotes, get_upvoted_wallpapers and PluginInterface
+# steps above, run them all at once as a pipeline so images start
+# downloading while later pages of upvotes are still being fetched. It takes
+# the same options as PluginInterface:
+
+#from pipeline import Pipeline
+#pipeline = Pipeline(rc, my_subs, database='db_name',
+#                    output=os.path.join('X:\\', 'location_to_save_to'),
+#                    resolvers=4, workers=8, per_host=2, session=session)
+#pipeline.acquire()
+#rc.save_sync_mark()
+
+#To run several accounts at once, each with its own subreddits and output
+# directory, put them in a JSON config (see batch_runner.load_config) and run
+# python -m batch_runner config.json. They share one session, rate limiter
+# and database, and an image more than one of them wants is downloaded once
+# and hard linked into each output directory.
 
 #If you use Jenkins with the EnvInject plugin, you can expose parameter input to the web interface and configure from
 # over your network instead of editing the module directly, e.g.:
@@ -10,7 +10,7 @@ setup(
     version=VERSION,
     packages=find_packages(),
     install_requires=['pillow>=1.7.8',
-                      'lxml>=3.0.2',
+                      'lxml>=3.3',
                       'sqlalchemy>=0.8.0b2',
                       'requests>=2.0.0',
                       'BeautifulSoup4'
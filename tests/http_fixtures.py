@@ -0,0 +1,256 @@
+#Offline HTTP fixtures. Responses (reddit listings, plugin pages, images) are
+# recorded into a FixtureStore by running anything through a
+# RecordingSession, and served back by a FixtureServer on localhost with
+# whatever latency and bandwidth you want, so the tests and benchmarks never
+# touch the real sites.
+#
+#Recording a real run:
+#   session = RecordingSession(FixtureStore('fixtures/my_run'))
+#   ... pass session to RedditConnect and PluginInterface as usual ...
+#
+#Replaying it:
+#   server = FixtureServer(FixtureStore('fixtures/my_run'), latency=0.05)
+#   server.start()
+#   session = server.session()
+#   ...
+#   server.stop()
+
+import os
+import json
+import time
+import hashlib
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from requests.adapters import HTTPAdapter
+
+from http_session import HttpSession
+from rate_limit import RateLimiter, REDDIT_HOST
+
+#the header the replay adapter sends the original url in
+URL_HEADER = 'X-Fixture-Url'
+#how much of a body the server writes between bandwidth sleeps
+WRITE_CHUNK = 16 * 1024
+#response headers that are about the original transfer, not the content
+HOP_HEADERS = ('connection', 'content-encoding', 'content-length',
+               'keep-alive', 'transfer-encoding')
+
+
+def fixture_key(method, url):
+    return hashlib.sha1('%s %s' % (method.upper(), url)).hexdigest()
+
+
+class FixtureStore(object):
+    def __init__(self, directory=None):
+        """
+        Recorded responses, keyed on the method and url. Each one is kept as
+        a .json file with the status and headers next to a .body file, or
+        only in memory if no directory is given.
+
+        :param str directory: where the fixtures are kept
+        """
+        self.directory = directory
+        self._memory = {}
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def add(self, url, body, content_type='text/html', status=200,
+            headers=None, method='GET'):
+        """
+        Adds a response, for building synthetic fixtures
+        """
+        headers = dict(headers or {})
+        headers['Content-Type'] = content_type
+        self.save(method, url, status, headers, body)
+
+    def save(self, method, url, status, headers, body):
+        meta = {'method': method.upper(), 'url': url, 'status': status,
+                'headers': dict((k, v) for k, v in headers.items()
+                                if k.lower() not in HOP_HEADERS)}
+        key = fixture_key(method, url)
+        if self.directory is None:
+            with self._lock:
+                self._memory[key] = (meta, body)
+            return
+        path = os.path.join(self.directory, key)
+        with open(path + '.body', 'wb') as f:
+            f.write(body)
+        with open(path + '.json', 'wb') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+
+    def load(self, method, url):
+        """
+        Returns (status, headers, body) for a request, or None if it wasn't
+        recorded. A HEAD request is answered from the GET if it has to be.
+        """
+        for m in (method.upper(), 'GET'):
+            key = fixture_key(m, url)
+            if self.directory is None:
+                with self._lock:
+                    found = self._memory.get(key)
+            else:
+                path = os.path.join(self.directory, key)
+                found = None
+                if os.path.exists(path + '.json'):
+                    with open(path + '.json', 'rb') as f:
+                        meta = json.load(f)
+                    with open(path + '.body', 'rb') as f:
+                        found = (meta, f.read())
+            if found is not None:
+                meta, body = found
+                return meta['status'], meta['headers'], body
+            if method.upper() != 'HEAD':
+                break
+        return None
+
+
+class RecordingSession(HttpSession):
+    def __init__(self, store, **kwargs):
+        """
+        An `class` HttpSession that saves every response it gets into the
+        store. It takes the same keyword arguments as HttpSession.
+        """
+        HttpSession.__init__(self, **kwargs)
+        self.store = store
+
+    def request(self, method, url, **kwargs):
+        resp = HttpSession.request(self, method, url, **kwargs)
+        #reading it all here leaves iter_content working off the copy
+        self.store.save(method, url, resp.status_code, resp.headers,
+                        resp.content)
+        return resp
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #send the status line and headers in one go rather than one write each
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, send_body=True):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        url = self.headers.get(URL_HEADER) or self.path
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        found = server.store.load(self.command, url)
+        if found is None:
+            status, headers, body = 404, {'Content-Type': 'text/plain'}, \
+                'No fixture for %s %s' % (self.command, url)
+        else:
+            status, headers, body = found
+        with server.lock:
+            server.requests.append((self.command, url))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        for i in range(0, len(body), WRITE_CHUNK):
+            chunk = body[i:i + WRITE_CHUNK]
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(len(chunk) / float(server.bandwidth))
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FixtureServer(object):
+    def __init__(self, store, latency=0.0, bandwidth=None):
+        """
+        Serves the responses in a `class` FixtureStore from localhost, one
+        thread per connection.
+
+        :param store: the `class` FixtureStore
+        :param float latency: seconds to wait before every response
+        :param int bandwidth: bytes a second each response body is sent at,
+        None for as fast as possible
+        """
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.httpd.store = store
+        self.httpd.latency = latency
+        self.httpd.bandwidth = bandwidth
+        self.httpd.requests = []
+        self.httpd.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    @property
+    def requests(self):
+        """
+        (method, url) for every request served so far
+        """
+        with self.httpd.lock:
+            return list(self.httpd.requests)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05},
+                                       name='fixture-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def session(self, **kwargs):
+        """
+        Returns an `class` HttpSession that sends every request to this
+        server instead of the real host. Nothing is rate limited unless a
+        limiter is passed in.
+        """
+        if 'limiter' not in kwargs:
+            kwargs['limiter'] = RateLimiter(default_rate=None)
+            kwargs['limiter'].set_rate(REDDIT_HOST, None)
+        kwargs.setdefault('retries', 0)
+        session = HttpSession(**kwargs)
+        adapter = ReplayAdapter(self.base_url,
+                                pool_maxsize=kwargs.get('pool_maxsize', 10))
+        session.session.mount('http://', adapter)
+        session.session.mount('https://', adapter)
+        return session
+
+
+class ReplayAdapter(HTTPAdapter):
+    def __init__(self, base_url, **kwargs):
+        """
+        Sends every request to the fixture server with the original url in
+        a header
+        """
+        HTTPAdapter.__init__(self, **kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = request.url
+        request.headers[URL_HEADER] = url
+        request.url = self.base_url + '/'
+        kwargs.pop('proxies', None)
+        resp = HTTPAdapter.send(self, request, **kwargs)
+        resp.url = request.url = url
+        return resp
@@ -0,0 +1,48 @@
+import time
+import threading
+import unittest
+
+from acquisition import AcquisitionEngine
+
+
+class TestAcquisitionEngine(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+        self.done = []
+
+    def task(self, host, n):
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0),
+                                  self.running[host])
+        time.sleep(0.01)
+        with self.lock:
+            self.running[host] -= 1
+            self.done.append(n)
+
+    def test_per_host_limit(self):
+        engine = AcquisitionEngine(workers=6, per_host=2)
+        for n in range(12):
+            host = 'imgur.com' if n % 2 else 'deviantart.com'
+            engine.submit(host, self.task, host, n)
+        engine.shutdown()
+        self.assertEqual(sorted(self.done), range(12))
+        self.assertEqual(self.peak['imgur.com'], 2)
+        self.assertEqual(self.peak['deviantart.com'], 2)
+
+    def test_synchronous_without_workers(self):
+        engine = AcquisitionEngine(workers=0)
+        engine.submit('imgur.com', self.task, 'imgur.com', 1)
+        self.assertEqual(self.done, [1])
+
+    def test_failing_task_does_not_stall_join(self):
+        engine = AcquisitionEngine(workers=2)
+
+        def boom():
+            raise ValueError('boom')
+        engine.submit('imgur.com', boom)
+        engine.submit('imgur.com', self.task, 'imgur.com', 1)
+        engine.shutdown()
+        self.assertEqual(self.done, [1])
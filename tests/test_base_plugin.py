@@ -0,0 +1,349 @@
+import os
+import re
+import hashlib
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from PIL import Image
+from requests.structures import CaseInsensitiveDict
+
+from data_types import Download
+from database import Database, DedupIndex, CopyIndex, WriteBuffer, \
+    TEMP_PREFIX
+from metrics import metrics
+from perceptual import NearDuplicateIndex, KEEP_LARGER
+from acquisition import AcquisitionEngine
+from plugins.base_plugin import BasePlugin, Selector, select, js_literal, \
+    Fetcher
+
+
+def png_bytes(color):
+    out = StringIO()
+    Image.new('RGB', (4, 3), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, body=''):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, head=None, get=None):
+        self.responses = {'HEAD': head, 'GET': get}
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, kwargs))
+        return self.responses[method]
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def methods(self):
+        return [c[0] for c in self.calls]
+
+
+class NullPlugin(BasePlugin):
+    def execute(self):
+        pass
+
+
+class TestAcquisitionTasks(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.output = os.path.join(self.tmp, 'out')
+        os.mkdir(self.output)
+        self.dedup = DedupIndex(Database('test'))
+        self.image = png_bytes('red')
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def fetch(self, session, name='a.png', **kwargs):
+        plugin = NullPlugin('test', [], self.output, dedup=self.dedup,
+                            session=session, **kwargs)
+        download = Download('t', 'wallpapers', 'http://i.imgur.com/' + name)
+        plugin.acquisition_tasks(download, download)
+        return plugin
+
+    def image_response(self, headers=None, image=None):
+        image = image or self.image
+        all_headers = {'content-type': 'image/png',
+                       'content-length': str(len(image))}
+        all_headers.update(headers or {})
+        return FakeResponse(200, all_headers, image)
+
+    def test_preflight_rejects_without_downloading(self):
+        for head in [FakeResponse(404),
+                     FakeResponse(200, {'content-type': 'text/html'}),
+                     FakeResponse(200, {'content-type': 'image/png',
+                                        'content-length': '5000'})]:
+            session = FakeSession(head, self.image_response())
+            plugin = self.fetch(session, max_image_size=1000, preflight=True)
+            self.assertEqual(session.methods(), ['HEAD'])
+            self.assertEqual(len(plugin.unhandled), 1)
+
+    def test_head_not_supported_falls_through_to_get(self):
+        session = FakeSession(FakeResponse(405), self.image_response())
+        plugin = self.fetch(session, preflight=True)
+        self.assertEqual(session.methods(), ['HEAD', 'GET'])
+        self.assertEqual(len(plugin.handled), 1)
+
+    def test_without_preflight(self):
+        session = FakeSession(None, self.image_response())
+        plugin = self.fetch(session, preflight=False)
+        self.assertEqual(session.methods(), ['GET'])
+        self.assertEqual(len(plugin.handled), 1)
+
+    def test_error_status_is_not_saved(self):
+        session = FakeSession(None, FakeResponse(
+            404, {'content-type': 'image/png'}, self.image))
+        plugin = self.fetch(session, preflight=False)
+        self.assertEqual(len(plugin.unhandled), 1)
+        self.assertEqual(os.listdir(self.output), [])
+
+    def test_size_cap_aborts_and_removes_the_temp_file(self):
+        #no content-length, so it is only caught while streaming
+        session = FakeSession(None, FakeResponse(
+            200, {'content-type': 'image/png'}, self.image))
+        plugin = self.fetch(session, preflight=False,
+                            max_image_size=len(self.image) - 1)
+        self.assertEqual(plugin.handled, [])
+        self.assertEqual(len(plugin.unhandled), 1)
+        self.assertEqual(os.listdir(self.output), [])
+
+    def test_temp_file_is_renamed_into_the_output_directory(self):
+        plugin = NullPlugin('test', [], self.output, dedup=self.dedup)
+        download = Download('t', 'wallpapers', 'http://i.imgur.com/a.png?1')
+        tmp_path = plugin.stream_to_temp(self.image_response(), download)
+        self.assertEqual(os.path.dirname(tmp_path), self.output)
+        self.assertTrue(os.path.basename(tmp_path).startswith(TEMP_PREFIX))
+        plugin.save_img(download, tmp_path)
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertEqual(os.listdir(self.output), ['a.png'])
+        with open(os.path.join(self.output, 'a.png'), 'rb') as f:
+            self.assertEqual(f.read(), self.image)
+        #a name that is taken gets a number rather than being overwritten
+        download = Download('t', 'wallpapers', 'http://i.imgur.com/a.png')
+        plugin.save_img(download, plugin.stream_to_temp(
+            self.image_response(), download))
+        self.assertEqual(sorted(os.listdir(self.output)),
+                         ['a.png', download.filename])
+        self.assertNotEqual(download.filename, 'a.png')
+
+    def test_records_dimensions(self):
+        plugin = self.fetch(FakeSession(None, self.image_response()),
+                            preflight=False)
+        download = plugin.handled[0]
+        self.assertEqual((download.width, download.height), (4, 3))
+        self.assertEqual(download.file_size, len(self.image))
+
+    def test_rejects_small_mislabeled_and_truncated_images(self):
+        bad = [(self.image, {'min_width': 1920}),
+               ('<html>Not found</html>', {}),
+               (self.image[:-20], {})]
+        for body, kwargs in bad:
+            session = FakeSession(None, FakeResponse(
+                200, {'content-type': 'image/png'}, body))
+            plugin = self.fetch(session, preflight=False, **kwargs)
+            self.assertEqual(plugin.handled, [])
+            self.assertEqual(len(plugin.unhandled), 1)
+            self.assertEqual(os.listdir(self.output), [])
+
+    def test_duplicate_is_refetched_conditionally(self):
+        self.dedup.add_md5(hashlib.md5(self.image).hexdigest())
+        validators = {'etag': '"abc"',
+                      'last-modified': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+        self.fetch(FakeSession(None, self.image_response(validators)),
+                   preflight=False)
+        session = FakeSession(FakeResponse(304), None)
+        plugin = self.fetch(session, preflight=True)
+        self.assertEqual(session.methods(), ['HEAD'])
+        headers = session.calls[0][1]['headers']
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(plugin.unhandled, [])
+
+    def test_duplicate_body_is_discarded(self):
+        self.fetch(FakeSession(None, self.image_response()), 'a.png',
+                   preflight=False)
+        plugin = self.fetch(FakeSession(None, self.image_response()),
+                            'b.png', preflight=False)
+        self.assertEqual(plugin.handled, [])
+        #the temp file of the second went too
+        self.assertEqual(os.listdir(self.output), ['a.png'])
+
+    def test_duplicate_found_by_one_plugin_is_skipped_by_another(self):
+        #nothing is written to the database until the end of the run, so
+        # only the shared index knows the first plugin saved it
+        writer = WriteBuffer(self.dedup.database, max_rows=1000,
+                             max_delay=3600)
+        first, second = [
+            NullPlugin('test', [], self.output, dedup=self.dedup,
+                       session=FakeSession(None, self.image_response()),
+                       writer=writer, preflight=False) for _ in range(2)]
+        for plugin, name in [(first, 'a.png'), (second, 'b.png')]:
+            download = Download('t', 'wallpapers', 'http://i.imgur.com/' +
+                                name)
+            plugin.acquisition_tasks(download, download)
+        self.assertEqual([d.filename for d in first.handled], ['a.png'])
+        self.assertEqual(second.handled, [])
+        self.assertEqual(os.listdir(self.output), ['a.png'])
+        writer.close()
+
+    def test_duplicate_with_no_copy_left_is_saved(self):
+        copies = CopyIndex(self.dedup.database)
+        md5 = hashlib.md5(self.image).hexdigest()
+        self.dedup.add_md5(md5)
+        metrics.reset()
+        self.fetch(FakeSession(None, self.image_response()), preflight=False,
+                   copies=copies)
+        self.assertEqual(os.listdir(self.output), ['a.png'])
+        self.assertEqual(copies.place(md5, self.output), 'a.png')
+        self.assertEqual(metrics.total('images', result='duplicate_saved'), 1)
+        self.assertEqual(metrics.total('images', result='duplicate'), 0)
+
+    def test_bigger_near_duplicate_replaces_the_saved_image(self):
+        near = NearDuplicateIndex(self.dedup.database, policy=KEEP_LARGER)
+        pattern = Image.new('L', (2, 2))
+        pattern.putdata([0, 255, 128, 64])
+        for name, size in [('small.png', (40, 30)), ('big.png', (80, 60))]:
+            out = StringIO()
+            pattern.resize(size, Image.BILINEAR).save(out, 'PNG')
+            session = FakeSession(None, self.image_response(
+                image=out.getvalue()))
+            self.fetch(session, name, preflight=False, near_duplicates=near)
+        self.assertEqual(os.listdir(self.output), ['big.png'])
+
+
+class ChunkedResponse(FakeResponse):
+    """
+    Serves a page in small chunks and counts how many were read
+    """
+    def __init__(self, body, headers=None):
+        FakeResponse.__init__(self, 200, headers or {}, body)
+        self.read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for chunk in FakeResponse.iter_content(self, 64):
+            self.read += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class TestSelect(unittest.TestCase):
+    page = ('<html><head><title>A page</title>'
+            '<meta name="og:image" content="http://i.imgur.com/a.png">'
+            '<link rel="image_src" href="//i.imgur.com/b.png"></head><body>'
+            + '<p>filler</p>' * 500 +
+            '<a class="big thumb" href="/1">1</a><a class="thumb2" href="/2">'
+            '2</a><div id="photo"><span><a href="/3">3</a></span></div>'
+            '</body></html>')
+
+    def test_values_in_page_order(self):
+        title = Selector('title', 'string()')
+        thumbs = Selector('a', '@href', {'class': ('thumb', 'other')})
+        photo = Selector(None, 'descendant::a[1]/@href', {'id': 'photo'})
+        found = list(select(ChunkedResponse(self.page), title, thumbs, photo))
+        self.assertEqual(found, [(title, 'A page'), (thumbs, '/1'),
+                                 (photo, '/3')])
+
+    def test_stops_reading_once_done(self):
+        resp = ChunkedResponse(self.page)
+        for _, content in select(resp, Selector('meta', '@content')):
+            break
+        self.assertEqual(content, 'http://i.imgur.com/a.png')
+        self.assertTrue(resp.closed)
+        self.assertEqual(resp.read, 2)
+        resp = ChunkedResponse(self.page)
+        links = Selector('head', './/link/@href', final=True)
+        missing = Selector('head', './/script/@src', final=True)
+        self.assertEqual(list(select(resp, links)),
+                         [(links, '//i.imgur.com/b.png')])
+        self.assertEqual(list(select(ChunkedResponse(self.page), missing)),
+                         [])
+        self.assertTrue(resp.read < 10)
+
+    def test_charset_from_the_header(self):
+        page = u'<title>caf\xe9</title>'.encode('utf-8')
+        resp = ChunkedResponse(page, {'content-type':
+                                      'text/html; charset=utf-8'})
+        self.assertEqual(list(select(resp, Selector('title', 'string()')))
+                         [0][1], u'caf\xe9')
+        self.assertEqual(list(select(ChunkedResponse(''), Selector('a'))), [])
+
+
+class TestJsLiteral(unittest.TestCase):
+    start = re.compile(r'var album\s*=\s*')
+
+    def test_json(self):
+        page = 'var album = [{"hash": "a", "ext": ".jpg"}, {"hash": "b"}];'
+        self.assertEqual(js_literal(page, self.start),
+                         [{'hash': 'a', 'ext': '.jpg'}, {'hash': 'b'}])
+
+    def test_javascript(self):
+        page = ("var album = {hash: 'it\\'s \"b\"', ext: '.png', "
+                "size: undefined, tags: ['x', 'y',], s: 'a: {'};\n"
+                "Imgur.init(album);")
+        self.assertEqual(js_literal(page, self.start),
+                         {'hash': 'it\'s "b"', 'ext': '.png', 'size': None,
+                          'tags': ['x', 'y'], 's': 'a: {'})
+
+    def test_nothing_to_parse(self):
+        for page in ['var other = [1];', 'var album = [1, 2', 'var album = x',
+                     'var album = alert(1)']:
+            self.assertEqual(js_literal(page, self.start), None)
+
+
+class TestFetcher(unittest.TestCase):
+    def fetch(self, acquirer):
+        def page(url):
+            return ['http://b.com/%s/%d' % (url[-1], n) for n in range(3)]
+
+        def image(url):
+            if url.endswith('/2'):
+                raise ValueError('no image')
+            return url + '.png'
+        fetcher = Fetcher(acquirer)
+        for n in range(3):
+            fetcher.submit(page, 'http://a.com/%d' % n)
+        images = []
+        for func, url, result in fetcher.results():
+            if func == page:
+                for link in result:
+                    fetcher.submit(image, link)
+            else:
+                images.append(result)
+        return sorted(images)
+
+    def test_follow_ups_and_failures(self):
+        expected = ['http://b.com/%d/%d.png' % (p, n)
+                    for p in range(3) for n in range(2)]
+        self.assertEqual(self.fetch(None), expected)
+        acquirer = AcquisitionEngine(workers=3)
+        try:
+            self.assertEqual(self.fetch(acquirer), expected)
+        finally:
+            acquirer.shutdown()
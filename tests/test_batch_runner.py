@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import batch_runner
+from batch_runner import BatchRunner
+from journal import Journal, FAILED
+from tests.test_pipeline import FakeRedditConnect, FakeSession
+
+
+class TestBatchRunner(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.log = []
+        self.logins = []
+        log, logins = self.log, self.logins
+
+        class Reddit(FakeRedditConnect):
+            def __init__(self, username, password, session=None):
+                FakeRedditConnect.__init__(self, 2, 4, log)
+                self.username = username
+
+            def login(self):
+                logins.append(self.username)
+                if self.username == 'broken':
+                    raise ValueError('bad password')
+
+        self.original = batch_runner.RedditConnect
+        batch_runner.RedditConnect = Reddit
+
+    def tearDown(self):
+        batch_runner.RedditConnect = self.original
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, accounts):
+        return BatchRunner(accounts, 'test', session=FakeSession(self.log),
+                           workers=0, preflight=False).run()
+
+    def gets(self):
+        return [e[1] for e in self.log if e[0] == 'get']
+
+    def test_shared_images_are_downloaded_once(self):
+        self.run_batch([
+            {'username': 'a', 'password': '', 'subs': ['wallpapers'],
+             'output': 'a'},
+            {'username': 'b', 'password': '', 'subs': ['wallpapers'],
+             'output': 'b'}])
+        self.assertEqual(len(self.gets()), 4)
+        self.assertEqual(len(set(self.gets())), 4)
+        self.assertEqual(sorted(os.listdir('a')), sorted(os.listdir('b')))
+        for name in os.listdir('a'):
+            self.assertEqual(open(os.path.join('a', name), 'rb').read(),
+                             open(os.path.join('b', name), 'rb').read())
+            if hasattr(os, 'link'):
+                self.assertTrue(os.path.samefile(os.path.join('a', name),
+                                                 os.path.join('b', name)))
+
+    def test_missing_copy_is_linked_on_a_later_run(self):
+        accounts = [{'username': 'a', 'password': '',
+                     'subs': ['wallpapers'], 'output': 'a',
+                     'mode': 'backfill'}]
+        self.run_batch(accounts)
+        accounts.append({'username': 'b', 'password': '',
+                         'subs': ['wallpapers'], 'output': 'b'})
+        del self.log[:]
+        self.run_batch(accounts)
+        self.assertEqual(self.gets(), [])
+        self.assertEqual(len(os.listdir('b')), 4)
+
+    def test_failed_account_does_not_stop_the_rest(self):
+        failed = self.run_batch([
+            {'username': 'broken', 'password': '', 'subs': ['wallpapers'],
+             'output': 'x'},
+            {'username': 'b', 'password': '', 'subs': ['wallpapers'],
+             'output': 'b'}])
+        self.assertEqual(failed, ['broken'])
+        self.assertEqual(self.logins, ['broken', 'b'])
+        self.assertEqual(len(os.listdir('b')), 4)
+
+    def test_failed_posts_are_retried_by_their_own_account(self):
+        journal = Journal('test_a_journal.log')
+        journal.post('http://i.imgur.com/101.png', FAILED, reason='boom',
+                     title='t', subreddit='wallpapers')
+        journal.close()
+        self.run_batch([
+            {'username': 'a', 'password': '', 'subs': ['wallpapers'],
+             'output': 'a'},
+            {'username': 'b', 'password': '', 'subs': ['pics'],
+             'output': 'b'}])
+        self.assertEqual(self.gets().count('http://i.imgur.com/101.png'), 1)
+        self.assertTrue('101.png' in os.listdir('a'))
+        self.assertFalse('101.png' in os.listdir('b'))
+        self.assertTrue(os.path.exists('test_b_journal.log'))
+        self.assertFalse(os.path.exists('test_journal.log'))
@@ -0,0 +1,65 @@
+import unittest
+
+from data_types import CandidatesList, DownloadList, Download
+
+
+class TestDownload(unittest.TestCase):
+    def test_equal_downloads_hash_the_same(self):
+        a = Download('title', 'wallpapers', 'http://i.imgur.com/a.jpg')
+        b = Download('title', 'wallpapers', 'http://i.imgur.com/a.jpg')
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len(set([a, b])), 1)
+
+    def test_different_subreddit_is_not_equal(self):
+        a = Download('title', 'wallpapers', 'http://i.imgur.com/a.jpg')
+        b = Download('title', 'multiscreen', 'http://i.imgur.com/a.jpg')
+        self.assertNotEqual(a, b)
+
+    def test_slots(self):
+        d = Download('title', 'wallpapers', 'http://i.imgur.com/a.jpg')
+        self.assertRaises(AttributeError, setattr, d, 'resp', None)
+
+
+class TestCandidatesList(unittest.TestCase):
+    def setUp(self):
+        self.downloads = [Download('t%d' % i, 'wallpapers',
+                                   'http://i.imgur.com/%d.jpg' % i)
+                          for i in range(5)]
+        self.candidates = CandidatesList(self.downloads)
+
+    def test_contains_url_and_download(self):
+        self.assertTrue('http://i.imgur.com/3.jpg' in self.candidates)
+        self.assertTrue(self.downloads[3] in self.candidates)
+        self.assertFalse('http://i.imgur.com/9.jpg' in self.candidates)
+
+    def test_remove_by_url(self):
+        self.candidates.remove('http://i.imgur.com/1.jpg')
+        self.assertEqual(len(self.candidates), 4)
+        self.assertFalse(self.downloads[1] in self.candidates)
+
+    def test_remove_missing_is_noop(self):
+        self.candidates.remove('http://i.imgur.com/9.jpg')
+        self.assertEqual(len(self.candidates), 5)
+
+    def test_remove_while_iterating(self):
+        seen = []
+        for c in self.candidates:
+            seen.append(c)
+            self.candidates.remove(c)
+            self.candidates.remove(self.downloads[4])
+        self.assertEqual(seen, self.downloads[:4])
+        self.assertEqual(len(self.candidates), 0)
+
+
+class TestDownloadList(unittest.TestCase):
+    def test_contains_matches_urls_and_downloads(self):
+        dl = Download('title', 'wallpapers', 'http://i.imgur.com/a.jpg')
+        downloads = DownloadList(['http://i.imgur.com/b.jpg'])
+        downloads.append(dl)
+        self.assertTrue('http://i.imgur.com/b.jpg' in downloads)
+        self.assertTrue(Download('other', 'wallpapers',
+                                 'http://i.imgur.com/b.jpg') in downloads)
+        self.assertTrue(Download('title', 'wallpapers',
+                                 'http://i.imgur.com/a.jpg') in downloads)
+        self.assertFalse('http://i.imgur.com/c.jpg' in downloads)
@@ -0,0 +1,179 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import sqlalchemy.sql as sql
+
+from data_types import Download
+from database import Database, DedupIndex, WriteBuffer, CopyIndex, \
+    TEMP_PREFIX, TEMP_SUFFIX, MIGRATIONS, OPEN_BUFFERS, file_md5
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.database = Database('test')
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def count(self, table):
+        conn = self.database.engine.connect()
+        return len(conn.execute(sql.select([table])).fetchall())
+
+    def download(self, n):
+        dl = Download('title %d' % n, 'wallpapers',
+                      'http://i.imgur.com/%d.jpg' % n)
+        dl.md5 = '%032x' % n
+        return dl
+
+
+class TestWriteBuffer(DatabaseTestCase):
+    def test_flushes_in_batches(self):
+        writer = WriteBuffer(self.database, max_rows=3, max_delay=None)
+        for n in range(2):
+            writer.add_wallpaper(self.download(n))
+        self.assertEqual(self.count(self.database.wallpapers), 0)
+        writer.add_retrieved('http://imgur.com/a/1')
+        self.assertEqual(self.count(self.database.wallpapers), 2)
+        self.assertEqual(self.count(self.database.retrieved), 1)
+
+    def test_close_flushes(self):
+        writer = WriteBuffer(self.database, max_rows=100, max_delay=60)
+        writer.add_wallpaper(self.download(1))
+        writer.close()
+        self.assertEqual(self.count(self.database.wallpapers), 1)
+
+    def test_duplicates_do_not_lose_the_batch(self):
+        writer = WriteBuffer(self.database, max_rows=1)
+        writer.add_wallpaper(self.download(1))
+        writer.add_wallpaper(self.download(1))
+        self.assertEqual(self.count(self.database.wallpapers), 1)
+
+    def test_flushed_at_exit_until_closed(self):
+        writer = WriteBuffer(self.database, max_rows=100, max_delay=None)
+        self.assertTrue(writer in OPEN_BUFFERS)
+        writer.close()
+        self.assertFalse(writer in OPEN_BUFFERS)
+
+    def test_wal_mode(self):
+        conn = self.database.engine.connect()
+        mode = conn.execute('PRAGMA journal_mode').scalar()
+        self.assertEqual(mode, 'wal')
+
+
+class TestCopyIndex(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        for output_dir in ('a', 'b', 'c'):
+            os.mkdir(output_dir)
+
+    def save(self, copies, n, output_dir, filename, body):
+        with open(os.path.join(output_dir, filename), 'wb') as f:
+            f.write(body)
+        download = self.download(n)
+        download.filename = filename
+        copies.add(download, output_dir)
+        return download
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_place_links_an_existing_copy(self):
+        copies = CopyIndex(self.database)
+        old = self.save(copies, 1, 'a', 'x.png', 'old')
+        self.assertEqual(copies.place(old.md5, 'b'), 'x.png')
+        self.assertEqual(copies.place(old.md5, 'b'), 'x.png')
+        self.assertEqual(self.read('b/x.png'), 'old')
+        self.assertEqual(copies.place(self.download(2).md5, 'b'), None)
+
+    def test_replace_relinks_copies_in_other_directories(self):
+        copies = CopyIndex(self.database)
+        old = self.save(copies, 1, 'a', 'x.png', 'old')
+        copies.place(old.md5, 'b')
+        new = self.save(copies, 2, 'a', 'y.png', 'bigger')
+        os.remove('a/x.png')
+        placed = copies.replace(old.md5, new.md5, 'a/y.png')
+        self.assertEqual(placed, [os.path.abspath('b/y.png')])
+        self.assertEqual(os.listdir('a'), ['y.png'])
+        self.assertEqual(os.listdir('b'), ['y.png'])
+        self.assertEqual(self.read('b/y.png'), 'bigger')
+        self.assertEqual(copies.place(old.md5, 'c'), None)
+        self.assertEqual(copies.place(new.md5, 'c'), 'y.png')
+
+
+class TestReconcile(DatabaseTestCase):
+    def test_records_unknown_files_and_removes_temp_files(self):
+        output = os.path.join(self.tmp, 'out')
+        os.makedirs(output)
+        writer = WriteBuffer(self.database, max_rows=1)
+        known = self.download(1)
+        known.filename = 'known.jpg'
+        writer.add_wallpaper(known)
+        for name in ['known.jpg', 'unflushed.jpg',
+                     TEMP_PREFIX + 'abc' + TEMP_SUFFIX]:
+            with open(os.path.join(output, name), 'wb') as f:
+                f.write(name)
+        self.assertEqual(self.database.reconcile(output), 1)
+        self.assertEqual(sorted(os.listdir(output)),
+                         ['known.jpg', 'unflushed.jpg'])
+        dedup = DedupIndex(self.database)
+        self.assertTrue(known.md5 in dedup.md5s)
+        self.assertTrue(file_md5(os.path.join(output, 'unflushed.jpg')) in
+                        dedup.md5s)
+        self.assertEqual(self.database.reconcile(output), 0)
+
+
+class TestMigrations(DatabaseTestCase):
+    def test_upgrades_original_schema_in_place(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        conn = sqlite3.connect('old_downloaded.db')
+        conn.execute('CREATE TABLE wallpapers (subreddit VARCHAR, '
+                     'title VARCHAR, url VARCHAR, filename VARCHAR, '
+                     'md5 VARCHAR NOT NULL, PRIMARY KEY (md5))')
+        conn.execute('CREATE TABLE retrieved (image_url VARCHAR NOT NULL, '
+                     'PRIMARY KEY (image_url))')
+        conn.execute("INSERT INTO wallpapers VALUES ('wallpapers', 'title', "
+                     "'http://i.imgur.com/a.jpg', 'a.jpg', 'abc')")
+        conn.commit()
+        conn.close()
+        database = Database('old')
+        self.assertEqual(database.schema_version(), len(MIGRATIONS))
+        dedup = DedupIndex(database)
+        self.assertTrue('abc' in dedup.md5s)
+        self.assertTrue(dedup.already_acquired('http://i.imgur.com/a.jpg'))
+        conn = database.engine.connect()
+        plan = ' '.join(str(r) for r in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT url FROM wallpapers WHERE url = 'x'"))
+        self.assertTrue('ix_wallpapers_url' in plan)
+
+    def test_migrating_twice_is_harmless(self):
+        self.database.migrate()
+        Database('test')
+        self.assertEqual(self.database.schema_version(), len(MIGRATIONS))
+
+
+class TestDedupIndex(DatabaseTestCase):
+    def test_add_md5_is_only_new_once(self):
+        writer = WriteBuffer(self.database, max_rows=1)
+        writer.add_wallpaper(self.download(1))
+        dedup = DedupIndex(self.database)
+        self.assertFalse(dedup.add_md5(self.download(1).md5))
+        self.assertTrue(dedup.add_md5('new'))
+        self.assertFalse(dedup.add_md5('new'))
+
+    def test_prefetch_remembers_misses(self):
+        dedup = DedupIndex(self.database)
+        dedup.prefetch(['http://i.imgur.com/1.jpg'])
+        self.assertFalse(dedup.already_acquired('http://i.imgur.com/1.jpg'))
+        dedup.add_post('http://i.imgur.com/1.jpg')
+        self.assertTrue(dedup.already_acquired('http://i.imgur.com/1.jpg'))
@@ -0,0 +1,77 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from data_types import Download
+from plugin_interface import PluginInterface
+from tests.http_fixtures import FixtureStore, FixtureServer, \
+    RecordingSession, ReplayAdapter
+from tests.test_base_plugin import png_bytes
+
+
+class TestFixtures(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.store = FixtureStore()
+        self.store.add('http://www.reddit.com/user/me/liked.json',
+                       '{"data": {}}', 'application/json')
+        for n in range(3):
+            self.store.add('http://i.imgur.com/%d.png' % n,
+                           png_bytes((n, 0, 0)), 'image/png')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def serve(self, store, **kwargs):
+        server = FixtureServer(store, **kwargs).start()
+        self.servers.append(server)
+        return server
+
+    def test_record_and_replay(self):
+        recorder = RecordingSession(FixtureStore('fixtures'))
+        adapter = ReplayAdapter(self.serve(self.store).base_url)
+        recorder.session.mount('http://', adapter)
+        url = 'http://www.reddit.com/user/me/liked.json'
+        self.assertEqual(recorder.get(url).text, '{"data": {}}')
+        self.assertEqual(recorder.get('http://i.imgur.com/9.png')
+                         .status_code, 404)
+
+        replay = self.serve(FixtureStore('fixtures')).session()
+        resp = replay.get(url)
+        self.assertEqual((resp.status_code, resp.text, resp.url),
+                         (200, '{"data": {}}', url))
+        self.assertEqual(resp.headers['content-type'], 'application/json')
+        self.assertEqual(replay.head(url).status_code, 200)
+        self.assertEqual(replay.get('http://i.imgur.com/9.png').status_code,
+                         404)
+
+    def test_latency_and_bandwidth(self):
+        self.store.add('http://example.com/big', 'x' * 20000)
+        session = self.serve(self.store, latency=0.1,
+                             bandwidth=100000).session()
+        start = time.time()
+        self.assertEqual(len(session.get('http://example.com/big').content),
+                         20000)
+        self.assertTrue(time.time() - start >= 0.25)
+
+    def test_acquire_end_to_end(self):
+        server = self.serve(self.store)
+        candidates = [Download('t', 'wallpapers',
+                               'http://i.imgur.com/%d.png' % n)
+                      for n in range(3)]
+        pi = PluginInterface('test', candidates, 'out', workers=2,
+                             session=server.session())
+        pi.acquire()
+        self.assertEqual(len(pi.handled), 3)
+        self.assertEqual(sorted(os.listdir('out')),
+                         ['0.png', '1.png', '2.png'])
+        self.assertEqual(len([r for r in server.requests
+                              if r[0] == 'GET']), 3)
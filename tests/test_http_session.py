@@ -0,0 +1,85 @@
+import unittest
+
+import requests
+
+from http_session import HttpSession
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, FakeResponse):
+            return outcome
+        return FakeResponse(outcome)
+
+
+class TestHttpSession(unittest.TestCase):
+    def make_session(self, outcomes, **kwargs):
+        session = HttpSession(backoff=0, **kwargs)
+        session.session = FakeSession(outcomes)
+        return session
+
+    def test_retries_server_errors(self):
+        session = self.make_session([503, 502, 200])
+        self.assertEqual(session.get('http://imgur.com/').status_code, 200)
+        self.assertEqual(len(session.session.calls), 3)
+
+    def test_gives_up_after_retries(self):
+        session = self.make_session([500, 500, 500], retries=2)
+        self.assertEqual(session.get('http://imgur.com/').status_code, 500)
+
+    def test_retries_connection_errors_on_get(self):
+        session = self.make_session([requests.ConnectionError(), 200])
+        self.assertEqual(session.get('http://imgur.com/').status_code, 200)
+
+    def test_does_not_retry_post_on_connection_error(self):
+        session = self.make_session([requests.ConnectionError(), 200])
+        self.assertRaises(requests.ConnectionError, session.post,
+                          'https://ssl.reddit.com/api/login/')
+
+    def test_retries_post_only_when_refused_with_retry_after(self):
+        for status in (500, 502, 503, 429):
+            session = self.make_session([status, 200])
+            self.assertEqual(session.post('https://oauth.reddit.com/api/'
+                                          'vote').status_code, status)
+            self.assertEqual(len(session.session.calls), 1)
+        session = self.make_session(
+            [FakeResponse(503, {'retry-after': '0'}), 200])
+        self.assertEqual(session.post('https://oauth.reddit.com/api/'
+                                      'vote').status_code, 200)
+        self.assertEqual(len(session.session.calls), 2)
+
+    def test_timeout_and_host_cookies(self):
+        session = self.make_session([200], timeout=(1, 2))
+        session.set_cookies('www.deviantart.com', {'a': '1'})
+        session.get('http://www.deviantart.com/art/1', cookies={'b': '2'})
+        kwargs = session.session.calls[0][2]
+        self.assertEqual(kwargs['timeout'], (1, 2))
+        self.assertEqual(kwargs['cookies'], {'a': '1', 'b': '2'})
+
+    def test_retries_too_many_requests_after_retry_after(self):
+        session = self.make_session(
+            [FakeResponse(429, {'retry-after': '0'}), 200])
+        self.assertEqual(session.get('http://imgur.com/').status_code, 200)
+        self.assertEqual(len(session.session.calls), 2)
+
+    def test_backoff_is_capped(self):
+        session = HttpSession(backoff=1, max_backoff=4)
+        for attempt in range(10):
+            self.assertTrue(0 <= session.delay(attempt) <= 4)
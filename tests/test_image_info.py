@@ -0,0 +1,53 @@
+import unittest
+from StringIO import StringIO
+
+from PIL import Image
+
+from image_info import parse_header, check_complete, sniff, ImageError, \
+    TAIL_SIZE
+
+
+def encode(image_format, size=(64, 48), **kwargs):
+    out = StringIO()
+    Image.new('RGB', size, 'blue').save(out, image_format, **kwargs)
+    return out.getvalue()
+
+
+class TestParseHeader(unittest.TestCase):
+    def test_dimensions_of_every_format(self):
+        for image_format, kwargs in [('JPEG', {}),
+                                     ('JPEG', {'progressive': True}),
+                                     ('PNG', {}), ('GIF', {}), ('BMP', {}),
+                                     ('WEBP', {}),
+                                     ('WEBP', {'lossless': True})]:
+            data = encode(image_format, **kwargs)
+            info = parse_header(data, final=True)
+            self.assertEqual((info.width, info.height), (64, 48),
+                             '%s %r' % (image_format, kwargs))
+            self.assertEqual(info.format, image_format.lower())
+            check_complete(info, data[-TAIL_SIZE:], len(data))
+
+    def test_jpeg_dimensions_after_exif(self):
+        data = encode('JPEG', size=(1920, 1080), exif='Exif\x00\x00' +
+                      'x' * 20000)
+        self.assertEqual(parse_header(data[:100]), None)
+        info = parse_header(data[:21000])
+        self.assertEqual((info.width, info.height), (1920, 1080))
+
+    def test_needs_more_data(self):
+        data = encode('PNG')
+        self.assertEqual(parse_header(data[:10]), None)
+        self.assertRaises(ImageError, parse_header, data[:20], True)
+
+    def test_not_an_image(self):
+        self.assertEqual(sniff('<html><body>404</body></html>'), None)
+        self.assertRaises(ImageError, parse_header,
+                          '<html><body>404</body></html>')
+
+    def test_truncated(self):
+        for image_format in ['JPEG', 'PNG', 'GIF', 'BMP', 'WEBP']:
+            data = encode(image_format, size=(300, 200))
+            cut = data[:len(data) - 40]
+            info = parse_header(cut, final=True)
+            self.assertRaises(ImageError, check_complete, info,
+                              cut[-TAIL_SIZE:], len(cut))
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from data_types import Download
+from database import Database, DedupIndex
+from journal import Journal, POST, IMAGE, SAVED, FAILED, DOWNLOADING, \
+    MAX_FAILURES
+from plugin_interface import PluginInterface
+from plugins.base_plugin import BasePlugin
+from tests.test_base_plugin import FakeResponse
+from tests.test_pipeline import FakeSession
+
+
+class Gallery(BasePlugin):
+    def execute(self):
+        for n in (1, 2):
+            self.current = Download('t', 'wallpapers',
+                                    'http://i.imgur.com/%d.png' % n)
+
+
+class BrokenSession(FakeSession):
+    def get(self, url, **kwargs):
+        if url.endswith('/2.png'):
+            return FakeResponse(404)
+        return FakeSession.get(self, url, **kwargs)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.journal = Journal('test_journal.log')
+
+    def tearDown(self):
+        self.journal.close()
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def test_replay_keeps_the_last_state_and_skips_a_cut_off_line(self):
+        self.journal.image('http://a/1.png', DOWNLOADING)
+        self.journal.image('http://a/1.png', SAVED, md5='abc')
+        self.journal.close()
+        with open('test_journal.log', 'ab') as f:
+            f.write('{"kind":"image","url":"http://a/2.p')
+        state = Journal('test_journal.log').replay()
+        self.assertEqual(state.lines, 2)
+        self.assertEqual(state.last(IMAGE, 'http://a/1.png')['state'], SAVED)
+        self.assertEqual(state.last(IMAGE, 'http://a/2.png'), None)
+
+    def test_compact_keeps_only_recent_failed_posts(self):
+        self.journal.image('http://a/1.png', SAVED)
+        self.journal.image('http://a/2.png', FAILED, reason='HTTP 404')
+        self.journal.post('http://a/post', FAILED, reason='boom')
+        self.assertEqual(self.journal.compact(), 1)
+        self.assertEqual(self.journal.compact(failure_ttl=-1), 0)
+        self.assertEqual(os.path.getsize('test_journal.log'), 0)
+
+    def test_gives_up_on_a_post_that_keeps_failing(self):
+        for n in range(MAX_FAILURES):
+            self.assertEqual(len(self.journal.replay().retries()), min(n, 1))
+            self.journal.post('http://a/post', DOWNLOADING)
+            self.journal.post('http://a/post', FAILED, reason='boom')
+            #the count is kept through compacting
+            self.journal.compact()
+        self.assertEqual(self.journal.replay().retries(), [])
+        self.assertEqual(os.path.getsize('test_journal.log'), 0)
+
+    def run_gallery(self, session):
+        plugin = Gallery('test', [], 'out', session=session,
+                         preflight=False, journal=self.journal)
+        plugin.process_candidate(Download('t', 'wallpapers',
+                                          'http://example.com/gallery'))
+        plugin.add_to_previous_aquisitions()
+        conn = plugin.engine.connect()
+        posts = [r[0] for r in conn.execute('SELECT image_url FROM '
+                                            'retrieved')]
+        conn.close()
+        return posts
+
+    def test_gallery_is_finished_once_every_image_is(self):
+        os.mkdir('out')
+        self.assertEqual(self.run_gallery(BrokenSession([])), [])
+        state = self.journal.replay()
+        self.assertEqual(state.last(IMAGE, 'http://i.imgur.com/2.png')
+                         ['reason'], 'HTTP 404')
+        self.assertEqual(state.last(POST, 'http://example.com/gallery')
+                         ['state'], FAILED)
+        self.assertEqual(self.run_gallery(FakeSession([])),
+                         ['http://example.com/gallery'])
+
+    def test_resume_restores_what_a_killed_run_saved(self):
+        #a run that saved an image and died before its row was written
+        os.mkdir('out')
+        with open(os.path.join('out', '3.png'), 'wb') as f:
+            f.write('png')
+        self.journal.image('http://i.imgur.com/3.png', SAVED,
+                           post='http://i.imgur.com/3.png', md5='abc',
+                           filename='3.png', title='t',
+                           subreddit='wallpapers')
+        self.journal.close()
+        log = []
+        pi = PluginInterface('test', [Download('t', 'wallpapers',
+                                               'http://i.imgur.com/3.png')],
+                             'out', workers=0, session=FakeSession(log),
+                             preflight=False, journal='test_journal.log')
+        pi.acquire()
+        self.assertEqual(log, [])
+        conn = Database('test').engine.connect()
+        self.assertEqual(conn.execute('SELECT url, filename FROM '
+                                      'wallpapers').fetchall(),
+                         [('http://i.imgur.com/3.png', '3.png')])
+        conn.close()
+        self.assertEqual(os.path.getsize('test_journal.log'), 0)
+
+    def test_resume_retries_failed_posts(self):
+        self.journal.post('http://i.imgur.com/5.png', FAILED, reason='boom',
+                          title='t', subreddit='wallpapers')
+        self.journal.close()
+        log = []
+        pi = PluginInterface('test', [Download('t', 'wallpapers',
+                                               'http://i.imgur.com/6.png')],
+                             'out', workers=0, session=FakeSession(log),
+                             preflight=False, journal='test_journal.log')
+        pi.acquire()
+        self.assertEqual(log, [('get', 'http://i.imgur.com/5.png'),
+                               ('get', 'http://i.imgur.com/6.png')])
+        self.assertEqual(sorted(os.listdir('out')), ['5.png', '6.png'])
+        self.assertEqual(os.path.getsize('test_journal.log'), 0)
+
+    def test_kept_next_to_a_shared_database(self):
+        os.mkdir('data')
+        os.chdir('data')
+        dedup = DedupIndex(Database('shared'))
+        os.chdir(self.tmp)
+        pi = PluginInterface('shared', [], 'out', dedup=dedup)
+        self.assertEqual(pi.journal.path,
+                         os.path.join(self.tmp, 'data', 'shared_journal.log'))
+        self.assertEqual(pi.metrics_file,
+                         os.path.join(self.tmp, 'data', 'shared_metrics.json'))
@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from data_types import Download
+from metrics import Metrics, Histogram, metrics, setup_logging, get_logger, \
+    LOGGER_NAME
+from plugin_interface import PluginInterface
+from tests.test_pipeline import FakeSession
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_by_label(self):
+        m = Metrics()
+        m.inc('images', host='a.com', result='saved')
+        m.inc('images', 2, host='b.com', result='saved')
+        m.inc('images', host='a.com', result='failed')
+        self.assertEqual(m.value('images', host='b.com', result='saved'), 2)
+        self.assertEqual(m.total('images', result='saved'), 3)
+        self.assertEqual(m.total('images'), 4)
+        self.assertEqual(m.value('missing'), 0)
+
+    def test_histogram(self):
+        h = Histogram((1, 5, 10))
+        for value in (0.5, 2, 3, 4, 20):
+            h.observe(value)
+        self.assertEqual(h.cumulative(), [(1, 1), (5, 4), (10, 4)])
+        summary = h.summary()
+        self.assertEqual((summary['count'], summary['min'], summary['max']),
+                         (5, 0.5, 20))
+        self.assertEqual(summary['p50'], 5)
+        self.assertEqual(summary['p95'], 20)
+
+    def test_prometheus_textfile(self):
+        m = Metrics()
+        m.inc('images', host='a.com', result='saved')
+        m.observe('download_seconds', 0.2, (0.1, 1), host='a.com')
+        text = m.prometheus()
+        self.assertTrue('# TYPE reddit_scraper_images_total counter\n'
+                        'reddit_scraper_images_total{host="a.com",'
+                        'result="saved"} 1\n' in text)
+        self.assertTrue('reddit_scraper_download_seconds_bucket{host="a.com",'
+                        'le="0.1"} 0\n' in text)
+        self.assertTrue('reddit_scraper_download_seconds_bucket{host="a.com",'
+                        'le="+Inf"} 1\n' in text)
+        self.assertTrue('reddit_scraper_download_seconds_count{host="a.com"}'
+                        ' 1\n' in text)
+
+    def test_logging(self):
+        stream = StringIO()
+        handler = setup_logging(logging.WARNING, stream)
+        try:
+            get_logger('test').info('quiet')
+            get_logger('test').warning('loud %d', 1)
+        finally:
+            logging.getLogger(LOGGER_NAME).removeHandler(handler)
+        self.assertEqual(stream.getvalue().count('\n'), 1)
+        self.assertTrue('WARNING loud 1' in stream.getvalue())
+
+
+class TestRunMetrics(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        metrics.reset()
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def test_summary_written_at_the_end_of_a_run(self):
+        candidates = [Download('t', 'wallpapers',
+                               'http://i.imgur.com/%d.png' % n)
+                      for n in (1, 2, 2)]
+        pi = PluginInterface('test', candidates, 'out', workers=0,
+                             session=FakeSession([]), preflight=False,
+                             prometheus_file='test.prom')
+        pi.acquire()
+        with open('test_metrics.json') as f:
+            summary = json.load(f)
+        counters = dict(((c['name'], tuple(sorted(c['labels'].items()))),
+                         c['value']) for c in summary['counters'])
+        self.assertEqual(counters[('images', (('host', 'i.imgur.com'),
+                                              ('result', 'saved')))], 2)
+        self.assertEqual(counters[('candidates',
+                                   (('result', 'dispatched'),))], 2)
+        names = set(h['name'] for h in summary['histograms'])
+        self.assertTrue(set(['resolve_seconds', 'download_seconds',
+                             'db_flush_seconds']).issubset(names))
+        self.assertTrue(os.path.exists('test.prom'))
@@ -0,0 +1,113 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from data_types import Download
+from database import Database, WriteBuffer
+from perceptual import dhash, hamming, to_hex, backfill, BKTree, \
+    NearDuplicateIndex, SKIP, KEEP_LARGER
+
+
+def noise(seed, size=(96, 64)):
+    rand = random.Random(seed)
+    image = Image.new('L', (12, 8))
+    image.putdata([rand.randint(0, 255) for i in range(96)])
+    return image.resize(size, Image.BILINEAR).convert('RGB')
+
+
+class PerceptualTestCase(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def save(self, image, name, **kwargs):
+        path = os.path.join(self.tmp, name)
+        image.save(path, **kwargs)
+        return path
+
+    def download(self, name, path, md5):
+        dl = Download('t', 'wallpapers', 'http://i.imgur.com/' + name)
+        dl.filename = name
+        dl.md5 = md5
+        dl.width, dl.height = Image.open(path).size
+        return dl
+
+
+class TestHashing(PerceptualTestCase):
+    def test_resized_and_recompressed_copies_are_close(self):
+        original = dhash(self.save(noise(1), 'a.png'))
+        copy = dhash(self.save(noise(1, (192, 128)), 'b.jpg', quality=40))
+        other = dhash(self.save(noise(2), 'c.png'))
+        self.assertTrue(hamming(original, copy) <= 6)
+        self.assertTrue(hamming(original, other) > 10)
+
+    def test_bk_tree_matches_brute_force(self):
+        rand = random.Random(0)
+        values = [rand.getrandbits(64) for i in range(2000)]
+        tree = BKTree()
+        for i, value in enumerate(values):
+            tree.add(value, i)
+        self.assertEqual(len(tree), 2000)
+        for query in values[:20] + [rand.getrandbits(64) for i in range(5)]:
+            expected = sorted(i for i, v in enumerate(values)
+                              if hamming(query, v) <= 20)
+            found = sorted(i for d, i in tree.search(query, 20))
+            self.assertEqual(found, expected)
+
+
+class TestNearDuplicateIndex(PerceptualTestCase):
+    def test_skip(self):
+        index = NearDuplicateIndex(Database('test'), policy=SKIP)
+        small = self.save(noise(1), 'small.png')
+        big = self.save(noise(1, (192, 128)), 'big.png')
+        keep, match = index.claim(self.download('small.png', small, 'a'),
+                                  small)
+        self.assertEqual((keep, match), (True, None))
+        keep, match = index.claim(self.download('big.png', big, 'b'), big)
+        self.assertFalse(keep)
+        self.assertEqual(match.filename, 'small.png')
+
+    def test_keep_larger_and_reload(self):
+        database = Database('test')
+        writer = WriteBuffer(database, max_rows=1)
+        index = NearDuplicateIndex(database, policy=KEEP_LARGER)
+        small = self.save(noise(1), 'small.png')
+        big = self.save(noise(1, (192, 128)), 'big.png')
+        first = self.download('small.png', small, 'a')
+        index.claim(first, small)
+        writer.add_wallpaper(first)
+        second = self.download('big.png', big, 'b')
+        keep, match = index.claim(second, big)
+        self.assertTrue(keep)
+        self.assertTrue(match is first)
+        writer.add_wallpaper(second)
+        writer.add_replacement(first.md5, second.md5)
+        #the smaller copy is out of the index once it has been replaced
+        reloaded = NearDuplicateIndex(database, policy=KEEP_LARGER)
+        keep, match = reloaded.claim(self.download('small.png', small, 'c'),
+                                     small)
+        self.assertFalse(keep)
+        self.assertEqual(match.md5, 'b')
+
+    def test_backfill(self):
+        database = Database('test')
+        writer = WriteBuffer(database, max_rows=1)
+        for n in range(3):
+            path = self.save(noise(n), '%d.png' % n)
+            writer.add_wallpaper(self.download('%d.png' % n, path, str(n)))
+        self.assertEqual(backfill(database, self.tmp, processes=2), 3)
+        self.assertEqual(backfill(database, self.tmp, processes=2), 0)
+        conn = database.engine.connect()
+        stored = conn.execute("SELECT dhash FROM wallpapers "
+                              "WHERE md5 = '1'").scalar()
+        self.assertEqual(stored, to_hex(dhash(os.path.join(self.tmp,
+                                                           '1.png'))))
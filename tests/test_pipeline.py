@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from journal import Journal, FAILED
+from pipeline import Pipeline
+from reddit_connect import RedditConnect
+from tests.test_base_plugin import FakeResponse, png_bytes
+
+
+class FakeRedditConnect(RedditConnect):
+    """
+    Serves `pages` pages of liked posts from memory, every other one in a
+    wanted subreddit
+    """
+    def __init__(self, pages, per_page, log):
+        RedditConnect.__init__(self, 'username', 'password')
+        self.pages = pages
+        self.per_page = per_page
+        self.log = log
+
+    def get_upvotes_page(self, after=None, count=0, limit=25):
+        page = 0 if after is None else int(after) + 1
+        self.log.append(('page', page))
+        children = []
+        for n in range(self.per_page):
+            post = page * self.per_page + n
+            children.append({'data': {
+                'name': 't3_%d' % post,
+                'title': 'post %d' % post,
+                'subreddit': 'Wallpapers' if post % 2 else 'pics',
+                'url': 'http://i.imgur.com/%d.png' % post}})
+        after = str(page) if page + 1 < self.pages else None
+        return {'data': {'after': after, 'children': children}}
+
+
+class FakeSession(object):
+    def __init__(self, log):
+        self.log = log
+
+    def get(self, url, **kwargs):
+        self.log.append(('get', url))
+        n = int(url.rsplit('/', 1)[1].split('.')[0])
+        image = png_bytes((n, 0, 0))
+        return FakeResponse(200, {'content-type': 'image/png'}, image)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def run_pipeline(self, log, pages=4):
+        pipeline = Pipeline(FakeRedditConnect(pages, 6, log), ['wallpapers'],
+                            'test', 'out', resolvers=1, queue_size=1,
+                            workers=0, session=FakeSession(log),
+                            preflight=False)
+        pipeline.acquire()
+        return pipeline
+
+    def test_downloads_start_before_paging_finishes(self):
+        log = []
+        pipeline = self.run_pipeline(log)
+        self.assertEqual(len(pipeline.handled), 12)
+        self.assertEqual(len(os.listdir('out')), 12)
+        first_get = log.index([e for e in log if e[0] == 'get'][0])
+        self.assertTrue(first_get < log.index(('page', 3)))
+
+    def test_second_run_downloads_nothing(self):
+        self.run_pipeline([])
+        log = []
+        pipeline = self.run_pipeline(log)
+        self.assertEqual(pipeline.handled, [])
+        self.assertFalse([e for e in log if e[0] == 'get'])
+
+    def test_retries_failed_posts_from_the_journal(self):
+        journal = Journal('test_journal.log')
+        journal.post('http://i.imgur.com/101.png', FAILED, reason='boom',
+                     title='t', subreddit='wallpapers')
+        journal.close()
+        log = []
+        self.run_pipeline(log, pages=1)
+        self.assertEqual([e for e in log if e[0] == 'get'][0],
+                         ('get', 'http://i.imgur.com/101.png'))
+        self.assertTrue('101.png' in os.listdir('out'))
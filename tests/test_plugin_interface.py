@@ -1,6 +1,13 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from plugin_interface import extract_domain
+import plugin_interface
+from data_types import Download
+from plugin_interface import extract_domain, PluginRouter, PluginInterface
+from plugins import loaded_plugins
+from tests.test_pipeline import FakeSession
 
 
 class TestExtractDomain(unittest.TestCase):
@@ -38,4 +45,141 @@ class TestExtractDomain(unittest.TestCase):
               '/~userfolder/timedate01-23-04/unixtime/13019348623/image' \
               '.png?token=3418327129&other_param="some_other_stuff_to_ignore'
         extracted = extract_domain(url)
-        self.assertEqual(extracted, 'deviantart.com')
\ No newline at end of file
+        self.assertEqual(extracted, 'deviantart.com')
+
+class TestPluginRouter(unittest.TestCase):
+    def setUp(self):
+        self.plugins = dict((p.__name__, p) for p in loaded_plugins)
+        self.router = PluginRouter(loaded_plugins)
+
+    def assertRoutedTo(self, url, name):
+        plugin = self.router.route(url)
+        self.assertEqual(plugin.__name__ if plugin else None, name)
+
+    def test_route_imgur_album(self):
+        self.assertRoutedTo('http://imgur.com/a/abcde', 'ImgurAlbum')
+
+    def test_route_imgur_single_indirect(self):
+        self.assertRoutedTo('http://imgur.com/abcde', 'ImgurSingleIndirect')
+
+    def test_route_imgur_direct_link_with_reddit_argument(self):
+        self.assertRoutedTo('http://i.imgur.com/nbsQ4SF.jpg#.UTtRkqYGmy0'
+                            '.reddit', 'DirectLinks')
+
+    def test_route_direct_link_any_host(self):
+        self.assertRoutedTo('http://example.com/wall.PNG?size=big',
+                            'DirectLinks')
+
+    def test_route_subdomain(self):
+        self.assertRoutedTo('http://oscillot.deviantart.com/art/thing-123',
+                            'DeviantArt')
+        self.assertRoutedTo('http://someone.tumblr.com/post/123', 'Tumblr')
+
+    def test_route_direct_links_past_domain_plugins(self):
+        for url in ['http://24.media.tumblr.com/abc/tumblr_x_1280.jpg',
+                    'http://someone.tumblr.com/photo.png',
+                    'http://i.imgur.com/abc.jpg?1',
+                    'http://i.imgur.com/abc.jpeg',
+                    'http://imgur.com/abc.JPG']:
+            self.assertRoutedTo(url, 'DirectLinks')
+
+    def test_routes_domain_plugin_first(self):
+        self.assertEqual([p.__name__ for p in self.router.routes(
+            'http://oscillot.deviantart.com/wall.png')],
+            ['DeviantArt', 'DirectLinks'])
+
+    def test_route_unclaimed(self):
+        self.assertRoutedTo('http://example.com/some/page', None)
+
+    def test_route_matches_handles(self):
+        for url in ['http://imgur.com/a/abcde', 'http://imgur.com/abcde',
+                    'http://www.flickr.com/photos/someone/123',
+                    'http://500px.com/photo/123']:
+            plugin = self.router.route(url)
+            self.assertTrue(plugin.handles(url))
+
+
+class Claims(object):
+    def __init__(self, name, domains, url_pattern, claims, log):
+        self.__name__ = name
+        self.domains = domains
+        self.url_pattern = url_pattern
+        self.claims = claims
+        self.log = log
+
+    def process_candidate(self, candidate):
+        self.log.append(self.__name__)
+        return self.claims
+
+
+class TestDispatch(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.pi = PluginInterface('test', [], 'out', workers=0,
+                                  preflight=False, journal=False)
+        self.pi.prepare()
+        self.log = []
+
+    def tearDown(self):
+        self.pi.writer.close()
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def dispatch(self, url, *plugins):
+        self.pi.dispatch(Download('t', 'wallpapers', url),
+                         PluginRouter(plugins), lambda plugin: plugin)
+
+    def test_falls_through_when_the_owner_finds_nothing(self):
+        self.dispatch('http://host.com/wall.png',
+                      Claims('Owner', ('host.com',), None, False, self.log),
+                      Claims('Direct', None, r'.*\.png$', False, self.log),
+                      Claims('Fallback', None, None, True, self.log))
+        self.assertEqual(self.log, ['Owner', 'Direct', 'Fallback'])
+        self.assertEqual(self.pi.unclaimed, [])
+
+    def test_stops_at_the_first_plugin_that_claims_it(self):
+        self.dispatch('http://host.com/wall.png',
+                      Claims('Owner', ('host.com',), None, True, self.log),
+                      Claims('Direct', None, r'.*\.png$', True, self.log))
+        self.assertEqual(self.log, ['Owner'])
+
+    def test_unclaimed(self):
+        self.dispatch('http://host.com/wall.png',
+                      Claims('Owner', ('host.com',), None, False, self.log))
+        self.assertEqual(len(self.pi.unclaimed), 1)
+
+
+class TestStreamingCandidates(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.batch = plugin_interface.CANDIDATE_BATCH
+        plugin_interface.CANDIDATE_BATCH = 10
+
+    def tearDown(self):
+        plugin_interface.CANDIDATE_BATCH = self.batch
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def test_consumes_a_generator_a_batch_at_a_time(self):
+        log = []
+
+        def candidates():
+            for n in range(25):
+                log.append(('yield', n))
+                url = 'http://i.imgur.com/%d.png' % n
+                if n == 7:
+                    url = 'http://example.com/gallery/7'
+                yield Download('title %d' % n, 'wallpapers', url)
+
+        pi = PluginInterface('test', candidates(), 'out', workers=0,
+                             session=FakeSession(log), preflight=False)
+        pi.acquire()
+        self.assertEqual(len(pi.handled), 24)
+        first_get = log.index([e for e in log if e[0] == 'get'][0])
+        self.assertTrue(first_get < log.index(('yield', 10)))
+        self.assertEqual(pi.unhandled, [('example.com',
+                                         'http://example.com/gallery/7')])
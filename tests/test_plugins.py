@@ -0,0 +1,257 @@
+import os
+import sys
+import base64
+import shutil
+import tempfile
+import warnings
+import unittest
+import subprocess
+
+from data_types import Download
+from plugin_interface import PluginInterface, PluginRouter
+from plugins import PluginRegistry
+from tests.http_fixtures import FixtureStore, FixtureServer
+from tests.test_base_plugin import png_bytes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class PluginTestCase(unittest.TestCase):
+    """
+    Runs candidates through every plugin against pages served by a
+    `class` FixtureServer
+    """
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.store = FixtureStore()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def add_image(self, url, n):
+        self.store.add(url, png_bytes((n % 256, n / 256, 0)), 'image/png')
+
+    def acquire(self, url, **kwargs):
+        self.server = FixtureServer(self.store, **kwargs).start()
+        pi = PluginInterface('test', [Download('t', 'wallpapers', url)],
+                             'out', workers=4, per_host=4,
+                             session=self.server.session(), preflight=False)
+        pi.acquire()
+        return sorted(os.listdir('out')) if os.path.isdir('out') else []
+
+    def gets(self, prefix):
+        return [url for method, url in self.server.requests
+                if method == 'GET' and url.startswith(prefix)]
+
+
+class TestWallbaseCollection(PluginTestCase):
+    collection = 'http://wallbase.cc/user/collection/1/'
+
+    def add_collection(self, images):
+        self.store.add(self.collection,
+                       '<html><body><div id="delwrap"><div></div><div>'
+                       '<div></div><div></div><div></div><div><span></span>'
+                       '<span>%d</span></div></div></div></body></html>' %
+                       images)
+        start = 1
+        while start <= images + 32:
+            thumbs = ''.join('<a class="thumb" href="http://wallbase.cc/'
+                             'wallpaper/%d">x</a>' % n
+                             for n in range(start, min(start + 32,
+                                                       images + 1)))
+            self.store.add('%s%d/%d' % (self.collection, start, start + 31),
+                           '<html><body>%s</body></html>' % thumbs)
+            start += 32
+        for n in range(1, images + 1):
+            #every tenth wallpaper is the same image as the one before it
+            image = 'http://wallpapers.wallbase.cc/%d.png' % (n - n % 10 / 9)
+            self.store.add('http://wallbase.cc/wallpaper/%d' % n,
+                           '<html><body><div id="bigwall"><script>'
+                           'document.write(\'<img src="\'+B(\'%s\')+\'">\');'
+                           '</script></div></body></html>' %
+                           base64.b64encode(image))
+            self.add_image(image, n)
+
+    def test_whole_collection(self):
+        self.add_collection(70)
+        saved = self.acquire(self.collection, latency=0.02)
+        self.assertEqual(len(saved), 63)
+        self.assertEqual(len(self.gets('http://wallbase.cc/wallpaper/')), 70)
+        #the collection page and then its four pages of thumbnails
+        self.assertEqual(len(self.gets(self.collection)), 5)
+
+
+class TestTumblr(PluginTestCase):
+    post = 'http://me.tumblr.com/post/1'
+
+    def photo(self, n):
+        return 'http://68.media.tumblr.com/%d/tumblr_%d_1280.jpg' % (n, n)
+
+    def test_photosets_with_one_missing(self):
+        iframes = ''
+        for photoset in range(3):
+            src = 'http://me.tumblr.com/post/1/photoset_iframe/%d' % photoset
+            iframes += '<iframe class="photoset" src="%s"></iframe>' % src
+            if photoset == 1:
+                continue
+            links = ''.join('<a class="photoset_photo" href="%s"><img src='
+                            '"x_500.jpg"></a>' % self.photo(photoset * 10 + n)
+                            for n in range(3))
+            self.store.add(src, '<html><body>%s</body></html>' % links)
+            for n in range(3):
+                self.add_image(self.photo(photoset * 10 + n),
+                               photoset * 10 + n)
+        self.store.add(self.post, '<html><body><img src="http://68.media.'
+                       'tumblr.com/9/tumblr_9_500.jpg">%s</body></html>' %
+                       iframes)
+        self.assertEqual(self.acquire(self.post),
+                         sorted('tumblr_%d_1280.jpg' % n
+                                for n in (0, 1, 2, 20, 21, 22)))
+
+    def test_original_sizes_on_the_page(self):
+        self.store.add(self.post, '<html><body><iframe class="photoset" src='
+                       '"http://me.tumblr.com/photoset_iframe/1"></iframe>'
+                       '<a href="%s"><img src="%s"></a><img src="%s">'
+                       '</body></html>' % (self.photo(1), self.photo(1),
+                                           self.photo(2)))
+        for n in (1, 2):
+            self.add_image(self.photo(n), n)
+        self.assertEqual(self.acquire(self.post),
+                         ['tumblr_1_1280.jpg', 'tumblr_2_1280.jpg'])
+        self.assertEqual(self.gets('http://me.tumblr.com/photoset'), [])
+
+
+class TestPluginRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, 'lazy_plugins')
+        os.mkdir(self.folder)
+        self.write('__init__', '')
+        self.write('hosts', 'from plugins.base_plugin import *\n'
+                   'import time\n\n'
+                   'class Host(BasePlugin):\n'
+                   '    domains = (\'host.com\',)\n'
+                   '    url_pattern = r\'http://host\\.com/a/\' \\\n'
+                   '                  r\'[0-9]+\'\n\n'
+                   'class MoreHost(Host):\n'
+                   '    cache_resolutions = False\n\n'
+                   'class NotAPlugin(object):\n'
+                   '    domains = (\'other.com\',)\n')
+        self.write('computed', 'from plugins.base_plugin import *\n\n'
+                   'class Computed(BasePlugin):\n'
+                   '    domains = tuple([\'computed.com\'])\n')
+        self.write('broken', 'import no_such_module\n'
+                   'class Broken(BasePlugin):\n'
+                   '    domains = (\'broken.com\',)\n')
+        sys.path.insert(0, self.tmp)
+        #the plugin modules are loaded into the package, which has to exist
+        __import__('lazy_plugins')
+
+    def tearDown(self):
+        sys.path.remove(self.tmp)
+        for name in list(sys.modules):
+            if name.startswith('lazy_plugins'):
+                del sys.modules[name]
+        shutil.rmtree(self.tmp)
+
+    def write(self, module, source):
+        with open(os.path.join(self.folder, module + '.py'), 'wb') as f:
+            f.write(source)
+
+    def registry(self):
+        return PluginRegistry(self.folder, 'lazy_plugins',
+                              os.path.join(self.tmp, 'manifest.json'))
+
+    def test_discovered_without_importing(self):
+        registry = self.registry()
+        plugins = registry.discover()
+        self.assertEqual([(p.__name__, p.domains, p.url_pattern)
+                          for p in plugins],
+                         [('Broken', ('broken.com',), None),
+                          ('Computed', ('computed.com',), None),
+                          ('Host', ('host.com',),
+                           r'http://host\.com/a/[0-9]+'),
+                          ('MoreHost', ('host.com',),
+                           r'http://host\.com/a/[0-9]+')])
+        #only the one with a computed attribute had to be imported
+        self.assertTrue('lazy_plugins.computed' in sys.modules)
+        self.assertFalse('lazy_plugins.hosts' in sys.modules)
+        router = PluginRouter(plugins)
+        host = router.route('http://host.com/a/123')
+        self.assertEqual(host.__name__, 'Host')
+        self.assertFalse(host.cache_resolutions is False)
+        self.assertTrue('lazy_plugins.hosts' in sys.modules)
+        self.assertTrue(host.import_seconds is not None)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(router.route('http://broken.com/1').load(), None)
+        self.assertEqual([str(w.message) for w in caught
+                          if 'failed to load' in str(w.message)],
+                         ['Plugin broken failed to load: No module named '
+                          'no_such_module'])
+
+    def test_qualified_and_inherited_bases(self):
+        self.write('more', 'import plugins.base_plugin\n'
+                   'from lazy_plugins.hosts import Host\n\n'
+                   'class Qualified(plugins.base_plugin.BasePlugin):\n'
+                   '    domains = (\'qualified.com\',)\n\n'
+                   'class OtherHost(Host):\n'
+                   '    url_pattern = r\'http://host\\.com/b/\'\n')
+        self.write('recomputed', 'import lazy_plugins.computed\n\n'
+                   'class Recomputed(lazy_plugins.computed.Computed):\n'
+                   '    pass\n')
+        plugins = dict((p.__name__, p) for p in self.registry().discover())
+        self.assertEqual(plugins['Qualified'].domains, ('qualified.com',))
+        self.assertEqual((plugins['OtherHost'].domains,
+                          plugins['OtherHost'].url_pattern),
+                         (('host.com',), r'http://host\.com/b/'))
+        self.assertFalse('lazy_plugins.more' in sys.modules)
+        host = PluginRouter(plugins.values()).route('http://host.com/b/1')
+        self.assertEqual(host.__name__, 'OtherHost')
+        self.assertEqual(host.load().__bases__[0].__name__, 'Host')
+        #a subclass of a computed plugin has to be imported up front too
+        self.assertEqual(plugins['Recomputed'].domains, ('computed.com',))
+
+    def test_manifest_skips_unchanged_files(self):
+        self.assertEqual(len(self.registry().discover()), 4)
+        registry = self.registry()
+        self.assertEqual(len(registry.discover()), 4)
+        self.assertEqual(registry.scanned, [])
+        self.write('broken', 'def broken(:\n')
+        registry = self.registry()
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.assertEqual([p.__name__ for p in registry.discover()],
+                             ['Computed', 'Host', 'MoreHost'])
+        self.assertEqual(registry.scanned, ['broken'])
+
+    def test_loads_after_a_chdir(self):
+        #python -m and -c put a relative '' on sys.path, so this has to be
+        # a fresh interpreter that hasn't imported the plugins yet
+        script = ('import os\n'
+                  'from plugin_interface import PluginRouter\n'
+                  'from plugins import loaded_plugins, failed_plugins\n'
+                  'os.chdir(%r)\n'
+                  'plugin = PluginRouter(loaded_plugins).route('
+                  '"http://i.imgur.com/1.png")\n'
+                  'print plugin.load().__name__, failed_plugins\n' %
+                  self.tmp)
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=ROOT, stderr=subprocess.STDOUT)
+        self.assertEqual(output.splitlines()[-1], 'DirectLinks []')
+
+    def test_importing_leaves_the_heavy_modules_unloaded(self):
+        #a fresh interpreter, as this one has imported everything already
+        script = ('import sys\n'
+                  'import plugin_interface\n'
+                  'print sorted(name for name in ("sqlalchemy", "lxml", "PIL")'
+                  ' if name in sys.modules)\n')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=ROOT, stderr=subprocess.STDOUT)
+        self.assertEqual(output.splitlines()[-1], '[]')
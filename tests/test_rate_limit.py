@@ -0,0 +1,76 @@
+import time
+import unittest
+from email.utils import formatdate
+
+from rate_limit import TokenBucket, RateLimiter, parse_retry_after
+
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_throttled(self):
+        bucket = TokenBucket(rate=20, capacity=3)
+        start = time.time()
+        for i in range(3):
+            bucket.acquire()
+        self.assertTrue(time.time() - start < 0.05)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.08)
+
+    def test_block(self):
+        bucket = TokenBucket(rate=1000, capacity=5)
+        bucket.block(0.1)
+        start = time.time()
+        bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_set_budget_spreads_remaining(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.set_budget(30, 60)
+        self.assertEqual(bucket.rate, 0.5)
+        bucket.set_budget(0, 0.1)
+        self.assertEqual(bucket.tokens, 0)
+        self.assertTrue(bucket.blocked_until > time.time())
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_subdomains_share_a_bucket(self):
+        limiter = RateLimiter()
+        self.assertTrue(limiter.bucket('www.reddit.com') is
+                        limiter.bucket('ssl.reddit.com'))
+        self.assertTrue(limiter.bucket('i.imgur.com') is not
+                        limiter.bucket('imgur.com'))
+
+    def test_unlimited_host(self):
+        limiter = RateLimiter(default_rate=None)
+        self.assertEqual(limiter.bucket('imgur.com'), None)
+        limiter.acquire('imgur.com')
+        limiter.update('imgur.com', FakeResponse({'retry-after': '100'}))
+
+    def test_update_from_reddit_headers(self):
+        limiter = RateLimiter()
+        limiter.update('www.reddit.com',
+                       FakeResponse({'x-ratelimit-remaining': '60.0',
+                                     'x-ratelimit-reset': '30'}))
+        self.assertEqual(limiter.bucket('reddit.com').rate, 2.0)
+
+    def test_update_from_retry_after(self):
+        limiter = RateLimiter()
+        limiter.update('imgur.com', FakeResponse({'retry-after': '120'}))
+        self.assertTrue(limiter.bucket('imgur.com').blocked_until >
+                        time.time() + 100)
+
+
+class TestParseRetryAfter(unittest.TestCase):
+    def test_seconds_and_dates(self):
+        self.assertEqual(parse_retry_after('7'), 7)
+        self.assertEqual(parse_retry_after(None), None)
+        self.assertEqual(parse_retry_after('soon'), None)
+        later = parse_retry_after(formatdate(time.time() + 60, usegmt=True))
+        self.assertTrue(55 <= later <= 61)
+        past = parse_retry_after(formatdate(time.time() - 60, usegmt=True))
+        self.assertEqual(past, 0)
@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import urlparse
+
+from database import Database
+from reddit_connect import RedditConnect, BACKFILL
+
+
+class FakeRedditConnect(RedditConnect):
+    """
+    Serves a liked listing of `total` posts, newest first, from memory
+    """
+    def __init__(self, total, fail_after=None):
+        RedditConnect.__init__(self, 'username', 'password')
+        self.posts = ['t3_%d' % n for n in range(total, 0, -1)]
+        self.requests = []
+        self.fail_after = fail_after
+
+    def basic_request(self, url):
+        self.requests.append(url)
+        if self.fail_after is not None and \
+                len(self.requests) > self.fail_after:
+            return None
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(url).query))
+        limit = int(query['limit'])
+        start = 0
+        if 'after' in query:
+            start = self.posts.index(query['after']) + 1
+        page = self.posts[start:start + limit]
+        after = page[-1] if start + limit < len(self.posts) else None
+        return json.dumps({'data': {
+            'after': after,
+            'children': [{'data': {
+                'name': name,
+                'created_utc': float(int(name[3:]) * 100),
+                'title': 'title %s' % name,
+                'subreddit': 'wallpapers' if int(name[3:]) % 2 else 'pics',
+                'url': 'http://i.imgur.com/%s.jpg' % name}}
+                for name in page]}})
+
+    def wait(self):
+        pass
+
+
+class RedditConnectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.database = Database('test')
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def names(self, upvotes):
+        return [u['data']['name'] for u in upvotes]
+
+
+class TestSyncUpvotes(RedditConnectTestCase):
+    def test_incremental_stops_at_high_water_mark(self):
+        rc = FakeRedditConnect(50)
+        self.assertEqual(len(rc.sync_upvotes(self.database, limit=10)), 50)
+        rc.save_sync_mark()
+        rc = FakeRedditConnect(53)
+        upvotes = rc.sync_upvotes(self.database, limit=10)
+        self.assertEqual(self.names(upvotes), ['t3_53', 't3_52', 't3_51'])
+        self.assertEqual(len(rc.requests), 1)
+
+    def test_stops_past_a_mark_that_was_unupvoted(self):
+        rc = FakeRedditConnect(50)
+        rc.sync_upvotes(self.database, limit=10)
+        rc.save_sync_mark()
+        rc = FakeRedditConnect(53)
+        rc.posts.remove('t3_50')
+        upvotes = self.names(rc.sync_upvotes(self.database, limit=10))
+        self.assertEqual(upvotes[:4], ['t3_53', 't3_52', 't3_51', 't3_49'])
+        #the first page still had new posts on it, the second had none
+        self.assertEqual(len(rc.requests), 2)
+        rc.save_sync_mark()
+        self.assertEqual(self.database.get_state(
+            'upvotes_high_water:username'), 't3_53')
+
+    def test_unsaved_mark_is_not_used(self):
+        rc = FakeRedditConnect(20)
+        rc.sync_upvotes(self.database, limit=10)
+        rc = FakeRedditConnect(20)
+        self.assertEqual(len(rc.sync_upvotes(self.database, limit=10)), 20)
+
+    def test_mark_not_moved_when_cut_short(self):
+        rc = FakeRedditConnect(30)
+        rc.sync_upvotes(self.database, limit=10, max_pages=1)
+        rc.save_sync_mark()
+        self.assertEqual(self.database.get_state(
+            'upvotes_high_water:username'), None)
+
+    def test_backfill_resumes_from_cursor(self):
+        rc = FakeRedditConnect(30, fail_after=2)
+        self.assertRaises(ValueError, rc.sync_upvotes, self.database,
+                          BACKFILL, None, 10)
+        rc = FakeRedditConnect(30)
+        upvotes = rc.sync_upvotes(self.database, BACKFILL, limit=10)
+        self.assertEqual(self.names(upvotes)[0], 't3_10')
+        self.assertEqual(len(upvotes), 10)
+        self.assertEqual(self.database.get_state(
+            'upvotes_backfill_after:username'), None)
+
+
+class TestIterUpvotes(RedditConnectTestCase):
+    def test_pages_lazily(self):
+        rc = FakeRedditConnect(50)
+        upvotes = rc.iter_upvotes(limit=10)
+        self.assertEqual(rc.requests, [])
+        self.assertEqual(next(upvotes)['data']['name'], 't3_50')
+        self.assertEqual(len(rc.requests), 1)
+        self.assertEqual(len(list(upvotes)), 49)
+        self.assertEqual(len(rc.requests), 5)
+        self.assertEqual(rc.sync_mark, None)
+
+    def test_max_pages(self):
+        rc = FakeRedditConnect(50)
+        self.assertEqual(len(list(rc.iter_upvotes(max_pages=2, limit=10))),
+                         20)
+
+    def test_syncs_with_a_database(self):
+        rc = FakeRedditConnect(20)
+        list(rc.iter_upvotes(limit=10, database=self.database))
+        rc.save_sync_mark()
+        rc = FakeRedditConnect(22)
+        self.assertEqual(self.names(rc.iter_upvotes(
+            limit=10, database=self.database)), ['t3_22', 't3_21'])
+
+    def test_backfill_replays_a_page_stopped_partway(self):
+        rc = FakeRedditConnect(30)
+        upvotes = rc.iter_upvotes(limit=10, database=self.database,
+                                  mode=BACKFILL)
+        for n in range(15):
+            next(upvotes)
+        upvotes.close()
+        rc = FakeRedditConnect(30)
+        self.assertEqual(self.names(rc.iter_upvotes(
+            limit=10, database=self.database, mode=BACKFILL))[0], 't3_20')
+
+    def test_iter_candidates_filters_by_subreddit(self):
+        rc = FakeRedditConnect(10)
+        candidates = list(rc.iter_candidates(['WallPapers'],
+                                             rc.iter_upvotes(limit=10)))
+        self.assertEqual([c.url for c in candidates],
+                         ['http://i.imgur.com/t3_%d.jpg' % n
+                          for n in (9, 7, 5, 3, 1)])
+        self.assertEqual(candidates[0].title, 'title t3_9')
@@ -0,0 +1,108 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy.sql as sql
+
+from data_types import Download
+from database import Database, DedupIndex, WriteBuffer
+from resolution_cache import ResolutionCache
+from plugins.base_plugin import BasePlugin
+
+
+class FakeAcquirer(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, host, func, *args):
+        self.submitted.append(args[0])
+
+
+class CountingPlugin(BasePlugin):
+    executions = 0
+
+    def execute(self):
+        CountingPlugin.executions += 1
+        for n in range(2):
+            self.current = Download(self.candidate.title,
+                                    self.candidate.subreddit,
+                                    'http://i.imgur.com/%d.jpg' % n,
+                                    {'session': 'abc'})
+
+
+class ResolutionCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.here = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.database = Database('test')
+
+    def tearDown(self):
+        os.chdir(self.here)
+        shutil.rmtree(self.tmp)
+
+    def post(self):
+        return Download('album', 'wallpapers', 'http://imgur.com/a/xyz')
+
+    def images(self):
+        return [Download('album', 'wallpapers', 'http://i.imgur.com/1.jpg',
+                         {'a': '1'})]
+
+
+class TestResolutionCache(ResolutionCacheTestCase):
+    def test_survives_between_runs(self):
+        ResolutionCache(self.database).put('http://imgur.com/a/xyz',
+                                           self.images())
+        cache = ResolutionCache(Database('test'))
+        images = cache.get('http://imgur.com/a/xyz')
+        self.assertEqual(images, [{'url': 'http://i.imgur.com/1.jpg',
+                                   'title': 'album', 'cookies': {'a': '1'}}])
+        self.assertEqual(cache.get('http://imgur.com/a/other'), None)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_expired_entries_miss_and_are_evicted(self):
+        cache = ResolutionCache(self.database, ttl=60)
+        cache.writer.add_resolution('http://imgur.com/a/old', '[]',
+                                    int(time.time()) - 120, 0)
+        self.assertEqual(cache.get('http://imgur.com/a/old'), None)
+        self.assertEqual(cache.evict(), 1)
+
+    def test_evicts_least_recently_used(self):
+        writer = WriteBuffer(self.database, max_rows=100, max_delay=None)
+        cache = ResolutionCache(self.database, writer, max_entries=2,
+                                memory_entries=1)
+        for n in range(3):
+            cache.put('http://imgur.com/a/%d' % n, self.images())
+        writer.flush()
+        cache.get('http://imgur.com/a/0')
+        writer.flush()
+        cache.evict()
+        table = self.database.resolutions
+        left = set(r[0] for r in self.database.engine.connect().execute(
+            sql.select([table.c.post_url])))
+        self.assertEqual(left, set(['http://imgur.com/a/0',
+                                    'http://imgur.com/a/2']))
+
+
+class TestPluginResolutionCache(ResolutionCacheTestCase):
+    def make_plugin(self, acquirer):
+        return CountingPlugin('test', [], self.tmp,
+                              dedup=DedupIndex(self.database),
+                              acquirer=acquirer)
+
+    def test_second_run_skips_execute(self):
+        CountingPlugin.executions = 0
+        first = FakeAcquirer()
+        self.assertTrue(self.make_plugin(first).process_candidate(
+            self.post()))
+        second = FakeAcquirer()
+        plugin = self.make_plugin(second)
+        self.assertTrue(plugin.process_candidate(self.post()))
+        self.assertEqual(CountingPlugin.executions, 1)
+        self.assertEqual([d.url for d in second.submitted],
+                         [d.url for d in first.submitted])
+        self.assertEqual(second.submitted[0].cookies, {'session': 'abc'})
+        self.assertEqual(plugin.resolution_cache.hits, 1)